@@ -0,0 +1,505 @@
+"""Bulk admin operations on users and subscriptions.
+
+    python admin.py import customers.csv --checkpoint migrate-2024
+    python admin.py import customers.jsonl --dry-run
+    python admin.py extend --days 7 --checkpoint outage-0612
+    python admin.py extend --days 7 --panel de-1 --data-limit-gb 100
+    python admin.py reconcile --dry-run
+
+import reads CSV (with a header row) or JSONL, one customer per record:
+telegram_id (required), username, marzban_username (default tg_<id>),
+end_at (ISO 8601 or unix time) or days, data_limit_gb, is_trial, panel.
+Users that already have an active or pending subscription are skipped.
+
+extend moves end_at of every active subscription forward and pushes the
+new expiry (and data limit, if given) to Marzban.
+
+reconcile compares each panel's user list with the local users and live
+subscriptions and queues the repairs (create missing users, delete users
+without an active subscription, push expiry/data limit mismatches) for the
+bot's provisioning workers; with --dry-run it only prints what it found.
+
+Rows are written in batches together with their provisioning tasks, then
+pushed to Marzban with bounded concurrency. A push that fails stays in the
+provisioning outbox for the bot's workers to retry. With --checkpoint NAME
+progress is committed with each batch, and running the same command again
+resumes after the last committed batch.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Iterator, Optional
+from sqlalchemy import delete, insert, select, update
+from db.models import (
+    AdminCheckpoint,
+    ProvisioningTask,
+    SessionLocal,
+    Subscription,
+    SubscriptionQr,
+    User,
+    engine,
+    subscription_is_active,
+    subscription_is_live,
+)
+from bot.logs import setup_logging
+from bot.jobs import lease_free
+from bot.marzban_api import close_clients, create_user, start_clients, update_user
+from bot.notifications import reminder_window
+from bot.placement import on_panel, placement
+from bot.reconcile import format_report, reconcile_panels
+from bot.usage import forget_snapshots
+from config import MARZBAN_PANELS, PROVISIONING_LEASE, RECONCILE_BATCH_SIZE
+from init_db import init_db
+
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+PANEL_NAMES = {panel["name"] for panel in MARZBAN_PANELS}
+
+
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+@dataclass
+class ImportRecord:
+    line: int
+    telegram_id: int
+    username: Optional[str]
+    marzban_username: str
+    end_at: datetime
+    data_limit: Optional[int]
+    is_trial: bool
+    panel: Optional[str]
+
+
+def _field(raw: dict, name: str) -> Optional[str]:
+    value = raw.get(name)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def parse_record(line: int, raw: dict, now: datetime) -> ImportRecord:
+    # Raises ValueError with a message fit for the error report
+    telegram_id = _field(raw, "telegram_id")
+    if telegram_id is None:
+        raise ValueError("telegram_id is missing")
+    telegram_id = int(telegram_id)
+
+    end_at, days = _field(raw, "end_at"), _field(raw, "days")
+    if end_at is not None:
+        end_at = (
+            datetime.fromtimestamp(int(end_at), timezone.utc)
+            if end_at.isdigit()
+            else _utc(datetime.fromisoformat(end_at))
+        )
+    elif days is not None:
+        end_at = now + timedelta(days=float(days))
+    else:
+        raise ValueError("end_at or days is required")
+    if end_at <= now:
+        raise ValueError(f"end_at {end_at:%Y-%m-%d %H:%M} is in the past")
+
+    data_limit = _field(raw, "data_limit_gb")
+    panel = _field(raw, "panel")
+    if panel is not None and panel not in PANEL_NAMES:
+        raise ValueError(f"unknown panel {panel!r}")
+    return ImportRecord(
+        line=line,
+        telegram_id=telegram_id,
+        username=_field(raw, "username"),
+        marzban_username=_field(raw, "marzban_username") or f"tg_{telegram_id}",
+        end_at=end_at,
+        data_limit=int(float(data_limit) * GB) if data_limit is not None else None,
+        is_trial=(_field(raw, "is_trial") or "").lower() in ("1", "true", "yes"),
+        panel=panel,
+    )
+
+
+def read_records(path: str, fmt: str) -> Iterator[tuple[int, dict]]:
+    # Streams (line number, raw record); nothing is read ahead of the batch
+    stream = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(stream)
+            for raw in reader:
+                yield reader.line_num, raw
+        else:
+            for line, text in enumerate(stream, 1):
+                if text.strip():
+                    yield line, json.loads(text)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+class Progress:
+    def __init__(self, interval: float = 2.0):
+        self.interval = interval
+        self.processed = 0
+        self.written = 0
+        self.skipped = 0
+        self.errors = 0
+        self.pushed = 0
+        self.push_failed = 0
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def error(self, line: int, message: str) -> None:
+        self.errors += 1
+        print(f"line {line}: {message}", file=sys.stderr)
+
+    def report(self, final: bool = False) -> None:
+        now = time.monotonic()
+        if not final and now - self._reported < self.interval:
+            return
+        self._reported = now
+        elapsed = max(now - self.started, 1e-9)
+        print(
+            f"{'done' if final else 'progress'}: {self.processed} processed ({self.processed / elapsed:.0f}/s), "
+            f"{self.written} written, {self.skipped} skipped, {self.errors} errors, "
+            f"{self.pushed} pushed, {self.push_failed} left to the provisioning workers",
+            file=sys.stderr,
+        )
+
+
+async def load_checkpoint(name: Optional[str]) -> int:
+    if name is None:
+        return 0
+    async with SessionLocal() as session:
+        checkpoint = await session.get(AdminCheckpoint, name)
+    return checkpoint.position if checkpoint is not None else 0
+
+
+async def save_checkpoint(session, name: Optional[str], position: int, processed: int) -> None:
+    # In the caller's transaction, so the batch and its checkpoint commit together
+    if name is None:
+        return
+    await session.merge(
+        AdminCheckpoint(name=name, position=position, processed=processed, updated_at=datetime.now(timezone.utc))
+    )
+
+
+async def _push_one(task: dict, semaphore: asyncio.Semaphore) -> bool:
+    operation = create_user if task["kind"] == "create" else update_user
+    async with semaphore:
+        return await operation(
+            task["marzban_username"], data_limit=task["data_limit"], expire_at=task["expire_at"], panel=task["panel"]
+        )
+
+
+async def push_tasks(tasks: list[dict], concurrency: int, progress: Progress) -> None:
+    # Runs the batch's provisioning tasks right away instead of waiting for
+    # the bot's workers. They were committed with a lease, so workers leave
+    # them alone meanwhile and pick them up if this process dies.
+    if not tasks:
+        return
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(_push_one(task, semaphore) for task in tasks))
+    done = [task["id"] for task, ok in zip(tasks, results) if ok]
+    reprovisioned = [task["marzban_username"] for task, ok in zip(tasks, results) if ok]
+    by_panel: dict[Optional[str], list[str]] = {}
+    for task, ok in zip(tasks, results):
+        if ok:
+            by_panel.setdefault(task["panel"], []).append(task["marzban_username"])
+    failed = [task["id"] for task, ok in zip(tasks, results) if not ok]
+    activated = [task["subscription_id"] for task, ok in zip(tasks, results) if ok and task["kind"] == "create"]
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        if done:
+            await session.execute(
+                update(ProvisioningTask)
+                .where(ProvisioningTask.id.in_(done), ProvisioningTask.status == "pending")
+                .values(status="done", attempts=1, finished_at=now)
+            )
+            # as the bot's workers do: /profile uploads the link QR afresh
+            await session.execute(
+                delete(SubscriptionQr).where(SubscriptionQr.marzban_username.in_(reprovisioned))
+            )
+            for panel, names in by_panel.items():
+                await forget_snapshots(session, names, panel)
+        if activated:
+            await session.execute(
+                update(Subscription)
+                .where(Subscription.id.in_(activated), Subscription.status == "pending")
+                .values(status="active")
+            )
+        if failed:
+            await session.execute(
+                update(ProvisioningTask)
+                .where(ProvisioningTask.id.in_(failed), ProvisioningTask.status == "pending")
+                .values(run_after=now, last_error="admin.py push failed")
+            )
+        await session.commit()
+    progress.pushed += len(done)
+    progress.push_failed += len(failed)
+
+
+async def _insert_returning(session, model, returning, rows: list[dict]) -> list:
+    if not rows:
+        return []
+    result = await session.execute(insert(model).returning(*returning, sort_by_parameter_order=True), rows)
+    return result.all()
+
+
+async def import_batch(batch: list[tuple[int, dict]], args: argparse.Namespace, progress: Progress) -> list[dict]:
+    now = datetime.now(timezone.utc)
+    records: dict[int, ImportRecord] = {}
+    for line, raw in batch:
+        try:
+            record = parse_record(line, raw, now)
+        except (ValueError, TypeError) as exc:
+            progress.error(line, str(exc))
+            continue
+        if record.telegram_id in records:
+            progress.error(line, f"duplicate telegram_id {record.telegram_id} (first on line {records[record.telegram_id].line})")
+            continue
+        records[record.telegram_id] = record
+
+    async with SessionLocal() as session:
+        existing = {
+            user.telegram_id: user
+            for user in await session.scalars(select(User).where(User.telegram_id.in_(list(records))))
+        }
+        live = set(
+            await session.scalars(
+                select(Subscription.user_id).where(
+                    Subscription.user_id.in_([user.id for user in existing.values()]), subscription_is_live()
+                )
+            )
+        )
+        new_names = [r.marzban_username for r in records.values() if r.telegram_id not in existing]
+        taken = dict(
+            (await session.execute(
+                select(User.marzban_username, User.telegram_id).where(User.marzban_username.in_(new_names))
+            )).all()
+        )
+
+        new_users: list[dict] = []
+        targets: list[tuple[ImportRecord, Optional[User]]] = []
+        for record in records.values():
+            user = existing.get(record.telegram_id)
+            if user is not None and user.id in live:
+                progress.skipped += 1
+                continue
+            if user is None:
+                if record.marzban_username in taken:
+                    progress.error(
+                        record.line,
+                        f"marzban_username {record.marzban_username} belongs to telegram_id {taken[record.marzban_username]}",
+                    )
+                    continue
+                taken[record.marzban_username] = record.telegram_id
+                new_users.append({
+                    "telegram_id": record.telegram_id,
+                    "username": record.username,
+                    "marzban_username": record.marzban_username,
+                    "panel": record.panel or await placement.choose(session, record.telegram_id),
+                })
+            targets.append((record, user))
+
+        progress.processed += len(batch)
+        progress.written += len(targets)
+        if args.dry_run:
+            return []
+
+        inserted = await _insert_returning(session, User, (User.id, User.telegram_id), new_users)
+        panels = {row["telegram_id"]: row["panel"] for row in new_users}
+        user_ids = {telegram_id: user_id for user_id, telegram_id in inserted}
+        identities = []
+        for record, user in targets:
+            if user is not None:
+                identities.append((user.id, user.marzban_username, user.panel))
+            else:
+                identities.append((user_ids[record.telegram_id], record.marzban_username, panels[record.telegram_id]))
+
+        subscription_ids = await _insert_returning(session, Subscription, (Subscription.id,), [
+            {
+                "user_id": user_id,
+                "is_trial": record.is_trial,
+                "status": "pending",
+                "start_at": now,
+                "end_at": record.end_at,
+            }
+            for (record, _), (user_id, _, _) in zip(targets, identities)
+        ])
+        tasks = [
+            {
+                "kind": "create",
+                "marzban_username": marzban_username,
+                "panel": panel,
+                "subscription_id": subscription_id,
+                "data_limit": record.data_limit,
+                "expire_at": int(record.end_at.timestamp()),
+                "run_after": now + timedelta(seconds=PROVISIONING_LEASE),
+            }
+            for (record, _), (_, marzban_username, panel), (subscription_id,) in zip(targets, identities, subscription_ids)
+        ]
+        task_ids = await _insert_returning(session, ProvisioningTask, (ProvisioningTask.id,), tasks)
+        for task, (task_id,) in zip(tasks, task_ids):
+            task["id"] = task_id
+        await save_checkpoint(session, args.checkpoint, batch[-1][0], progress.processed)
+        await session.commit()
+    return tasks
+
+
+async def run_import(args: argparse.Namespace, progress: Progress) -> None:
+    resume_after = await load_checkpoint(args.checkpoint)
+    if resume_after:
+        print(f"resuming {args.checkpoint} after input line {resume_after}", file=sys.stderr)
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "jsonl")
+    records = ((line, raw) for line, raw in read_records(args.path, fmt) if line > resume_after)
+    pushing: Optional[asyncio.Task] = None
+    while batch := list(islice(records, args.batch_size)):
+        tasks = await import_batch(batch, args, progress)
+        # the previous batch is pushed while this one was being written
+        if pushing is not None:
+            await pushing
+        pushing = asyncio.create_task(push_tasks(tasks, args.concurrency, progress))
+        progress.report()
+    if pushing is not None:
+        await pushing
+
+
+async def run_extend(args: argparse.Namespace, progress: Progress) -> None:
+    cursor = await load_checkpoint(args.checkpoint)
+    if cursor:
+        print(f"resuming {args.checkpoint} after subscription {cursor}", file=sys.stderr)
+    delta = timedelta(days=args.days)
+    data_limit = int(args.data_limit_gb * GB) if args.data_limit_gb is not None else None
+    pushing: Optional[asyncio.Task] = None
+    while True:
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as session:
+            query = (
+                select(Subscription.id, Subscription.start_at, Subscription.end_at, User.marzban_username, User.panel)
+                .join(User, User.id == Subscription.user_id)
+                .where(subscription_is_active(), Subscription.id > cursor)
+            )
+            if args.panel:
+                query = query.where(on_panel(User.panel, args.panel))
+            # FOR UPDATE: the expiry jobs must not claim a row while it is being
+            # extended; a row they have already claimed is being revoked and is skipped
+            query = query.where(lease_free(now))
+            rows = (await session.execute(
+                query.order_by(Subscription.id).limit(args.batch_size).with_for_update(of=Subscription)
+            )).all()
+            if not rows:
+                break
+            cursor = rows[-1].id
+            progress.processed += len(rows)
+            progress.written += len(rows)
+            if args.dry_run:
+                progress.report()
+                continue
+
+            new_end = {row.id: _utc(row.end_at) + delta for row in rows}
+            # a reminder already sent for the old end_at must go out again
+            # before the new one, unless that is still inside the window
+            rearm = {row.id for row in rows if new_end[row.id] - now > reminder_window(row.start_at, new_end[row.id])}
+            await session.execute(
+                update(Subscription),
+                [
+                    {"id": sub_id, "end_at": end_at, **({"reminded_at": None} if sub_id in rearm else {})}
+                    for sub_id, end_at in new_end.items()
+                ],
+            )
+            tasks = [
+                {
+                    "kind": "update",
+                    "marzban_username": row.marzban_username,
+                    "panel": row.panel,
+                    "subscription_id": row.id,
+                    "data_limit": data_limit,
+                    "expire_at": int(new_end[row.id].timestamp()),
+                    "run_after": now + timedelta(seconds=PROVISIONING_LEASE),
+                }
+                for row in rows
+            ]
+            task_ids = await _insert_returning(session, ProvisioningTask, (ProvisioningTask.id,), tasks)
+            for task, (task_id,) in zip(tasks, task_ids):
+                task["id"] = task_id
+            await save_checkpoint(session, args.checkpoint, cursor, progress.processed)
+            await session.commit()
+
+        if pushing is not None:
+            await pushing
+        pushing = asyncio.create_task(push_tasks(tasks, args.concurrency, progress))
+        progress.report()
+    if pushing is not None:
+        await pushing
+
+
+async def run_reconcile(args: argparse.Namespace, progress: Progress) -> None:
+    panels = [args.panel] if args.panel else None
+    for report in await reconcile_panels(dry_run=args.dry_run, panels=panels, batch_size=args.batch_size):
+        print(format_report(report))
+        progress.processed += report.remote
+        progress.written += report.queued
+        progress.skipped += report.skipped
+        progress.errors += report.failed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--batch-size", type=int, default=500, help="rows per transaction")
+    common.add_argument("--concurrency", type=int, default=16, help="parallel Marzban requests")
+    common.add_argument("--checkpoint", help="name under which progress is saved; rerun with it to resume")
+    common.add_argument("--dry-run", action="store_true", help="validate and count, write nothing")
+
+    importer = commands.add_parser("import", parents=[common], help="import users and subscriptions from CSV/JSONL")
+    importer.add_argument("path", help="input file, or - for stdin")
+    importer.add_argument("--format", choices=("csv", "jsonl"), help="default: from the file extension")
+
+    extend = commands.add_parser("extend", parents=[common], help="extend all active subscriptions")
+    extend.add_argument("--days", type=float, required=True)
+    extend.add_argument("--panel", choices=sorted(PANEL_NAMES), help="only users on this panel")
+    extend.add_argument("--data-limit-gb", type=float, help="also set this data limit")
+
+    reconcile = commands.add_parser("reconcile", help="diff the panels against the database and queue repairs")
+    reconcile.add_argument("--panel", choices=sorted(PANEL_NAMES), help="only this panel")
+    reconcile.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE, help="repair tasks per transaction")
+    reconcile.add_argument("--dry-run", action="store_true", help="report the drift, queue nothing")
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> Progress:
+    progress = Progress()
+    await init_db()
+    await start_clients()
+    try:
+        if args.command == "import":
+            await run_import(args, progress)
+        elif args.command == "reconcile":
+            await run_reconcile(args, progress)
+        else:
+            await run_extend(args, progress)
+    finally:
+        progress.report(final=True)
+        await close_clients()
+        await engine.dispose()
+    return progress
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    setup_logging()
+    progress = asyncio.run(run(args))
+    if progress.errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
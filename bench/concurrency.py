@@ -0,0 +1,88 @@
+"""How one flooding user affects everyone else's updates.
+
+    python -m bench.concurrency --concurrency 8 --flood 100 --users 50
+
+One user sends --flood updates back to back, each taking --handler-ms (a
+slow panel call), while --users other users send one update each. Updates
+go through PerUserUpdateProcessor with --concurrency slots. The flooder's
+updates run one at a time; the other users' latency must stay close to
+what their own handlers cost, not grow with the flooder's queue.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from bench.load import percentile
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8, help="update processor slots")
+    parser.add_argument("--flood", type=int, default=100, help="updates from the flooding user")
+    parser.add_argument("--users", type=int, default=50, help="other users, one update each")
+    parser.add_argument("--handler-ms", type=float, default=50.0, help="time each update takes")
+    return parser.parse_args(argv)
+
+
+def configure_env() -> None:
+    # config.py reads the environment at import time
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["METRICS_PORT"] = "0"
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from bench.fake_telegram import FakeBot, make_command
+    from bot.concurrency import PerUserUpdateProcessor
+
+    bot = FakeBot()
+    processor = PerUserUpdateProcessor(args.concurrency)
+    handler_s = args.handler_ms / 1000
+    latencies: list[float] = []
+    running = peak = 0
+
+    async def handle(started: float, record: bool) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(handler_s)
+        running -= 1
+        if record:
+            latencies.append(time.perf_counter() - started)
+
+    async def send(telegram_id: int, record: bool) -> None:
+        update = make_command(bot, telegram_id, "/profile")
+        await processor.process_update(update, handle(time.perf_counter(), record))
+
+    flooder = 1_999_999
+    flood = [asyncio.create_task(send(flooder, False)) for _ in range(args.flood)]
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await asyncio.gather(*(send(1_000_000 + i, True) for i in range(args.users)))
+    others_s = time.perf_counter() - started
+    await asyncio.gather(*flood)
+
+    # the other users share concurrency - 1 slots while the flooder holds one
+    expected = -(-args.users // max(args.concurrency - 1, 1)) * handler_s
+    p95 = percentile(latencies, 95)
+    print(f"concurrency={args.concurrency} flood={args.flood} users={args.users} handler={args.handler_ms:.0f}ms")
+    print(
+        f"other users: all answered in {others_s * 1000:.0f}ms (ideal ~{expected * 1000:.0f}ms), "
+        f"p50 {percentile(latencies, 50) * 1000:.0f}ms p95 {p95 * 1000:.0f}ms; peak {peak} running"
+    )
+    ok = others_s < 2 * expected + handler_s and peak <= args.concurrency and not processor.active_users
+    print("ok" if ok else "FAILED")
+    return ok
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    configure_env()
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Exercise the outbound dispatcher against a bot that enforces Telegram's flood limits.
+
+    python -m bench.dispatch --users 300 --others 100
+    python -m bench.dispatch --rate 40 --error-rate 0.05
+
+Seeds a throwaway SQLite database with subscriptions around the reminder
+window, then runs the expiry reminder job twice (the second run must queue
+nothing) and a broadcast to every user while replies to user actions are
+submitted alongside it. The fake bot answers 429 RetryAfter above 30 msg/s
+overall or 1 msg/s per chat, Forbidden for blocked chats and, optionally,
+random network errors. A --rate above the fake's limit shows the dispatcher
+recovering from 429s instead of dropping messages.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from bench.load import percentile
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300, help="users with a subscription ending inside the reminder window")
+    parser.add_argument("--others", type=int, default=100, help="users not due a reminder (broadcast only)")
+    parser.add_argument("--blocked", type=int, default=10, help="users that blocked the bot")
+    parser.add_argument("--rate", type=float, default=0, help="DISPATCH_GLOBAL_RATE (default from config)")
+    parser.add_argument("--telegram-rate", type=int, default=30, help="messages per second the fake Bot API accepts")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of sends failing with a network error")
+    parser.add_argument("--max-queue", type=int, default=100, help="DISPATCH_MAX_QUEUE")
+    parser.add_argument("--replies", type=int, default=20, help="high-priority replies submitted during the broadcast")
+    return parser.parse_args(argv)
+
+
+def configure_env(args: argparse.Namespace) -> None:
+    # config.py reads the environment at import time
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["METRICS_PORT"] = "0"
+    if args.rate:
+        os.environ["DISPATCH_GLOBAL_RATE"] = str(args.rate)
+    os.environ["DISPATCH_MAX_QUEUE"] = str(args.max_queue)
+    os.environ.pop("POSTGRES_DSN", None)
+    os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_dispatch_")
+
+
+async def seed(args: argparse.Namespace) -> tuple[set[int], set[int]]:
+    from db.models import SessionLocal, Subscription, User
+    from config import REMINDER_HOURS
+
+    # Per due user: an active subscription ending inside its reminder window
+    # (every tenth a trial as long as the window, inside its scaled window).
+    # Around them, subscriptions that must not be reminded: already reminded,
+    # ending after the window, a trial whose scaled window hasn't opened yet,
+    # not active.
+    now = datetime.now(timezone.utc)
+    window = timedelta(hours=REMINDER_HOURS)
+    due, everyone = set(), set()
+    async with SessionLocal() as session:
+        for i in range(args.users + args.others):
+            tg_id = 3_000_000 + i
+            everyone.add(tg_id)
+            user = User(telegram_id=tg_id, username=f"bench_{tg_id}", marzban_username=f"tg_{tg_id}")
+            session.add(user)
+            await session.flush()
+            if i < args.users:
+                if i % 10 == 0:
+                    end_at = now + window / 10
+                    session.add(Subscription(user_id=user.id, is_trial=True, start_at=end_at - window, end_at=end_at))
+                else:
+                    end_at = now + window * ((i % 9) + 1) / 10
+                    session.add(Subscription(user_id=user.id, start_at=now - timedelta(days=30), end_at=end_at))
+                due.add(tg_id)
+                continue
+            kind = i % 4
+            if kind == 0:
+                session.add(Subscription(user_id=user.id, start_at=now - timedelta(days=30), end_at=now + window / 2, reminded_at=now))
+            elif kind == 1:
+                session.add(Subscription(user_id=user.id, start_at=now - timedelta(days=30), end_at=now + window * 2))
+            elif kind == 2:
+                session.add(Subscription(user_id=user.id, is_trial=True, start_at=now - window / 2, end_at=now + window / 2))
+            else:
+                session.add(Subscription(user_id=user.id, status="expired", start_at=now - timedelta(days=30), end_at=now + window / 2))
+        await session.commit()
+    return due, everyone
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from bench.fake_telegram import RateLimitedBot
+    from bot.dispatcher import PRIORITY_HIGH, dispatcher
+    from bot.notifications import broadcast, send_expiry_reminders
+    from config import DISPATCH_GLOBAL_RATE
+    from db.models import engine
+    from init_db import init_db
+
+    await init_db()
+    due, everyone = await seed(args)
+    blocked = frozenset(sorted(everyone)[: args.blocked])
+    bot = RateLimitedBot(global_rate=args.telegram_rate, error_rate=args.error_rate, blocked=blocked)
+    await dispatcher.start(bot)
+
+    max_depth = 0
+
+    async def sample_depth():
+        nonlocal max_depth
+        while True:
+            max_depth = max(max_depth, len(dispatcher))
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_depth())
+    ok = True
+    try:
+        reminders = await send_expiry_reminders(wait=True)
+        reminded = Counter(chat_id for chat_id, _ in bot.sent)
+        again = await send_expiry_reminders(wait=True)
+        expected = due - blocked
+        ok &= set(reminded) <= due and all(n == 1 for n in reminded.values())
+        ok &= reminders.queued == len(due) and again.queued == 0
+        ok &= len(reminded) == len(expected) or args.error_rate > 0
+
+        bot.sent.clear()
+        reply_latencies: list[float] = []
+
+        async def replies():
+            # Replies to user actions, submitted while the broadcast is queued
+            futures = []
+            for i in range(args.replies):
+                await asyncio.sleep(0.25)
+                submitted = time.perf_counter()
+                future = dispatcher.submit(4_000_000 + i, "reply", PRIORITY_HIGH)
+                future.add_done_callback(lambda _, s=submitted: reply_latencies.append(time.perf_counter() - s))
+                futures.append(future)
+            await asyncio.gather(*futures)
+
+        replying = asyncio.create_task(replies())
+        broadcasted = await broadcast("bench broadcast")
+        await replying
+        received = Counter(chat_id for chat_id, text in bot.sent if text == "bench broadcast")
+        ok &= broadcasted.queued == len(everyone) and all(n == 1 for n in received.values())
+        ok &= len(received) == len(everyone - blocked) or args.error_rate > 0
+        ok &= len(reply_latencies) == args.replies
+    finally:
+        sampler.cancel()
+        await dispatcher.stop()
+        await engine.dispose()
+
+    ok &= max_depth <= args.max_queue + args.replies
+    print(
+        f"users={len(everyone)} due={len(due)} blocked={len(blocked)} dispatch_rate={DISPATCH_GLOBAL_RATE}/s "
+        f"telegram_limit={args.telegram_rate}/s max_queue={args.max_queue}"
+    )
+    for name, stats in (("reminders", reminders), ("again", again), ("broadcast", broadcasted)):
+        rate = stats.sent / stats.elapsed if stats.elapsed else 0.0
+        print(f"{name:<10} queued {stats.queued:>6} sent {stats.sent:>6} failed {stats.failed:>4} in {stats.elapsed:6.2f}s ({rate:5.1f}/s)")
+    print(
+        f"replies    {len(reply_latencies):>6} during broadcast, latency p50 {percentile(reply_latencies, 50) * 1000:.0f}ms "
+        f"p95 {percentile(reply_latencies, 95) * 1000:.0f}ms"
+    )
+    print(
+        f"fake bot: 429s {bot.rejected}, network errors {bot.errors}, busiest second {bot.max_per_second} msgs; "
+        f"max queue depth {max_depth}"
+    )
+    print("ok" if ok else "FAILED")
+    return ok
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    configure_env(args)
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import asyncio
+import base64
+import json
+import random
+import secrets
+import time
+from collections import Counter
+from aiohttp import web
+
+
+def _jwt(exp: float) -> str:
+    def seg(obj) -> str:
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b"=").decode()
+
+    return f"{seg({'alg': 'none'})}.{seg({'sub': 'admin', 'exp': int(exp)})}.{secrets.token_hex(8)}"
+
+
+class FakeMarzban:
+    # In-process stand-in for the Marzban admin API with configurable latency,
+    # error rate and token lifetime (expired tokens get 401 like the real panel)
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        token_ttl: float = 3600.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.host = host
+        self.port = port
+        self.users: dict[str, dict] = {}
+        self.tokens: dict[str, float] = {}
+        self.requests: Counter = Counter()
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    async def start(self) -> None:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_post("/api/admin/token", self._token)
+        app.router.add_get("/api/users", self._list_users)
+        app.router.add_post("/api/user", self._create_user)
+        app.router.add_get("/api/user/{username}", self._get_user)
+        app.router.add_patch("/api/user/{username}", self._update_user)
+        app.router.add_put("/api/user/{username}", self._update_user)
+        app.router.add_delete("/api/user/{username}", self._delete_user)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "?"
+        self.requests[f"{request.method} {route}"] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if request.path != "/api/admin/token":
+            auth = request.headers.get("Authorization", "")
+            expires_at = self.tokens.get(auth.removeprefix("Bearer "))
+            if expires_at is None or expires_at < time.time():
+                return web.json_response({"detail": "Could not validate credentials"}, status=401)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"detail": "Internal Server Error"}, status=500)
+        return await handler(request)
+
+    def _public(self, user: dict) -> dict:
+        return {
+            **user,
+            "subscription_url": f"{self.url}/sub/{user['username']}",
+        }
+
+    async def _token(self, request: web.Request) -> web.Response:
+        token = _jwt(time.time() + self.token_ttl)
+        self.tokens[token] = time.time() + self.token_ttl
+        return web.json_response({"access_token": token, "token_type": "bearer"})
+
+    async def _list_users(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+        users = list(self.users.values())
+        return web.json_response(
+            {"users": [self._public(u) for u in users[offset:offset + limit]], "total": len(users)}
+        )
+
+    async def _create_user(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        username = payload["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        self.users[username] = {
+            "username": username,
+            "status": "active",
+            "used_traffic": 0,
+            "data_limit": payload.get("data_limit"),
+            "expire": payload.get("expire"),
+        }
+        return web.json_response(self._public(self.users[username]))
+
+    async def _get_user(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        user["used_traffic"] += random.randint(0, 1 << 20)
+        return web.json_response(self._public(user))
+
+    async def _update_user(self, request: web.Request) -> web.Response:
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        payload = await request.json()
+        for key in ("data_limit", "expire", "status"):
+            if key in payload:
+                user[key] = payload[key]
+        return web.json_response(self._public(user))
+
+    async def _delete_user(self, request: web.Request) -> web.Response:
+        if self.users.pop(request.match_info["username"], None) is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({})
@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from telegram import Bot, Chat, Message, PhotoSize, Update, User
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+_update_ids = itertools.count(1)
+_file_ids = itertools.count(1)
+
+
+class PhotoLog:
+    # Photos "sent": bytes are uploads and get a new file_id back, a str is a
+    # reference to a file_id handed out earlier
+    def __init__(self):
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.references = 0
+        self.file_ids: set[str] = set()
+
+    def send(self, chat_id, photo) -> Message:
+        if isinstance(photo, str):
+            if photo not in self.file_ids:
+                raise BadRequest("Wrong file identifier/http url specified")
+            self.references += 1
+            file_id = photo
+        else:
+            self.uploads += 1
+            self.uploaded_bytes += len(photo)
+            file_id = f"photo-{next(_file_ids)}"
+            self.file_ids.add(file_id)
+        return Message(
+            message_id=next(_update_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type=Chat.PRIVATE),
+            photo=(PhotoSize(file_id, f"unique-{file_id}", 360, 360),),
+        )
+
+
+class FakeBot:
+    # Records outgoing messages instead of calling the Bot API
+    def __init__(self):
+        self.sent: list[tuple[int, str]] = []
+        self.photos = PhotoLog()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return None
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return self.photos.send(chat_id, photo)
+
+
+class RateLimitedBot(FakeBot):
+    # Enforces the Bot API flood limits the way Telegram does: more than
+    # `global_rate` messages in any one second, or two to the same chat within
+    # a second, is answered with a 429 RetryAfter. Chats in `blocked` raise
+    # Forbidden; `error_rate` of calls fail with a NetworkError.
+    def __init__(
+        self,
+        global_rate: int = 30,
+        chat_interval: float = 1.0,
+        latency: float = 0.03,
+        error_rate: float = 0.0,
+        blocked: frozenset = frozenset(),
+        retry_after: int = 1,
+    ):
+        super().__init__()
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.latency = latency
+        self.error_rate = error_rate
+        self.blocked = blocked
+        self.retry_after = retry_after
+        self.window: deque[float] = deque()
+        self.last_by_chat: dict[int, float] = {}
+        self.rejected = 0
+        self.errors = 0
+        self.max_per_second = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        now = time.monotonic()
+        while self.window and self.window[0] <= now - 1.0:
+            self.window.popleft()
+        last = self.last_by_chat.get(chat_id)
+        if len(self.window) >= self.global_rate or (last is not None and now - last < self.chat_interval - 0.01):
+            self.rejected += 1
+            raise RetryAfter(self.retry_after)
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise NetworkError("Bad Gateway")
+        self.window.append(now)
+        self.max_per_second = max(self.max_per_second, len(self.window))
+        self.last_by_chat[chat_id] = now
+        await asyncio.sleep(self.latency)
+        self.sent.append((chat_id, text))
+        return None
+
+
+def make_command(bot, telegram_id: int, text: str) -> Update:
+    update_id = next(_update_ids)
+    user = User(id=telegram_id, first_name=f"user{telegram_id}", is_bot=False, username=f"bench_{telegram_id}")
+    chat = Chat(id=telegram_id, type=Chat.PRIVATE)
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(timezone.utc),
+        chat=chat,
+        from_user=user,
+        text=text,
+    )
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
+
+
+class OfflineBot(Bot):
+    # A real telegram.Bot (as an Application requires) that never calls the
+    # Bot API: getMe is answered locally and sent messages are recorded
+    def __init__(self, token: str = "0:bench"):
+        super().__init__(token)
+        with self._unfrozen():
+            self.sent: list[tuple[int, str]] = []
+            self.photos = PhotoLog()
+
+    async def get_me(self, *args, **kwargs) -> User:
+        self._bot_user = User(id=0, first_name="bench", is_bot=True, username="bench_bot")
+        return self._bot_user
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent.append((chat_id, text))
+        return None
+
+    async def send_photo(self, chat_id, photo, *args, **kwargs):
+        return self.photos.send(chat_id, photo)
+
+    async def set_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+
+def command_payload(telegram_id: int, text: str) -> dict:
+    # Webhook body of a private-chat command, as Telegram would POST it
+    update_id = next(_update_ids)
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": telegram_id, "type": "private"},
+            "from": {"id": telegram_id, "is_bot": False, "first_name": f"user{telegram_id}", "username": f"bench_{telegram_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
@@ -0,0 +1,237 @@
+"""Load test for the bot's hot paths against an in-process fake Marzban.
+
+    python -m bench.load --users 2000 --profiles 3
+    python -m bench.load --users 2000 --panels 3
+    python -m bench.load --db postgres --postgres-dsn postgresql+asyncpg://u:p@localhost/bench_db
+
+Postgres runs drop and recreate all bot tables: point them at a throwaway database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="synthetic Telegram users")
+    parser.add_argument("--profiles", type=int, default=3, help="/profile calls per user")
+    parser.add_argument("--panels", type=int, default=1, help="fake Marzban panels to shard users across")
+    parser.add_argument("--concurrency", type=int, default=64, help="max concurrent updates")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake panel latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="fake panel latency jitter, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of panel calls answered with 500")
+    parser.add_argument("--token-ttl", type=float, default=30.0, help="admin token lifetime, seconds")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--postgres-dsn", default=os.getenv("BENCH_POSTGRES_DSN", ""))
+    return parser.parse_args(argv)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_env(args: argparse.Namespace, ports: list[int]) -> None:
+    # config.py reads the environment at import time, so this must run before
+    # any bot module is imported
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["MARZBAN_API_URL"] = f"http://127.0.0.1:{ports[0]}"
+    os.environ["MARZBAN_API_KEY"] = ""
+    os.environ["MARZBAN_USERNAME"] = "bench"
+    os.environ["MARZBAN_PASSWORD"] = "bench"
+    if len(ports) > 1:
+        os.environ["MARZBAN_PANELS"] = json.dumps([
+            {"name": f"panel{i}", "url": f"http://127.0.0.1:{port}", "username": "bench", "password": "bench"}
+            for i, port in enumerate(ports)
+        ])
+    else:
+        os.environ.pop("MARZBAN_PANELS", None)
+    os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    os.environ["PROVISIONING_POLL_INTERVAL"] = "0.2"
+    if args.db == "postgres":
+        if not args.postgres_dsn:
+            sys.exit("--postgres-dsn (or BENCH_POSTGRES_DSN) is required for --db postgres")
+        os.environ["POSTGRES_DSN"] = args.postgres_dsn
+    else:
+        os.environ.pop("POSTGRES_DSN", None)
+        os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_bench_")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+@dataclass
+class PhaseResult:
+    name: str
+    count: int = 0
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    panel_requests: int = 0
+    db_queries: int = 0
+
+    def row(self) -> str:
+        rate = self.count / self.elapsed if self.elapsed else 0.0
+        per = max(self.count, 1)
+        return (
+            f"{self.name:<10} {self.count:>8} {rate:>10.1f} "
+            f"{percentile(self.latencies, 50) * 1000:>8.1f} {percentile(self.latencies, 95) * 1000:>8.1f} "
+            f"{percentile(self.latencies, 99) * 1000:>8.1f} "
+            f"{self.panel_requests / per:>9.2f} {self.db_queries / per:>8.2f}"
+        )
+
+
+HEADER = f"{'phase':<10} {'count':>8} {'per sec':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'panel/op':>9} {'db/op':>8}"
+
+
+async def run(args: argparse.Namespace, ports: list[int]) -> list[PhaseResult]:
+    from sqlalchemy import event, update
+    from bench.fake_marzban import FakeMarzban
+    from bench.fake_telegram import FakeBot, make_command
+    from bot.concurrency import PerUserUpdateProcessor
+    from bot.dispatcher import dispatcher
+    from bot.handlers.profile import profile
+    from bot.handlers.start import start
+    from bot.handlers.trial import trial
+    from bot.jobs import run_cleanup
+    from bot.marzban_api import close_clients, start_clients
+    from bot.provisioning import provisioner
+    from db.models import Base, SessionLocal, Subscription, engine
+    from init_db import init_db
+
+    panels = [
+        FakeMarzban(
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            token_ttl=args.token_ttl,
+            port=port,
+        )
+        for port in ports
+    ]
+    for panel in panels:
+        await panel.start()
+
+    def panel_requests() -> int:
+        return sum(panel.total_requests for panel in panels)
+
+    db_queries = 0
+
+    def _count_query(*_):
+        nonlocal db_queries
+        db_queries += 1
+
+    event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+
+    if args.db == "postgres":
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+    await start_clients()
+
+    bot = FakeBot()
+    processor = PerUserUpdateProcessor(args.concurrency)
+    results: list[PhaseResult] = []
+
+    async def phase(name: str, handler, commands: list[tuple[int, str]]) -> PhaseResult:
+        result = PhaseResult(name)
+        panel_before, db_before = panel_requests(), db_queries
+
+        async def one(telegram_id: int, text: str) -> None:
+            update = make_command(bot, telegram_id, text)
+            started = time.perf_counter()
+
+            async def timed():
+                await handler(update, None)
+                result.latencies.append(time.perf_counter() - started)
+
+            await processor.process_update(update, timed())
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(tg_id, text) for tg_id, text in commands))
+        result.elapsed = time.perf_counter() - started
+        result.count = len(commands)
+        result.panel_requests = panel_requests() - panel_before
+        result.db_queries = db_queries - db_before
+        results.append(result)
+        return result
+
+    user_ids = list(range(1_000_000, 1_000_000 + args.users))
+    try:
+        await phase("start", start, [(tg_id, "/start") for tg_id in user_ids])
+
+        await dispatcher.start(bot)
+        await provisioner.start()
+        await phase("trial", trial, [(tg_id, "/trial") for tg_id in user_ids])
+        # time until the outbox is drained and all trials are live in the panel
+        provisioning = PhaseResult("provision", count=args.users)
+        panel_before, db_before = panel_requests(), db_queries
+        started = time.perf_counter()
+        while await provisioner.queue_depth():
+            await asyncio.sleep(0.05)
+        provisioning.elapsed = time.perf_counter() - started
+        provisioning.latencies = list(provisioner.latencies)
+        provisioning.panel_requests = panel_requests() - panel_before
+        provisioning.db_queries = db_queries - db_before
+        results.append(provisioning)
+
+        await phase(
+            "profile",
+            profile,
+            [(tg_id, "/profile") for _ in range(args.profiles) for tg_id in user_ids],
+        )
+
+        async with SessionLocal() as session:
+            await session.execute(
+                update(Subscription).where(Subscription.status == "active").values(end_at=Subscription.start_at)
+            )
+            await session.commit()
+        cleanup = PhaseResult("cleanup")
+        panel_before, db_before = panel_requests(), db_queries
+        stats = await run_cleanup()
+        cleanup.count = stats.scanned
+        cleanup.elapsed = stats.elapsed
+        cleanup.panel_requests = panel_requests() - panel_before
+        cleanup.db_queries = db_queries - db_before
+        results.append(cleanup)
+    finally:
+        await provisioner.stop()
+        await dispatcher.stop()
+        await close_clients()
+        for panel in panels:
+            await panel.stop()
+        await engine.dispose()
+
+    print(f"db={args.db} users={args.users} panels={args.panels} concurrency={args.concurrency} panel_latency={args.latency * 1000:.0f}ms")
+    print(HEADER)
+    for result in results:
+        print(result.row())
+    for i, panel in enumerate(panels):
+        print(f"panel{i}: {len(panel.users)} users left, requests by endpoint: {dict(panel.requests)}")
+    print(
+        f"QR photos: {bot.photos.uploads} uploaded ({bot.photos.uploaded_bytes / 1024:.0f} KiB), "
+        f"{bot.photos.references} sent by file_id"
+    )
+    return results
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    ports = [_free_port() for _ in range(max(args.panels, 1))]
+    configure_env(args, ports)
+    asyncio.run(run(args, ports))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Measure how much event-loop time logging costs.
+
+    python -m bench.logs --iterations 20000
+    python -m bench.logs --sink slow-pipe
+
+Runs a handler-like workload on the event loop (three log calls per
+iteration, two of them DEBUG) under several setups:
+
+  off            logging disabled: the workload's own cost
+  sync-fstring   the old setup: root StreamHandler written from the loop,
+                 eagerly formatted f-strings
+  queue-percent  bot.logs: records queued to a writer thread, %-style args
+  ... -info      the same with DEBUG disabled (f-strings are still formatted)
+  ... -sampled   chatty logger sampled to 10% and rate-limited
+  ... -json      JSON output
+
+and reports event-loop CPU per iteration (the writer thread excluded), the
+loop's scheduling lag, and records dropped. --sink slow-pipe writes to a pipe
+drained at ~1 MB/s, like a log collector that can't keep up.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from bench.load import percentile
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000, help="workload iterations per setup")
+    parser.add_argument("--tasks", type=int, default=50, help="concurrent tasks sharing the iterations")
+    parser.add_argument("--sink", choices=("file", "slow-pipe"), default="file")
+    return parser.parse_args(argv)
+
+
+def _open_sink(kind: str):
+    if kind == "file":
+        return open(os.path.join(tempfile.mkdtemp(prefix="vpn_bot_logs_"), "bench.log"), "w")
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        with os.fdopen(read_fd, "rb") as reader:
+            while reader.read1(1024):
+                time.sleep(0.001)
+
+    threading.Thread(target=drain, daemon=True).start()
+    return os.fdopen(write_fd, "w")
+
+
+def fstring_calls(log, chatty, i: int, user: dict) -> None:
+    log.info(f"/profile by tg_id={user['telegram_id']} username={user['username']}")
+    chatty.debug(f"Fetched Marzban user info for {user['username']}: {user}")
+    log.debug(f"Cleanup batch {i}: {len(user)} rows, cursor={(user['expire'], i)}")
+
+
+def percent_calls(log, chatty, i: int, user: dict) -> None:
+    log.info("/profile by tg_id=%s username=%s", user["telegram_id"], user["username"])
+    chatty.debug("Fetched Marzban user info for %s: %s", user["username"], user)
+    log.debug("Cleanup batch %s: %s rows, cursor=%s", i, len(user), (user["expire"], i))
+
+
+async def workload(calls, iterations: int, tasks: int) -> tuple[float, float, list[float]]:
+    log = logging.getLogger("bench.handler")
+    chatty = logging.getLogger("bench.marzban")
+    user = {
+        "telegram_id": 1_000_123, "username": "tg_1000123", "status": "active",
+        "used_traffic": 123_456_789, "data_limit": 536_870_912, "expire": 1_760_000_000,
+    }
+    lags: list[float] = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    async def worker(offset: int):
+        for i in range(offset, iterations, tasks):
+            calls(log, chatty, i, user)
+            await asyncio.sleep(0)
+
+    prober = asyncio.create_task(probe())
+    cpu, wall = time.thread_time(), time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(tasks)))
+    cpu, wall = time.thread_time() - cpu, time.perf_counter() - wall
+    done.set()
+    await prober
+    return cpu, wall, lags
+
+
+def _sync_setup(stream, level: int) -> None:
+    # What the bot did before bot.logs: basicConfig, written from the loop
+    from bot.logs import stop_logging
+
+    stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+
+def run(args: argparse.Namespace) -> None:
+    from bot import logs
+    from bot.logs import setup_logging, stop_logging
+
+    def dropped() -> int:
+        return sum(logs.dropped.values())
+
+    stream = _open_sink(args.sink)
+    setups = [
+        ("off", percent_calls, lambda: logging.disable(logging.CRITICAL)),
+        ("sync-fstring", fstring_calls, lambda: _sync_setup(stream, logging.DEBUG)),
+        ("sync-fstring-info", fstring_calls, lambda: _sync_setup(stream, logging.INFO)),
+        ("queue-percent", percent_calls, lambda: setup_logging("DEBUG", "text", {}, {}, {}, stream=stream)),
+        ("queue-percent-info", percent_calls, lambda: setup_logging("INFO", "text", {}, {}, {}, stream=stream)),
+        (
+            "queue-percent-sampled",
+            percent_calls,
+            lambda: setup_logging("DEBUG", "text", {}, {"bench.marzban": 0.1}, {"bench.handler": 100}, stream=stream),
+        ),
+        ("queue-percent-json", percent_calls, lambda: setup_logging("DEBUG", "json", {}, {}, {}, stream=stream)),
+    ]
+
+    baseline = None
+    print(f"iterations={args.iterations} tasks={args.tasks} sink={args.sink}")
+    print(f"{'setup':<22} {'wall s':>7} {'loop us/it':>11} {'overhead':>9} {'lag p50 ms':>11} {'lag p99 ms':>11} {'dropped':>8} {'drain s':>8}")
+    for name, calls, configure in setups:
+        logging.disable(logging.NOTSET)
+        configure()
+        before = dropped()
+        cpu, wall, lags = asyncio.run(workload(calls, args.iterations, args.tasks))
+        drain = time.perf_counter()
+        stop_logging()
+        stream.flush()
+        drain = time.perf_counter() - drain
+        per_iteration = cpu / args.iterations * 1e6
+        if baseline is None:
+            baseline = per_iteration
+        print(
+            f"{name:<22} {wall:>7.2f} {per_iteration:>11.1f} {per_iteration - baseline:>+9.1f} "
+            f"{percentile(lags, 50) * 1000:>11.2f} {percentile(lags, 99) * 1000:>11.2f} "
+            f"{dropped() - before:>8.0f} {drain:>8.2f}"
+        )
+    logging.disable(logging.NOTSET)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("METRICS_PORT", "0")
+    if "DB_PATH" not in os.environ and "POSTGRES_DSN" not in os.environ:
+        os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_logs_")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Check that the subscription hot-path queries use their indexes at scale.
+
+    python -m bench.plans --rows 1000000
+    python -m bench.plans --db postgres --postgres-dsn postgresql+asyncpg://u:p@localhost/bench_db
+
+Fills a throwaway database with synthetic users and a long subscription
+history (mostly expired), runs the real queries built by the bot, prints their
+plans and exits non-zero if any of them does not use the expected index.
+It then runs the archiver over that history and checks that every row ended
+up in exactly one of subscriptions / subscriptions_archive.
+Postgres runs drop and recreate all bot tables: point them at a throwaway database.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="subscriptions to generate")
+    parser.add_argument("--users", type=int, default=0, help="users to generate (default rows / 5)")
+    parser.add_argument("--live-ratio", type=float, default=0.02, help="share of active/pending subscriptions")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--postgres-dsn", default=os.getenv("BENCH_POSTGRES_DSN", ""))
+    return parser.parse_args(argv)
+
+
+def configure_env(args: argparse.Namespace) -> None:
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.pop("MARZBAN_PANELS", None)
+    if args.db == "postgres":
+        if not args.postgres_dsn:
+            sys.exit("--postgres-dsn (or BENCH_POSTGRES_DSN) is required for --db postgres")
+        os.environ["POSTGRES_DSN"] = args.postgres_dsn
+    else:
+        os.environ.pop("POSTGRES_DSN", None)
+        os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_plans_")
+
+
+async def populate(engine, users: int, rows: int, live_ratio: float, chunk: int = 50_000) -> None:
+    from db.models import Subscription, User
+
+    rng = random.Random(42)
+    now = datetime.now(timezone.utc)
+    async with engine.begin() as conn:
+        for first in range(0, users, chunk):
+            await conn.execute(
+                User.__table__.insert(),
+                [
+                    {"id": i + 1, "telegram_id": 10_000_000 + i, "marzban_username": f"u{i}"}
+                    for i in range(first, min(first + chunk, users))
+                ],
+            )
+        for first in range(0, rows, chunk):
+            batch = []
+            for i in range(first, min(first + chunk, rows)):
+                live = rng.random() < live_ratio
+                start_at = now - timedelta(days=rng.uniform(0, 730))
+                batch.append({
+                    "id": i + 1,
+                    "user_id": rng.randint(1, users),
+                    "is_trial": rng.random() < 0.5,
+                    "status": rng.choice(("active", "active", "active", "pending")) if live
+                    else rng.choice(("expired", "expired", "expired", "canceled")),
+                    "start_at": start_at,
+                    # live rows straddle `now` so the expiry scan has work to do
+                    "end_at": now + timedelta(days=rng.uniform(-2, 30)) if live else start_at + timedelta(days=30),
+                })
+            await conn.execute(Subscription.__table__.insert(), batch)
+
+
+async def explain(engine, query) -> str:
+    # Run the query once to capture the exact SQL and driver parameters the
+    # bot sends, then EXPLAIN that
+    from sqlalchemy import event
+
+    captured = []
+
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    async with engine.connect() as conn:
+        event.listen(engine.sync_engine, "before_cursor_execute", _capture)
+        try:
+            await conn.execute(query)
+        finally:
+            event.remove(engine.sync_engine, "before_cursor_execute", _capture)
+        statement, parameters = captured[-1]
+        if engine.dialect.name == "postgresql":
+            result = await conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)
+            return "\n".join(row[0] for row in result)
+        result = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return "\n".join(row[-1] for row in result)
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from sqlalchemy import func, select, text
+    from bot.archive import archive_batch_query, archive_subscriptions
+    from bot.identity import live_subscription_query, user_subscription_query
+    from bot.jobs import expired_batch_query
+    from config import ARCHIVE_BATCH_SIZE, ARCHIVE_RETENTION_DAYS, CLEANUP_BATCH_SIZE, MARZBAN_DEFAULT_PANEL
+    from db.models import Base, Subscription, SubscriptionArchive, SubscriptionSummary, engine
+    from init_db import init_db
+
+    users = args.users or max(args.rows // 5, 1)
+    if args.db == "postgres":
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+
+    started = time.perf_counter()
+    await populate(engine, users, args.rows, args.live_ratio)
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE"))
+    print(f"db={args.db} users={users} subscriptions={args.rows} loaded in {time.perf_counter() - started:.1f}s")
+
+    now = datetime.now(timezone.utc)
+    checks = [
+        (
+            "cleanup first batch",
+            expired_batch_query(now, MARZBAN_DEFAULT_PANEL, None, CLEANUP_BATCH_SIZE),
+            "ix_subscriptions_status_end_at",
+        ),
+        (
+            "cleanup next batch",
+            expired_batch_query(now, MARZBAN_DEFAULT_PANEL, (now - timedelta(days=1), 1000), CLEANUP_BATCH_SIZE),
+            "ix_subscriptions_status_end_at",
+        ),
+        ("live subscription", live_subscription_query(users // 2), "ix_subscriptions_user_id_status"),
+        ("user + subscription", user_subscription_query(10_000_000 + users // 2), "ix_subscriptions_user_id_status"),
+        (
+            "archive next batch",
+            archive_batch_query(now - timedelta(days=ARCHIVE_RETENTION_DAYS), (now - timedelta(days=400), 1000), ARCHIVE_BATCH_SIZE),
+            "ix_subscriptions_finished_end_at",
+        ),
+    ]
+
+    ok = True
+    try:
+        for name, query, index in checks:
+            plan = await explain(engine, query)
+            passed = index in plan
+            ok &= passed
+            print(f"\n[{'ok' if passed else 'FAIL'}] {name}: expected {index}")
+            print("    " + plan.replace("\n", "\n    "))
+
+        # Then archive for real: every row must end up in exactly one table,
+        # and the summaries must account for every archived row
+        stats = await archive_subscriptions()
+        async with engine.connect() as conn:
+            remaining = (await conn.execute(select(func.count()).select_from(Subscription))).scalar_one()
+            archived = (await conn.execute(select(func.count()).select_from(SubscriptionArchive))).scalar_one()
+            summarized = (await conn.execute(select(func.sum(SubscriptionSummary.subscriptions)))).scalar_one() or 0
+        passed = archived == stats.archived == summarized and remaining + archived == args.rows
+        ok &= passed
+        print(
+            f"\n[{'ok' if passed else 'FAIL'}] archived {stats.archived} subscriptions older than {ARCHIVE_RETENTION_DAYS} days "
+            f"in {stats.batches} batches, {stats.elapsed:.1f}s ({stats.archived / max(stats.elapsed, 1e-9):.0f}/s); "
+            f"{remaining} left in subscriptions"
+        )
+    finally:
+        await engine.dispose()
+    return ok
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    configure_env(args)
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""Cost and correctness of the panel/DB reconciliation.
+
+    python -m bench.reconcile --users 20000 --drift 0.02
+
+Seeds a throwaway SQLite database and a fake panel with --users users that
+agree, then introduces --drift of each kind: active users missing from the
+panel, panel users whose subscription has expired (orphans), wrong expiry,
+wrong data limit, panel users unknown to the bot, and users with a pending
+subscription or a pending provisioning task (both must be left alone).
+Runs a dry run (must report the drift and queue nothing), a real run whose
+tasks the provisioning workers then drain, and a final run that must find
+nothing left but the unknown users. Between the real run and the drain an
+orphan gets a new subscription and a mismatched user is extended: the
+workers must drop both repairs. Reports timings and panel requests.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from bench.load import _free_port
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000, help="local users with an active subscription")
+    parser.add_argument("--drift", type=float, default=0.02, help="fraction of users in each drift case")
+    parser.add_argument("--page-size", type=int, default=1000, help="users per GET /api/users")
+    return parser.parse_args(argv)
+
+
+def configure_env(port: int, page_size: int) -> None:
+    # config.py reads the environment at import time
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["MARZBAN_API_URL"] = f"http://127.0.0.1:{port}"
+    os.environ["MARZBAN_API_KEY"] = ""
+    os.environ["MARZBAN_USERNAME"] = "bench"
+    os.environ["MARZBAN_PASSWORD"] = "bench"
+    os.environ.pop("MARZBAN_PANELS", None)
+    os.environ.pop("POSTGRES_DSN", None)
+    os.environ["RECONCILE_PAGE_SIZE"] = str(page_size)
+    os.environ["RECONCILE_MAX_DELETES"] = str(1 << 30)
+    os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_reconcile_")
+
+
+async def seed(panel, args: argparse.Namespace) -> dict[str, set[str]]:
+    # Returns the usernames of each drift case
+    from sqlalchemy import insert
+    from db.models import ProvisioningTask, SessionLocal, Subscription, User
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    names = [f"tg_{1_000_000 + i}" for i in range(args.users)]
+    per_case = max(1, int(args.users * args.drift))
+    shuffled = random.sample(names, len(names))
+    cases = {
+        kind: set(shuffled[i * per_case:(i + 1) * per_case])
+        for i, kind in enumerate(("missing", "orphans", "expire", "limit", "pending", "in_flight"))
+    }
+    cases["unknown"] = {f"manual_{i}" for i in range(per_case)}
+    limited = set(shuffled[6 * per_case:8 * per_case]) | cases["limit"]
+
+    end_at = {name: now + timedelta(days=random.randint(1, 30)) for name in names}
+    async with SessionLocal() as session:
+        await session.execute(
+            insert(User), [{"id": i + 1, "telegram_id": 1_000_000 + i, "marzban_username": n} for i, n in enumerate(names)]
+        )
+        subs = []
+        for i, name in enumerate(names):
+            if name in cases["orphans"]:
+                status = "expired"
+            elif name in cases["pending"]:
+                status = "pending"
+            else:
+                status = "active"
+            subs.append({"id": i + 1, "user_id": i + 1, "status": status, "end_at": end_at[name]})
+        await session.execute(insert(Subscription), subs)
+        # the data limit the bot last pushed, where it pushed one
+        tasks = [
+            {
+                "kind": "create",
+                "status": "done",
+                "marzban_username": name,
+                "subscription_id": int(name[3:]) - 1_000_000 + 1,
+                "data_limit": 10 << 30,
+                "expire_at": int(end_at[name].timestamp()),
+            }
+            for name in sorted(limited)
+        ]
+        tasks += [
+            {
+                "kind": "create",
+                "status": "pending",
+                "marzban_username": name,
+                "subscription_id": int(name[3:]) - 1_000_000 + 1,
+                "expire_at": int(end_at[name].timestamp()),
+                "run_after": now + timedelta(hours=1),
+            }
+            for name in sorted(cases["in_flight"])
+        ]
+        await session.execute(insert(ProvisioningTask), tasks)
+        await session.commit()
+
+    for name in names:
+        if name in cases["missing"] or name in cases["pending"] or name in cases["in_flight"]:
+            continue
+        expire = int(end_at[name].timestamp())
+        if name in cases["expire"]:
+            expire -= 86400
+        panel.users[name] = {
+            "username": name,
+            "status": "active",
+            "used_traffic": 0,
+            "data_limit": (5 << 30 if name in cases["limit"] else 10 << 30) if name in limited else None,
+            "expire": expire,
+        }
+    for name in cases["unknown"]:
+        panel.users[name] = {"username": name, "status": "active", "used_traffic": 0, "data_limit": None, "expire": 0}
+    return cases
+
+
+async def pending_tasks() -> int:
+    from sqlalchemy import func, select
+    from db.models import ProvisioningTask, SessionLocal
+
+    async with SessionLocal() as session:
+        return (
+            await session.execute(
+                select(func.count()).select_from(ProvisioningTask).where(ProvisioningTask.status == "pending")
+            )
+        ).scalar_one()
+
+
+async def skipped_tasks() -> int:
+    from sqlalchemy import func, select
+    from db.models import ProvisioningTask, SessionLocal
+
+    async with SessionLocal() as session:
+        return (
+            await session.execute(
+                select(func.count()).select_from(ProvisioningTask).where(ProvisioningTask.status == "skipped")
+            )
+        ).scalar_one()
+
+
+async def race_repairs(panel, cases: dict[str, set[str]]) -> tuple[str, str, int]:
+    from sqlalchemy import select, update
+    from db.models import SessionLocal, Subscription, User
+
+    renewed, extended = min(cases["orphans"]), min(cases["expire"])
+    end_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(days=60)
+    async with SessionLocal() as session:
+        user_id = await session.scalar(select(User.id).where(User.marzban_username == renewed))
+        session.add(Subscription(user_id=user_id, status="active", end_at=end_at))
+        await session.execute(
+            update(Subscription)
+            .where(Subscription.user_id == select(User.id).where(User.marzban_username == extended).scalar_subquery())
+            .values(end_at=end_at)
+        )
+        await session.commit()
+    panel.users[extended]["expire"] = panel.users[renewed]["expire"] = int(end_at.timestamp())
+    return renewed, extended, int(end_at.timestamp())
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from bench.fake_marzban import FakeMarzban
+    from bot.marzban_api import close_clients, start_clients
+    from bot.provisioning import provisioner
+    from bot.reconcile import format_report, reconcile_panels
+    from db.models import engine
+    from init_db import init_db
+
+    panel = FakeMarzban(port=int(os.environ["MARZBAN_API_URL"].rsplit(":", 1)[1]))
+    await panel.start()
+    await init_db()
+    await start_clients()
+    cases = await seed(panel, args)
+    in_flight = await pending_tasks()
+    ok = True
+    try:
+        panel.requests.clear()
+        started = time.perf_counter()
+        (dry,) = await reconcile_panels(dry_run=True)
+        dry_s = time.perf_counter() - started
+        dry_requests = panel.total_requests
+        print("dry run:", format_report(dry))
+        ok &= set(dry.missing) == cases["missing"]
+        ok &= set(dry.orphans) == cases["orphans"]
+        ok &= set(dry.mismatched) == cases["expire"] | cases["limit"]
+        ok &= set(dry.unknown) == cases["unknown"]
+        ok &= dry.queued == 0 and await pending_tasks() == in_flight
+
+        started = time.perf_counter()
+        (real,) = await reconcile_panels(rate=1e6)
+        real_s = time.perf_counter() - started
+        queued = len(cases["missing"]) + len(cases["orphans"]) + len(cases["expire"]) + len(cases["limit"])
+        ok &= real.queued == queued and await pending_tasks() == in_flight + queued
+
+        # Changes landing between the diff and the workers: an orphan starts a
+        # new subscription and a mismatched user is extended (with the panel
+        # updated by that change's own push). Both repairs must be dropped.
+        renewed, extended, new_expire = await race_repairs(panel, cases)
+
+        # the in-flight tasks are due in an hour; only the repairs drain now
+        await provisioner.start()
+        started = time.perf_counter()
+        while await pending_tasks() > in_flight:
+            await asyncio.sleep(0.05)
+        drain_s = time.perf_counter() - started
+        await provisioner.stop()
+
+        (final,) = await reconcile_panels(dry_run=True)
+        print("after repair:", format_report(final))
+        ok &= not final.missing and not final.orphans and not final.mismatched
+        ok &= set(final.unknown) == cases["unknown"]
+        ok &= renewed in panel.users and panel.users[extended]["expire"] == new_expire
+        ok &= not (cases["pending"] | cases["in_flight"] | cases["orphans"] - {renewed}) & panel.users.keys()
+        ok &= await skipped_tasks() == 2
+    finally:
+        await close_clients()
+        await panel.stop()
+        await engine.dispose()
+
+    pages = -(-dry.remote // args.page_size)
+    print(f"users={args.users} drift={args.drift:.0%} per case, {pages} listing pages")
+    print(f"dry run: {dry_s:.2f}s, {dry_requests} panel requests")
+    print(f"repair run: {real_s:.2f}s, {real.queued} tasks queued; drained by the workers in {drain_s:.2f}s")
+    print("ok" if ok else "FAILED")
+    return ok
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    configure_env(_free_port(), args.page_size)
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Ingest, rollup and query cost of the per-user usage series.
+
+    python -m bench.series --users 5000 --days 10
+    python -m bench.series --users 20000 --days 35 --interval 3600
+
+Replays --days of usage syncs into a throwaway SQLite database: every
+--interval seconds a random --active fraction of the users gets a traffic
+delta, recorded in pages of USAGE_SYNC_PAGE_SIZE as the sync does, and the
+rollup job runs at the end of each simulated day. Reports ingest cost per
+page, rollup time, the rows and bytes the series take per user, and the
+cost of the /usage query and chart for 7 and 30 days. The chart data of a
+sample of users is checked against the deltas that were fed in.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, time as dt_time, timedelta, timezone
+
+from bench.load import percentile
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=10, help="simulated days of syncs")
+    parser.add_argument("--interval", type=int, default=1800, help="seconds between simulated syncs")
+    parser.add_argument("--active", type=float, default=0.3, help="fraction of users with traffic per sync")
+    parser.add_argument("--queries", type=int, default=300, help="/usage queries per view")
+    parser.add_argument("--check", type=int, default=100, help="users whose chart data is verified")
+    return parser.parse_args(argv)
+
+
+def configure_env() -> None:
+    # config.py reads the environment at import time
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.pop("POSTGRES_DSN", None)
+    os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_series_")
+
+
+async def run(args: argparse.Namespace) -> bool:
+    from sqlalchemy import func, select
+    from bot.handlers.usage import render_chart
+    from bot.timeseries import daily_usage, record_usage, rollup_series
+    from config import DB_PATH, USAGE_SYNC_PAGE_SIZE
+    from db.models import SessionLocal, UsageSeries, engine
+    from init_db import init_db
+
+    await init_db()
+    usernames = [f"tg_{1_000_000 + i}" for i in range(args.users)]
+    checked = set(random.sample(usernames, min(args.check, args.users)))
+    expected: dict[tuple[str, object], int] = defaultdict(int)
+    today = datetime.now(timezone.utc).date()
+    first = today - timedelta(days=args.days - 1)
+
+    pages, points = 0, 0
+    page_times: list[float] = []
+    rollup_elapsed, rolled = 0.0, 0
+    started = time.perf_counter()
+    for d in range(args.days):
+        day = first + timedelta(days=d)
+        for second in range(0, 86400, args.interval):
+            at = datetime.combine(day, dt_time(), timezone.utc) + timedelta(seconds=second)
+            active = random.sample(usernames, int(args.users * args.active))
+            for offset in range(0, len(active), USAGE_SYNC_PAGE_SIZE):
+                deltas = {name: random.randint(1, 50 << 20) for name in active[offset:offset + USAGE_SYNC_PAGE_SIZE]}
+                for name in checked.intersection(deltas):
+                    expected[(name, day)] += deltas[name]
+                page_started = time.perf_counter()
+                async with SessionLocal() as session:
+                    await record_usage(session, deltas, at)
+                    await session.commit()
+                page_times.append(time.perf_counter() - page_started)
+                pages += 1
+                points += len(deltas)
+        stats = await rollup_series(today=day + timedelta(days=1) if day < today else day)
+        rollup_elapsed += stats.elapsed
+        rolled += stats.hours + stats.days
+    ingest_elapsed = time.perf_counter() - started - rollup_elapsed
+
+    ok = True
+    async with SessionLocal() as session:
+        for name in checked:
+            series = await daily_usage(session, name, min(30, args.days), today=today)
+            ok &= all(total == expected.get((name, day), 0) for day, total, _ in series)
+
+        by_resolution = {
+            resolution: (count, size)
+            for resolution, count, size in (
+                await session.execute(
+                    select(UsageSeries.resolution, func.count(), func.sum(func.length(UsageSeries.points)))
+                    .group_by(UsageSeries.resolution)
+                )
+            ).all()
+        }
+
+        query_times: dict[int, list[float]] = {7: [], 30: []}
+        for days in (7, 30):
+            for name in random.sample(usernames, min(args.queries, args.users)):
+                query_started = time.perf_counter()
+                render_chart(await daily_usage(session, name, days, today=today))
+                query_times[days].append(time.perf_counter() - query_started)
+    await engine.dispose()
+
+    db_size = os.path.getsize(os.path.join(DB_PATH, "bot.db"))
+    rows = sum(count for count, _ in by_resolution.values())
+    blob_bytes = sum(size or 0 for _, size in by_resolution.values())
+    print(f"users={args.users} days={args.days} interval={args.interval}s active={args.active:.0%}")
+    print(
+        f"ingest: {points} points in {pages} pages, {ingest_elapsed:.1f}s "
+        f"({points / ingest_elapsed:,.0f} points/s), page p50 {percentile(page_times, 50) * 1000:.1f}ms "
+        f"p95 {percentile(page_times, 95) * 1000:.1f}ms"
+    )
+    print(f"rollup: {rolled} rows folded in {rollup_elapsed:.1f}s over {args.days} runs")
+    for resolution, (count, size) in sorted(by_resolution.items()):
+        print(f"  {resolution:<7} {count:>8} rows {size / 1024:>10.0f} KiB")
+    print(
+        f"storage: {rows / args.users:.1f} rows and {blob_bytes / args.users:.0f} B of points per user, "
+        f"db file {db_size / args.users:.0f} B per user ({blob_bytes / max(points, 1):.2f} B per ingested point)"
+    )
+    for days, times in query_times.items():
+        print(
+            f"/usage {days:>2}d: p50 {percentile(times, 50) * 1000:.2f}ms p95 {percentile(times, 95) * 1000:.2f}ms"
+        )
+    print("ok" if ok else "FAILED")
+    return ok
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    configure_env()
+    if not asyncio.run(run(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Post synthetic Telegram updates to the bot's webhook server.
+
+    python -m bench.webhook --users 500 --profiles 3
+    python -m bench.webhook --users 500 --max-inflight 16
+    python -m bench.webhook --users 100 --flood 200
+
+Runs the real application (handlers, update processor, post_init/shutdown)
+in webhook mode against an in-process fake Marzban and a bot that records
+replies instead of calling the Bot API. Reports how fast updates are
+acknowledged, how many were turned away with 503 when more than
+--max-inflight were unfinished (they are redelivered, as Telegram would),
+and how long it took until every update had been answered. --flood sends
+that many /profile updates from one extra user as fast as they are acked,
+which the per-user throttle should cut down to its burst plus one warning.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from bench.load import percentile
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="synthetic Telegram users")
+    parser.add_argument("--profiles", type=int, default=3, help="/profile updates per user after /start")
+    parser.add_argument("--connections", type=int, default=40, help="parallel webhook connections (Telegram uses up to 100)")
+    parser.add_argument("--max-inflight", type=int, default=0, help="WEBHOOK_MAX_INFLIGHT (default from config)")
+    parser.add_argument("--concurrency", type=int, default=64, help="max concurrent updates")
+    parser.add_argument("--flood", type=int, default=0, help="/profile updates sent back to back by one extra user")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake panel latency, seconds")
+    return parser.parse_args(argv)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_env(args: argparse.Namespace, webhook_port: int, panel_port: int) -> None:
+    # config.py reads the environment at import time
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["WEBHOOK_URL"] = ""
+    os.environ["WEBHOOK_LISTEN"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(webhook_port)
+    os.environ["WEBHOOK_SECRET"] = "bench-secret"
+    if args.max_inflight:
+        os.environ["WEBHOOK_MAX_INFLIGHT"] = str(args.max_inflight)
+    os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["MARZBAN_API_URL"] = f"http://127.0.0.1:{panel_port}"
+    os.environ["MARZBAN_USERNAME"] = "bench"
+    os.environ["MARZBAN_PASSWORD"] = "bench"
+    os.environ.pop("MARZBAN_PANELS", None)
+    os.environ.pop("POSTGRES_DSN", None)
+    os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="vpn_bot_webhook_")
+
+
+async def run(args: argparse.Namespace, webhook_port: int, panel_port: int) -> bool:
+    import aiohttp
+    from bench.fake_marzban import FakeMarzban
+    from bench.fake_telegram import OfflineBot, command_payload
+    from bot.webhook import SECRET_HEADER, serve_webhook, webhook_server
+    from bot.throttle import THROTTLED_UPDATES
+    from config import THROTTLE_BURST, WEBHOOK_MAX_INFLIGHT, WEBHOOK_PATH, WEBHOOK_SECRET
+    from main import build_application
+
+    panel = FakeMarzban(latency=args.latency, port=panel_port)
+    await panel.start()
+    bot = OfflineBot()
+    application = build_application(bot=bot)
+    stop, ready = asyncio.Event(), asyncio.Event()
+    server = asyncio.create_task(serve_webhook(application, stop, ready))
+    await ready.wait()
+
+    url = f"http://127.0.0.1:{webhook_port}{WEBHOOK_PATH}"
+    headers = {SECRET_HEADER: WEBHOOK_SECRET}
+    ack_latencies: list[float] = []
+    busy = 0
+    ok = True
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as http:
+            async with http.post(url, json=command_payload(1, "/start"), headers={SECRET_HEADER: "wrong"}) as resp:
+                print(f"wrong secret -> {resp.status}")
+                ok &= resp.status == 403
+            async with http.post(url, data=b"not json", headers=headers) as resp:
+                print(f"malformed body -> {resp.status}")
+                ok &= resp.status == 400
+
+            async def deliver(payload: dict) -> None:
+                # Like Telegram: redeliver until acknowledged
+                nonlocal busy
+                while True:
+                    started = time.perf_counter()
+                    async with http.post(url, json=payload, headers=headers) as resp:
+                        await resp.read()
+                        if resp.status == 200:
+                            ack_latencies.append(time.perf_counter() - started)
+                            return
+                        if resp.status != 503:
+                            raise RuntimeError(f"webhook answered {resp.status}")
+                    busy += 1
+                    await asyncio.sleep(0.05)
+
+            async def user_session(telegram_id: int) -> None:
+                # One chat's updates are delivered in order, each after the previous ack
+                await deliver(command_payload(telegram_id, "/start"))
+                for _ in range(args.profiles):
+                    await deliver(command_payload(telegram_id, "/profile"))
+
+            async def flood(telegram_id: int) -> None:
+                await deliver(command_payload(telegram_id, "/start"))
+                await asyncio.gather(*(deliver(command_payload(telegram_id, "/profile")) for _ in range(args.flood)))
+
+            total = args.users * (1 + args.profiles)
+            flooder = 1_999_999
+            started = time.perf_counter()
+            sessions = [user_session(tg_id) for tg_id in range(2_000_000, 2_000_000 + args.users)]
+            if args.flood:
+                sessions.append(flood(flooder))
+            await asyncio.gather(*sessions)
+            acked = time.perf_counter() - started
+            while sum(1 for chat_id, _ in bot.sent if chat_id != flooder) < total and time.perf_counter() - started < 120:
+                await asyncio.sleep(0.01)
+            handled = time.perf_counter() - started
+    finally:
+        stop.set()
+        await server
+        await panel.stop()
+
+    print(f"users={args.users} updates={total} connections={args.connections} max_inflight={WEBHOOK_MAX_INFLIGHT}")
+    print(
+        f"acked    {len(ack_latencies):>7} in {acked:6.2f}s ({len(ack_latencies) / acked:8.1f}/s)  "
+        f"ack p50 {percentile(ack_latencies, 50) * 1000:.2f}ms p95 {percentile(ack_latencies, 95) * 1000:.2f}ms "
+        f"p99 {percentile(ack_latencies, 99) * 1000:.2f}ms"
+    )
+    print(f"answered {len(bot.sent):>7} in {handled:6.2f}s ({len(bot.sent) / handled:8.1f}/s)  503 busy: {busy}")
+    print(f"in flight after shutdown: {webhook_server.inflight}")
+    answered = len(bot.sent)
+    if args.flood:
+        flood_replies = sum(1 for chat_id, _ in bot.sent if chat_id == flooder)
+        answered -= flood_replies
+        throttled = {action: THROTTLED_UPDATES.value(action=action) for action in ("notified", "dropped")}
+        print(f"flood: {1 + args.flood} updates from one user -> {flood_replies} replies, throttled {throttled}")
+        # /start plus the burst (and whatever refilled meanwhile), one warning
+        ok &= throttled["notified"] == 1 and flood_replies < 1 + THROTTLE_BURST + handled + 1
+    return ok and answered == total
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    webhook_port, panel_port = _free_port(), _free_port()
+    configure_env(args, webhook_port, panel_port)
+    if not asyncio.run(run(args, webhook_port, panel_port)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import delete, literal, or_, and_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from db.models import (
+    ProvisioningTask,
+    SessionLocal,
+    Subscription,
+    SubscriptionArchive,
+    SubscriptionSummary,
+    engine,
+    subscription_is_finished,
+)
+from config import (
+    ARCHIVE_RETENTION_DAYS,
+    ARCHIVE_BATCH_SIZE,
+    ARCHIVE_BATCH_PAUSE,
+    ARCHIVE_PARTITIONED,
+)
+
+logger = logging.getLogger(__name__)
+
+_ARCHIVED_COLUMNS = ("id", "user_id", "is_trial", "status", "start_at", "end_at", "reminded_at")
+
+# Monthly archive partitions known to exist (Postgres with ARCHIVE_PARTITIONED)
+_partitions: set[tuple[int, int]] = set()
+
+
+@dataclass
+class ArchiveStats:
+    archived: int = 0
+    summaries: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+
+
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _insert(model):
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def _month_bounds(year: int, month: int) -> tuple[datetime, datetime]:
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+async def _ensure_partitions(session, end_ats: list[datetime]) -> set[tuple[int, int]]:
+    # Creates missing monthly partitions in the caller's transaction; the
+    # caller records them in _partitions once it has committed
+    if not ARCHIVE_PARTITIONED or engine.dialect.name != "postgresql":
+        return set()
+    created = {(end_at.year, end_at.month) for end_at in end_ats} - _partitions
+    for year, month in sorted(created):
+        start, end = _month_bounds(year, month)
+        table = SubscriptionArchive.__tablename__
+        await session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table}_{year:04d}_{month:02d} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+    return created
+
+
+def _summary_rows(rows, existing: dict[int, SubscriptionSummary], now: datetime) -> list[dict]:
+    summaries: dict[int, dict] = {}
+    for row in rows:
+        start_at, end_at = _utc(row.start_at), _utc(row.end_at)
+        summary = summaries.get(row.user_id)
+        if summary is None:
+            current = existing.get(row.user_id)
+            summary = summaries[row.user_id] = {
+                "user_id": row.user_id,
+                "subscriptions": current.subscriptions if current else 0,
+                "trials": current.trials if current else 0,
+                "days": current.days if current else 0,
+                "first_start_at": _utc(current.first_start_at) if current and current.first_start_at else None,
+                "last_end_at": _utc(current.last_end_at) if current and current.last_end_at else None,
+                "updated_at": now,
+            }
+        summary["subscriptions"] += 1
+        summary["trials"] += int(row.is_trial)
+        summary["days"] += max(0, round((end_at - start_at).total_seconds() / 86400))
+        if summary["first_start_at"] is None or start_at < summary["first_start_at"]:
+            summary["first_start_at"] = start_at
+        if summary["last_end_at"] is None or end_at > summary["last_end_at"]:
+            summary["last_end_at"] = end_at
+    return list(summaries.values())
+
+
+def _copy_to_archive(ids: list[int], archived_at: datetime):
+    # INSERT ... SELECT: the rows are copied inside the database, and the
+    # statement compiles once whatever the batch size
+    columns = [getattr(Subscription, name) for name in _ARCHIVED_COLUMNS]
+    return (
+        _insert(SubscriptionArchive)
+        .from_select(
+            [*_ARCHIVED_COLUMNS, "archived_at"],
+            select(*columns, literal(archived_at, SubscriptionArchive.archived_at.type)).where(Subscription.id.in_(ids)),
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def _upsert_summaries():
+    # Executed with a list of rows (executemany), values already merged
+    stmt = _insert(SubscriptionSummary)
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[SubscriptionSummary.user_id],
+        set_={
+            column.name: getattr(excluded, column.name)
+            for column in SubscriptionSummary.__table__.columns
+            if column.name != "user_id"
+        },
+    )
+
+
+def archive_batch_query(cutoff: datetime, cursor: Optional[tuple[datetime, int]], batch_size: int):
+    query = select(*(getattr(Subscription, name) for name in _ARCHIVED_COLUMNS)).where(
+        subscription_is_finished(), Subscription.end_at < cutoff
+    )
+    if cursor is not None:
+        last_end_at, last_id = cursor
+        query = query.where(
+            or_(
+                Subscription.end_at > last_end_at,
+                and_(Subscription.end_at == last_end_at, Subscription.id > last_id),
+            )
+        )
+    return (
+        query.order_by(Subscription.end_at, Subscription.id)
+        .limit(batch_size)
+        .with_for_update(of=Subscription, skip_locked=True)
+    )
+
+
+async def archive_batch(
+    cutoff: datetime, cursor: Optional[tuple[datetime, int]], batch_size: int
+) -> tuple[int, int, Optional[tuple[datetime, int]]]:
+    # Moves one batch of finished subscriptions that ended before `cutoff`
+    # to the archive and folds them into the per-user summaries, all in one
+    # short transaction. Returns (archived, summaries updated, next cursor).
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        rows = (await session.execute(archive_batch_query(cutoff, cursor, batch_size))).all()
+        if not rows:
+            return 0, 0, None
+
+        partitions = await _ensure_partitions(session, [_utc(row.end_at) for row in rows])
+        ids = [row.id for row in rows]
+        await session.execute(_copy_to_archive(ids, now))
+        user_ids = list({row.user_id for row in rows})
+        existing = {
+            summary.user_id: summary
+            for summary in await session.scalars(
+                select(SubscriptionSummary).where(SubscriptionSummary.user_id.in_(user_ids))
+            )
+        }
+        await session.execute(_upsert_summaries(), _summary_rows(rows, existing, now))
+        # Databases created before the foreign key became SET NULL still
+        # cascade, which would take the subscriptions' provisioning history
+        # with them
+        await session.execute(
+            update(ProvisioningTask).where(ProvisioningTask.subscription_id.in_(ids)).values(subscription_id=None)
+        )
+        await session.execute(delete(Subscription).where(Subscription.id.in_(ids)))
+        await session.commit()
+    _partitions.update(partitions)
+    last = rows[-1]
+    return len(rows), len(user_ids), (last.end_at, last.id)
+
+
+async def archive_subscriptions(
+    retention_days: int = ARCHIVE_RETENTION_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE
+) -> ArchiveStats:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    started = time.monotonic()
+    stats = ArchiveStats()
+    cursor = None
+    while True:
+        archived, summaries, cursor = await archive_batch(cutoff, cursor, batch_size)
+        if not archived:
+            break
+        stats.archived += archived
+        stats.summaries += summaries
+        stats.batches += 1
+        if archived < batch_size:
+            break
+        # let the bot's own writes in between batches
+        await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def archive_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await archive_subscriptions()
+    if stats.archived:
+        logger.info(
+            "Archived %s subscriptions in %s batches (%s user summary updates, %.1fs)",
+            stats.archived, stats.batches, stats.summaries, stats.elapsed,
+        )
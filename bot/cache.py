@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from bot.metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Named caches, reported by the metrics below
+_caches: "weakref.WeakValueDictionary[str, AsyncTTLCache]" = weakref.WeakValueDictionary()
+
+
+def _request_counts() -> dict:
+    counts = {}
+    for name, cache in _caches.items():
+        counts[(name, "hit")] = cache.hits
+        counts[(name, "stale")] = cache.stale_hits
+        counts[(name, "miss")] = cache.misses
+    return counts
+
+
+CACHE_REQUESTS = Counter(
+    "vpn_bot_cache_requests_total", "In-process cache lookups by result", ("cache", "result"),
+    callback=_request_counts,
+)
+CACHE_ENTRIES = Gauge(
+    "vpn_bot_cache_entries", "Entries held by in-process caches", ("cache",),
+    callback=lambda: {(name,): len(cache) for name, cache in _caches.items()},
+)
+
+
+class AsyncTTLCache:
+    # Bounded LRU cache in front of an async loader.
+    # - fresh entries (age < ttl) are served directly;
+    # - stale entries (age < ttl + stale_ttl) are served immediately while one
+    #   background refresh runs;
+    # - concurrent misses for the same key share a single loader call.
+    # Loader results of None are never cached, so failures fall through.
+    def __init__(
+        self,
+        loader: Callable[[Any], Awaitable[Any]],
+        ttl: float,
+        stale_ttl: float = 0.0,
+        maxsize: int = 1024,
+        name: Optional[str] = None,
+    ):
+        self._loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, tuple[Any, float]]" = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        if name is not None:
+            _caches[name] = self
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                self._load(key)
+                return value
+        self.misses += 1
+        return await asyncio.shield(self._load(key))
+
+    def get_nowait(self, key: Hashable) -> Optional[Any]:
+        # Like get(), but a miss returns None instead of awaiting the loader,
+        # for callers that can fetch the value more cheaply themselves
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                self._load(key)
+                return value
+        self.misses += 1
+        return None
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        # Last known value regardless of age, without touching the loader
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        # Seed an entry the caller already has (e.g. a row it just inserted)
+        self._inflight.pop(key, None)
+        self._store(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        # An in-flight load started before the invalidation must not repopulate
+        self._inflight.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._inflight.clear()
+
+    def _load(self, key: Hashable) -> asyncio.Future:
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._fetch(key))
+            self._inflight[key] = fut
+        return fut
+
+    async def _fetch(self, key: Hashable) -> Any:
+        fut = asyncio.current_task()
+        try:
+            value = await self._loader(key)
+        except Exception:
+            logger.exception("Cache loader failed for %r", key)
+            value = None
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+            else:
+                fut = None
+        if value is not None and fut is not None:
+            self._store(key, value)
+        return value
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
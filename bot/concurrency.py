@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from bot.throttle import UpdateThrottle
+
+logger = logging.getLogger(__name__)
+
+
+class _UserSlot:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates concurrently (up to max_concurrent_updates overall) but
+    # runs updates from the same Telegram user strictly one after another, so
+    # e.g. a double-tapped /trial sees the first one's subscription. Per-user
+    # locks only live while that user has updates in flight. With a throttle,
+    # a user's updates over the flood limit are dropped before they queue.
+    __slots__ = ("_slots", "_throttle")
+
+    def __init__(self, max_concurrent_updates: int, throttle: Optional[UpdateThrottle] = None):
+        super().__init__(max_concurrent_updates)
+        self._slots: dict[int, _UserSlot] = {}
+        self._throttle = throttle
+
+    @property
+    def active_users(self) -> int:
+        return len(self._slots)
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[int]:
+        if isinstance(update, Update) and update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        # Replaces the base class's version, which takes the global semaphore
+        # before do_process_update: updates queued behind the same user's
+        # running one would each hold a slot while waiting on its lock, and a
+        # single flooding user could stall everyone. Here the user's lock comes
+        # first, so only the update that actually runs holds a slot, and the
+        # throttle before both, so a flood never queues on the user's lock.
+        key = self._user_key(update)
+        if key is not None and self._throttle is not None and not self._throttle.admit(update):
+            if asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            return
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _UserSlot()
+        slot.refs += 1
+        try:
+            async with slot.lock:
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            slot.refs -= 1
+            if slot.refs == 0:
+                del self._slots[key]
+
+    async def do_process_update(self, update: object, coroutine: "Awaitable[Any]") -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._slots.clear()
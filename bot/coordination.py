@@ -0,0 +1,100 @@
+import asyncio
+import functools
+import logging
+from typing import Awaitable, Callable, Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from db.models import engine
+from config import MULTI_INSTANCE, LEADER_LOCK_KEY, LEADER_ELECTION_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    # Postgres session-level advisory lock held on a dedicated connection: the
+    # replica holding it runs the periodic jobs. If that connection dies the
+    # server releases the lock and another replica takes over on its next try.
+    # On SQLite (or with MULTI_INSTANCE off) this instance is always the leader.
+    def __init__(self, engine: AsyncEngine, lock_key: int = LEADER_LOCK_KEY, interval: float = LEADER_ELECTION_INTERVAL):
+        self._engine = engine
+        self.lock_key = lock_key
+        self.interval = interval
+        self.enabled = MULTI_INSTANCE and engine.dialect.name == "postgresql"
+        self.is_leader = not self.enabled
+        self._conn: Optional[AsyncConnection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        await self._elect()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            if self.is_leader:
+                try:
+                    await self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.lock_key})
+                except Exception:
+                    logger.exception("Failed to release leader lock")
+            await self._close_conn()
+        self.is_leader = not self.enabled
+
+    async def _close_conn(self) -> None:
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def _elect(self) -> None:
+        try:
+            if self._conn is None:
+                conn = await self._engine.connect()
+                self._conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            if self.is_leader:
+                # Still holding the lock as long as our connection is alive
+                await self._conn.execute(text("SELECT 1"))
+                return
+            acquired = (
+                await self._conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.lock_key})
+            ).scalar()
+            if acquired:
+                self.is_leader = True
+                logger.info("This instance is now the leader (lock %s)", self.lock_key)
+        except Exception:
+            if self.is_leader:
+                logger.warning("Lost leader lock connection, stepping down")
+            else:
+                logger.exception("Leader election attempt failed")
+            self.is_leader = False
+            await self._close_conn()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._elect()
+
+
+leader = LeaderElection(engine)
+
+
+def leader_only(job: Callable[[ContextTypes.DEFAULT_TYPE], Awaitable[None]]):
+    # Job queue callback wrapper: only the elected replica runs periodic jobs
+    @functools.wraps(job)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not leader.is_leader:
+            logger.debug("Skipping %s: not the leader", job.__name__)
+            return
+        await job(context)
+
+    return wrapper
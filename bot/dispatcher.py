@@ -0,0 +1,233 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Optional
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from bot.metrics import Counter, Gauge
+from bot.ratelimit import TokenBucket
+from bot.resilience import backoff_delay
+from config import (
+    DISPATCH_GLOBAL_RATE,
+    DISPATCH_CHAT_RATE,
+    DISPATCH_CONCURRENCY,
+    DISPATCH_MAX_QUEUE,
+    DISPATCH_MAX_ATTEMPTS,
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0  # replies to something the user just did
+PRIORITY_NORMAL = 1  # reminders
+PRIORITY_LOW = 2  # broadcasts
+
+DISPATCH_MESSAGES = Counter(
+    "vpn_bot_dispatch_messages_total", "Outbound messages by outcome", ("result",)
+)
+DISPATCH_RETRY_AFTER = Counter(
+    "vpn_bot_dispatch_retry_after_total", "429 RetryAfter responses from the Bot API"
+)
+
+# A chat's bucket is dropped once it has been idle long enough to be full again
+_CHAT_SWEEP_INTERVAL = 60.0
+
+
+class OutboundMessage:
+    __slots__ = ("chat_id", "text", "kwargs", "priority", "seq", "attempts", "future")
+
+    def __init__(self, chat_id: int, text: str, kwargs: dict, priority: int, seq: int):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "OutboundMessage") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def resolve(self, delivered: bool) -> None:
+        if not self.future.done():
+            self.future.set_result(delivered)
+
+
+class MessageDispatcher:
+    # Sends bot messages in priority order (FIFO within a priority) under a
+    # global and a per-chat token bucket, up to `concurrency` sends at a time.
+    # A 429 pauses all sending for its retry_after and requeues the message in
+    # its original place; network errors are retried with backoff. Each
+    # message carries a future resolving to whether it was delivered.
+    def __init__(
+        self,
+        global_rate: float = DISPATCH_GLOBAL_RATE,
+        chat_rate: float = DISPATCH_CHAT_RATE,
+        concurrency: int = DISPATCH_CONCURRENCY,
+        max_queue: int = DISPATCH_MAX_QUEUE,
+        max_attempts: int = DISPATCH_MAX_ATTEMPTS,
+    ):
+        self.chat_rate = chat_rate
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        # no burst: the Bot API counts messages over short windows, so they
+        # are spread evenly at `global_rate`
+        self._global = TokenBucket(global_rate, capacity=1.0)
+        self._chats: dict[int, TokenBucket] = {}
+        self._ready: list[OutboundMessage] = []
+        # (not before, message): waiting for its chat's bucket or a retry backoff
+        self._delayed: list[tuple[float, OutboundMessage]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sends: set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._ready) + len(self._delayed)
+
+    async def start(self, bot: Bot) -> None:
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._sends:
+            await asyncio.wait(set(self._sends), timeout=drain_timeout)
+        dropped = len(self)
+        for message in self._ready + [m for _, m in self._delayed]:
+            message.resolve(False)
+        self._ready.clear()
+        self._delayed.clear()
+        if dropped:
+            logger.warning("Dispatcher stopped with %s undelivered messages", dropped)
+
+    def submit(self, chat_id: int, text: str, priority: int = PRIORITY_HIGH, **kwargs: Any) -> asyncio.Future:
+        # Never blocks: for the few messages sent in reply to user actions
+        message = OutboundMessage(chat_id, text, kwargs, priority, next(self._seq))
+        heapq.heappush(self._ready, message)
+        self._wakeup.set()
+        if len(self) >= self.max_queue:
+            self._space.clear()
+        return message.future
+
+    async def put(self, chat_id: int, text: str, priority: int = PRIORITY_LOW, **kwargs: Any) -> asyncio.Future:
+        # For bulk senders: waits while the queue is full, so a producer
+        # streaming users from the DB is held to the sending rate
+        while len(self) >= self.max_queue:
+            self._space.clear()
+            await self._space.wait()
+        return self.submit(chat_id, text, priority, **kwargs)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, capacity=1.0)
+        return bucket
+
+    def _sweep_chats(self, now: float) -> None:
+        if now - self._last_sweep < _CHAT_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for chat_id in [c for c, bucket in self._chats.items() if bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+    async def _sleep(self, timeout: Optional[float]) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._delayed)[1])
+            if not self._ready:
+                await self._sleep(self._delayed[0][0] - now if self._delayed else None)
+                continue
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            message = heapq.heappop(self._ready)
+            chat_wait = self._chat_bucket(message.chat_id).consume(now)
+            if chat_wait > 0:
+                # Other chats go ahead; this one waits for its own bucket
+                heapq.heappush(self._delayed, (now + chat_wait, message))
+                continue
+            self._global.consume(now)
+            self._sweep_chats(now)
+
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(message))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+            if len(self) < self.max_queue:
+                self._space.set()
+
+    async def _send(self, message: OutboundMessage) -> None:
+        message.attempts += 1
+        try:
+            await self._bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+        except RetryAfter as exc:
+            delay = exc.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            DISPATCH_RETRY_AFTER.inc()
+            logger.warning("Bot API flood limit hit, pausing outbound messages for %ss", delay)
+            self._paused_until = max(self._paused_until, time.monotonic() + float(delay))
+            # a 429 is not the message's fault: keep its place and attempts
+            message.attempts -= 1
+            heapq.heappush(self._ready, message)
+            self._wakeup.set()
+        except Forbidden:
+            # the user blocked the bot or deleted their account
+            DISPATCH_MESSAGES.inc(result="forbidden")
+            message.resolve(False)
+        except BadRequest as exc:
+            DISPATCH_MESSAGES.inc(result="failed")
+            logger.warning("Message to chat %s rejected: %s", message.chat_id, exc)
+            message.resolve(False)
+        except NetworkError as exc:
+            if message.attempts >= self.max_attempts:
+                DISPATCH_MESSAGES.inc(result="failed")
+                logger.error(
+                    "Giving up on message to chat %s after %s attempts: %s", message.chat_id, message.attempts, exc
+                )
+                message.resolve(False)
+            else:
+                retry_at = time.monotonic() + backoff_delay(message.attempts, 1.0, cap=30.0)
+                heapq.heappush(self._delayed, (retry_at, message))
+                self._wakeup.set()
+        except Exception:
+            DISPATCH_MESSAGES.inc(result="failed")
+            logger.exception("Failed to send message to chat %s", message.chat_id)
+            message.resolve(False)
+        else:
+            DISPATCH_MESSAGES.inc(result="sent")
+            message.resolve(True)
+        finally:
+            self._slots.release()
+
+
+dispatcher = MessageDispatcher()
+DISPATCH_QUEUE_DEPTH = Gauge(
+    "vpn_bot_dispatch_queue_depth", "Outbound messages waiting to be sent", callback=lambda: len(dispatcher)
+)
@@ -0,0 +1,38 @@
+import logging
+from telegram import Update
+from telegram.ext import ContextTypes
+from bot.dispatcher import PRIORITY_HIGH, dispatcher
+from bot.notifications import broadcast as broadcast_all
+from config import ADMIN_IDS
+logger = logging.getLogger(__name__)
+
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_id = update.effective_user.id
+    if tg_id not in ADMIN_IDS:
+        return
+
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await update.message.reply_text("Использование: /broadcast <текст>")
+        return
+    text = parts[1].strip()
+
+    async def _run():
+        try:
+            stats = await broadcast_all(text)
+        except Exception:
+            logger.exception("Broadcast failed")
+            dispatcher.submit(tg_id, "Рассылка прервана из-за ошибки, подробности в логах.", PRIORITY_HIGH)
+            return
+        logger.info("Broadcast by %s: %s sent, %s failed in %.0fs", tg_id, stats.sent, stats.failed, stats.elapsed)
+        dispatcher.submit(
+            tg_id,
+            f"Рассылка завершена: доставлено {stats.sent}, не доставлено {stats.failed} ({stats.elapsed:.0f} с).",
+            PRIORITY_HIGH,
+        )
+
+    # Runs at the dispatcher's pace (minutes for a large user base), so it
+    # must not hold this update's slot in the update processor
+    context.application.create_task(_run())
+    await update.message.reply_text("Рассылка запущена, пришлю итог по завершении.")
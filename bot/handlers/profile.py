@@ -1,31 +1,77 @@
 import logging
-from telegram import Update
+from datetime import datetime, timezone
+from typing import Optional
+from telegram import Message, Update
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
-from sqlalchemy import select
-from db.models import SessionLocal, User, Subscription
-from bot.marzban_api import get_user_info
+from db.models import SessionLocal, SubscriptionQr
+from bot.identity import get_user_and_subscription
+from bot.marzban_api import MarzbanUser, get_user_info_cached, panel_available
+from bot.qr import QR_SENDS, qr_cache
+from bot.usage import get_snapshot
 
 logger = logging.getLogger(__name__)
 
+
+async def send_subscription_qr(
+    message: Message, session, marzban_username: str, url: str, stored: Optional[SubscriptionQr]
+) -> None:
+    # The image is uploaded once; after that Telegram's file_id for it is sent
+    # instead, which costs neither rendering nor upload
+    caption = f"🔗 Ссылка для подключения:\n`{url}`"
+    if stored is not None and stored.subscription_url == url:
+        try:
+            await message.reply_photo(stored.file_id, caption=caption, parse_mode="Markdown")
+            QR_SENDS.inc(source="file_id")
+            return
+        except BadRequest:
+            logger.warning("Stored QR file_id for %s was rejected, uploading again", marzban_username)
+
+    png = await qr_cache.get(url)
+    sent = await message.reply_photo(png, caption=caption, parse_mode="Markdown")
+    QR_SENDS.inc(source="upload")
+    if sent is None or not sent.photo:
+        return
+    await session.merge(
+        SubscriptionQr(
+            marzban_username=marzban_username,
+            subscription_url=url,
+            file_id=sent.photo[-1].file_id,
+            updated_at=datetime.now(timezone.utc),
+        )
+    )
+    await session.commit()
+
+
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_id = update.effective_user.id
 
     async with SessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == tg_id))
-        user = result.scalars().first()
+        user, sub = await get_user_and_subscription(session, tg_id)
         if user is None:
             await update.message.reply_text("Ты не зарегистрирован. Напиши /start.")
             return
 
-        marzban_info = await get_user_info(user.marzban_username)
-        if not marzban_info:
-            logger.info("No Marzban info found for user, likely no active access")
-            await update.message.reply_text("В Marzban нет активного доступа. Оформи /trial или оплату.")
-            return
+        # Prefer the locally synced snapshot; ask the panel only if it's missing or stale
+        snapshot = await get_snapshot(session, user.marzban_username, user.panel)
+        marzban_info: Optional[MarzbanUser] = None
+        if snapshot is not None:
+            usage = snapshot.used_traffic
+            limit = snapshot.data_limit
+            expire = snapshot.expire
+        else:
+            marzban_info = await get_user_info_cached(user.marzban_username, panel=user.panel)
+            if not marzban_info and not panel_available(user.panel):
+                await update.message.reply_text("Сервер временно недоступен, попробуй чуть позже.")
+                return
+            if not marzban_info:
+                logger.info("No Marzban info found for user, likely no active access")
+                await update.message.reply_text("В Marzban нет активного доступа. Оформи /trial или оплату.")
+                return
 
-        usage = marzban_info.get('used_traffic', 0)
-        limit = marzban_info.get('data_limit', None)
-        expire = marzban_info.get('expire', None)
+            usage = marzban_info.used_traffic
+            limit = marzban_info.data_limit
+            expire = marzban_info.expire
 
         def fmt_bytes(value):
             try:
@@ -34,12 +80,6 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 return str(value)
 
-        # subscription info
-        sub_result = await session.execute(
-            select(Subscription).where(Subscription.user_id == user.id, Subscription.status == "active")
-        )
-        sub = sub_result.scalars().first()
-
         text_lines = ["👤 *Профиль*", f"Marzban: `{user.marzban_username}`"]
         if expire is not None:
             text_lines.append(f"📅 Истекает: `{expire}`")
@@ -48,7 +88,23 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text_lines.append(f"🔒 Лимит: `{fmt_bytes(limit)}`")
         if sub is not None:
             text_lines.append(f"📌 Подписка: `{'trial' if sub.is_trial else 'paid'}` до `{sub.end_at}`")
+            if sub.status == "pending":
+                text_lines.append("⏳ Доступ оформляется")
 
         text = "\n".join(text_lines)
 
         await update.message.reply_text(text, parse_mode="Markdown")
+
+        if sub is None or sub.status != "active":
+            return
+        # The link comes from the stored QR row if there is one (dropped on
+        # re-provisioning), otherwise from the panel
+        stored = await session.get(SubscriptionQr, user.marzban_username)
+        if marzban_info is None and stored is None:
+            marzban_info = await get_user_info_cached(user.marzban_username, panel=user.panel)
+        if marzban_info is not None:
+            url = marzban_info.subscription_url
+        else:
+            url = stored.subscription_url if stored is not None else None
+        if url:
+            await send_subscription_qr(update.message, session, user.marzban_username, url, stored)
@@ -1,31 +1,38 @@
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy import select
+from sqlalchemy import update as sa_update
 from db.models import SessionLocal, User
+from bot.identity import UserRecord, get_user_record, identity_cache
+from bot.placement import placement
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_id = update.effective_user.id
     username = update.effective_user.username
-    logging.getLogger(__name__).info(f"/start by tg_id={tg_id} username={username}")
+    logging.getLogger(__name__).info("/start by tg_id=%s username=%s", tg_id, username)
 
-    async with SessionLocal() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == tg_id)
-        )
-        user = result.scalars().first()
-        if user is None:
+    record = await get_user_record(tg_id)
+    if record is None:
+        async with SessionLocal() as session:
             marzban_username = username or f"tg_{tg_id}"
             user = User(
                 telegram_id=tg_id,
                 username=username,
                 marzban_username=marzban_username,
+                panel=await placement.choose(session, tg_id),
             )
             session.add(user)
             await session.commit()
+        identity_cache.put(tg_id, UserRecord.from_user(user))
+    elif record.username != username:
+        async with SessionLocal() as session:
+            await session.execute(sa_update(User).where(User.id == record.id).values(username=username))
+            await session.commit()
+        identity_cache.invalidate(tg_id)
 
     await update.message.reply_text(
         "Привет! Добро пожаловать в VPN-бот. Команды:\n" \
         "- /profile — профиль и подписка\n" \
+        "- /usage — трафик за 7 дней (/usage 30 — за 30)\n" \
         "- /trial — получить тестовый доступ"
     )
@@ -2,9 +2,9 @@ import logging
 from datetime import datetime, timedelta, timezone
 from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy import select
-from db.models import SessionLocal, User, Subscription
-from bot.marzban_api import create_user
+from db.models import SessionLocal, Subscription
+from bot.identity import get_user_and_subscription
+from bot.provisioning import enqueue, provisioner
 logger = logging.getLogger(__name__)
 
 
@@ -16,19 +16,17 @@ async def trial(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_id = update.effective_user.id
 
     async with SessionLocal() as session:
-        result = await session.execute(select(User).where(User.telegram_id == tg_id))
-        user = result.scalars().first()
+        user, existing = await get_user_and_subscription(session, tg_id)
         if user is None:
             await update.message.reply_text("Сначала напиши /start")
             return
 
-        # already has active subscription
-        sub_q = await session.execute(
-            select(Subscription).where(Subscription.user_id == user.id, Subscription.status == "active")
-        )
-        existing = sub_q.scalars().first()
+        # already has active (or still provisioning) subscription
         if existing is not None:
-            await update.message.reply_text("У тебя уже есть активный доступ.")
+            if existing.status == "pending":
+                await update.message.reply_text("Доступ уже оформляется, пришлю сообщение, когда он будет готов.")
+            else:
+                await update.message.reply_text("У тебя уже есть активный доступ.")
             return
 
         end_at = datetime.now(timezone.utc) + timedelta(days=TRIAL_DAYS)
@@ -36,26 +34,32 @@ async def trial(update: Update, context: ContextTypes.DEFAULT_TYPE):
         expire_ts = int(end_at.timestamp())
         data_limit_bytes = TRIAL_LIMIT_MB * 1024 * 1024
 
-        logger.debug(f"Creating trial user in Marzban: {user.marzban_username}")
-        ok = await create_user(user.marzban_username, data_limit=data_limit_bytes, expire_at=expire_ts)
-        if not ok:
-            logger.error("Failed to create trial user in Marzban")
-            await update.message.reply_text("Не удалось выдать тестовый доступ. Попробуй позже.")
-            return
-
+        # Pending subscription and its Marzban task are written atomically;
+        # a provisioning worker creates the user and activates the subscription
         sub = Subscription(
             user_id=user.id,
             is_trial=True,
-            status="active",
+            status="pending",
             start_at=datetime.now(timezone.utc),
             end_at=end_at,
         )
         session.add(sub)
-        await session.commit()
-        logger.info(f"Trial granted for tg_id={tg_id} marzban={user.marzban_username} until {end_at}")
-
-        await update.message.reply_text(
-            f"Выдан тестовый доступ на {TRIAL_DAYS} дн., лимит {TRIAL_LIMIT_MB} MB. Смотри /profile"
+        await session.flush()
+        enqueue(
+            session,
+            "create",
+            user.marzban_username,
+            panel=user.panel,
+            subscription_id=sub.id,
+            data_limit=data_limit_bytes,
+            expire_at=expire_ts,
+            notify_chat_id=update.effective_chat.id,
         )
+        await session.commit()
+    provisioner.wake()
+    logger.info("Trial queued for tg_id=%s marzban=%s until %s", tg_id, user.marzban_username, end_at)
 
-
+    await update.message.reply_text(
+        f"Оформляю тестовый доступ на {TRIAL_DAYS} дн., лимит {TRIAL_LIMIT_MB} MB. "
+        "Пришлю сообщение, когда он будет готов."
+    )
@@ -0,0 +1,76 @@
+import logging
+from datetime import date
+from typing import Optional
+from telegram import Update
+from telegram.ext import ContextTypes
+from db.models import SessionLocal
+from bot.identity import get_user_record
+from bot.timeseries import daily_usage
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+SPARKS = " ▁▂▃▄▅▆▇█"
+BAR_WIDTH = 16
+
+
+def fmt_bytes(value: int) -> str:
+    if value >= 1 << 30:
+        return f"{value / (1 << 30):.2f} GB"
+    return f"{value / (1 << 20):.1f} MB"
+
+
+def _spark(hours: list[int], peak: int) -> str:
+    return "".join(SPARKS[-(-value * 8 // peak)] if value else SPARKS[0] for value in hours)
+
+
+def _bar(value: int, peak: int) -> str:
+    # eighths of a block, so small days still show
+    eighths = -(-value * BAR_WIDTH * 8 // peak) if value else 0
+    full, rest = divmod(eighths, 8)
+    return "█" * full + ("▏▎▍▌▋▊▉"[rest - 1] if rest else "")
+
+
+def render_chart(days: list[tuple[date, int, Optional[list[int]]]]) -> str:
+    # One line per day: an hourly sparkline for the 7-day view (where hourly
+    # data is still kept), a bar scaled to the busiest day otherwise. A day
+    # without traffic has no hour rows and is drawn as 24 empty hours; only
+    # traffic already rolled up to days (USAGE_HOUR_DAYS under 7) forces bars.
+    hourly = len(days) <= 7 and all(hours is not None or not total for _, total, hours in days)
+    if hourly:
+        days = [(day, total, hours or [0] * 24) for day, total, hours in days]
+    peak = max((max(hours) for _, _, hours in days if hours), default=0) if hourly else max(t for _, t, _ in days)
+    lines = []
+    for day, total, hours in days:
+        label = f"{WEEKDAYS[day.weekday()]} {day:%d.%m}"
+        if not peak:
+            graph = ""
+        elif hourly:
+            graph = _spark(hours, peak)
+        else:
+            graph = _bar(total, peak).ljust(BAR_WIDTH)
+        lines.append(f"{label} {graph} {fmt_bytes(total):>9}")
+    return "\n".join(lines)
+
+
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tg_id = update.effective_user.id
+    args = context.args if context is not None and context.args else []
+    days = 30 if args and args[0] == "30" else 7
+
+    user = await get_user_record(tg_id)
+    if user is None:
+        await update.message.reply_text("Ты не зарегистрирован. Напиши /start.")
+        return
+
+    async with SessionLocal() as session:
+        series = await daily_usage(session, user.marzban_username, days)
+    total = sum(t for _, t, _ in series)
+    if not total:
+        await update.message.reply_text(f"За последние {days} дней трафика нет.")
+        return
+
+    text = f"📈 *Трафик за {days} дней*: `{fmt_bytes(total)}`\n```\n{render_chart(series)}\n```"
+    if days == 7:
+        text += "\nЗа 30 дней: /usage 30"
+    await update.message.reply_text(text, parse_mode="Markdown")
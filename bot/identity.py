@@ -0,0 +1,86 @@
+import logging
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import SessionLocal, Subscription, User, subscription_is_live
+from bot.cache import AsyncTTLCache
+from config import IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class UserRecord:
+    # Detached, read-only view of the users row that handlers need on every
+    # command. None of these fields change after registration except the
+    # Telegram username, which /start refreshes.
+    __slots__ = ("id", "telegram_id", "username", "marzban_username", "panel")
+
+    def __init__(self, id: int, telegram_id: int, username: Optional[str], marzban_username: str, panel: Optional[str]):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.username = username
+        self.marzban_username = marzban_username
+        self.panel = panel
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserRecord":
+        return cls(user.id, user.telegram_id, user.username, user.marzban_username, user.panel)
+
+    def __repr__(self) -> str:
+        return f"UserRecord(id={self.id}, telegram_id={self.telegram_id}, marzban_username={self.marzban_username!r})"
+
+
+async def _load_user(telegram_id: int) -> Optional[UserRecord]:
+    async with SessionLocal() as session:
+        result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+        user = result.scalars().first()
+    return UserRecord.from_user(user) if user is not None else None
+
+
+# Misses for unregistered users return None and are not cached
+identity_cache = AsyncTTLCache(
+    _load_user,
+    ttl=IDENTITY_CACHE_TTL,
+    maxsize=IDENTITY_CACHE_SIZE,
+    name="identity",
+)
+
+
+async def get_user_record(telegram_id: int) -> Optional[UserRecord]:
+    return await identity_cache.get(telegram_id)
+
+
+def user_subscription_query(telegram_id: int):
+    # User and its active/pending subscription (if any) in one round-trip
+    return (
+        select(User, Subscription)
+        .outerjoin(
+            Subscription,
+            (Subscription.user_id == User.id) & subscription_is_live(),
+        )
+        .where(User.telegram_id == telegram_id)
+        .limit(1)
+    )
+
+
+def live_subscription_query(user_id: int):
+    return select(Subscription).where(Subscription.user_id == user_id, subscription_is_live()).limit(1)
+
+
+async def get_user_and_subscription(
+    session: AsyncSession, telegram_id: int
+) -> tuple[Optional[UserRecord], Optional[Subscription]]:
+    # One query either way: the subscription alone when the user is cached,
+    # otherwise the joined lookup, which also fills the cache
+    record = identity_cache.get_nowait(telegram_id)
+    if record is not None:
+        result = await session.execute(live_subscription_query(record.id))
+        return record, result.scalars().first()
+
+    row = (await session.execute(user_subscription_query(telegram_id))).first()
+    if row is None:
+        return None, None
+    user, sub = row
+    record = UserRecord.from_user(user)
+    identity_cache.put(telegram_id, record)
+    return record, sub
@@ -1,45 +1,312 @@
+import asyncio
 import logging
-from datetime import datetime, timezone
-from typing import Iterable
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 from telegram.ext import ContextTypes
-from sqlalchemy import select, and_
-from db.models import SessionLocal, Subscription, User
-from bot.marzban_api import delete_user
+from sqlalchemy import func, select, update, and_, or_
+from db.models import SessionLocal, Subscription, User, subscription_is_active
+from bot.marzban_api import clients, delete_user, panel_configured
+from bot.placement import on_panel
+from bot.metrics import CLEANUP_DURATION, CLEANUP_ROWS, CLEANUP_FAILURES
+from bot.usage import forget_snapshots
+from config import (
+    CLEANUP_BATCH_SIZE,
+    CLEANUP_CONCURRENCY,
+    CLEANUP_EXPIRE_WITHOUT_PANEL,
+    CLEANUP_LEASE,
+    CLEANUP_MAX_ATTEMPTS,
+    CLEANUP_RETRY_BACKOFF,
+)
 
 logger = logging.getLogger(__name__)
 
 
-async def cleanup_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
+@dataclass
+class CleanupStats:
+    scanned: int = 0
+    expired: int = 0
+    failed: int = 0
+    no_panel: int = 0  # no panel configured to delete them from
+    batches: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.scanned / self.elapsed if self.elapsed > 0 else 0.0
+
+
+async def _delete_with_retry(marzban_username: str, panel: Optional[str] = None) -> bool:
+    for attempt in range(CLEANUP_MAX_ATTEMPTS):
+        try:
+            if await delete_user(marzban_username, panel=panel):
+                return True
+        except Exception:
+            logger.exception("Error deleting Marzban user %s during cleanup", marzban_username)
+        if attempt + 1 < CLEANUP_MAX_ATTEMPTS:
+            # exponential backoff with jitter
+            delay = CLEANUP_RETRY_BACKOFF * (2 ** attempt)
+            await asyncio.sleep(delay + random.uniform(0, delay))
+    return False
+
+
+def lease_free(now: datetime):
+    # Not claimed by a revocation whose lease is still running
+    return or_(Subscription.revoke_lease_until.is_(None), Subscription.revoke_lease_until <= now)
+
+
+def expired_batch_query(
+    now: datetime, panel: str, cursor: Optional[tuple[datetime, int]], batch_size: int
+):
+    query = (
+        select(Subscription, User)
+        .join(User, User.id == Subscription.user_id)
+        .where(
+            and_(
+                subscription_is_active(),
+                Subscription.end_at < now,
+                on_panel(User.panel, panel),
+                lease_free(now),
+            )
+        )
+    )
+    if cursor is not None:
+        last_end_at, last_id = cursor
+        query = query.where(
+            or_(
+                Subscription.end_at > last_end_at,
+                and_(Subscription.end_at == last_end_at, Subscription.id > last_id),
+            )
+        )
+    # Other replicas skip these rows until the claim is committed
+    # (FOR UPDATE is a no-op on SQLite, which runs single-instance)
+    return (
+        query.order_by(Subscription.end_at, Subscription.id)
+        .limit(batch_size)
+        .with_for_update(of=Subscription, skip_locked=True)
+    )
+
+
+async def run_cleanup(
+    now: Optional[datetime] = None,
+    batch_size: int = CLEANUP_BATCH_SIZE,
+    concurrency: int = CLEANUP_CONCURRENCY,
+) -> CleanupStats:
+    # Panels are cleaned in parallel, each with its own `concurrency` deletes
+    # in flight, so one slow panel doesn't hold back the others
+    now = now or datetime.now(timezone.utc)
+    started = time.monotonic()
+    panels = list(clients) + await _removed_panels(now)
+    results = await asyncio.gather(
+        *(_run_panel_cleanup(panel, now, batch_size, concurrency) for panel in panels)
+    )
+    stats = CleanupStats()
+    for panel_stats in results:
+        stats.scanned += panel_stats.scanned
+        stats.expired += panel_stats.expired
+        stats.failed += panel_stats.failed
+        stats.no_panel += panel_stats.no_panel
+        stats.batches += panel_stats.batches
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def _removed_panels(now: datetime) -> list[str]:
+    # Panels that expired subscriptions still point at but that are no longer
+    # in MARZBAN_PANELS
+    async with SessionLocal() as session:
+        return list(
+            await session.scalars(
+                select(User.panel)
+                .join(Subscription, Subscription.user_id == User.id)
+                .where(
+                    subscription_is_active(),
+                    Subscription.end_at < now,
+                    User.panel.is_not(None),
+                    User.panel.not_in(list(clients)),
+                )
+                .distinct()
+            )
+        )
+
+
+async def _run_panel_cleanup(panel: str, now: datetime, batch_size: int, concurrency: int) -> CleanupStats:
+    # Walks the panel's expired backlog with keyset pagination over (end_at, id).
+    # Each batch is claimed in a short transaction that leases its rows, the
+    # Marzban deletes run with no transaction open, and the results are
+    # written in a second short transaction, so a crash only loses the batch
+    # in flight (its lease runs out). Subscriptions whose Marzban delete keeps
+    # failing are released and picked up again by the next run. With no panel
+    # configured there is nothing to delete from: the rows are only counted
+    # and stay active, unless CLEANUP_EXPIRE_WITHOUT_PANEL expires them locally.
+    stats = CleanupStats()
+    configured = panel_configured(panel)
+    started = time.monotonic()
+    if not configured and not CLEANUP_EXPIRE_WITHOUT_PANEL:
+        async with SessionLocal() as session:
+            stats.no_panel = stats.scanned = await session.scalar(
+                select(func.count())
+                .select_from(Subscription)
+                .join(User, User.id == Subscription.user_id)
+                .where(subscription_is_active(), Subscription.end_at < now, on_panel(User.panel, panel))
+            )
+        if stats.no_panel:
+            logger.error(
+                "No Marzban panel configured for %r: %s expired subscriptions left active, their users may still "
+                "have access; configure the panel or set CLEANUP_EXPIRE_WITHOUT_PANEL=1",
+                panel, stats.no_panel,
+            )
+        stats.elapsed = time.monotonic() - started
+        return stats
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _bounded_delete(marzban_username: str) -> bool:
+        async with semaphore:
+            return await _delete_with_retry(marzban_username, panel)
+
+    cursor: Optional[tuple[datetime, int]] = None
+
+    while True:
+        async with SessionLocal() as session:
+            query = expired_batch_query(now, panel, cursor, batch_size)
+            rows = (await session.execute(query)).all()
+            if not rows:
+                break
+
+            last_sub = rows[-1][0]
+            cursor = (last_sub.end_at, last_sub.id)
+            claimed = [(sub.id, user.marzban_username) for sub, user in rows]
+
+            if not configured:
+                for sub, _ in rows:
+                    sub.status = "expired"
+                await session.commit()
+                stats.no_panel += len(rows)
+                stats.scanned += len(rows)
+                stats.batches += 1
+                logger.warning(
+                    "No Marzban panel configured for %r: expired %s subscriptions locally without deleting their users",
+                    panel, len(rows),
+                )
+                if len(rows) < batch_size:
+                    break
+                continue
+
+            lease_until = datetime.now(timezone.utc) + timedelta(seconds=CLEANUP_LEASE)
+            await session.execute(
+                update(Subscription), [{"id": sub_id, "revoke_lease_until": lease_until} for sub_id, _ in claimed]
+            )
+            await session.commit()
+
+        # One delete per Marzban user even if several of its subscriptions expired
+        usernames = list({name for _, name in claimed})
+        results = await asyncio.gather(*(_bounded_delete(name) for name in usernames))
+        deleted = dict(zip(usernames, results))
+        expired = [sub_id for sub_id, name in claimed if deleted[name]]
+        failed = [sub_id for sub_id, name in claimed if not deleted[name]]
+
+        async with SessionLocal() as session:
+            if expired:
+                await session.execute(
+                    update(Subscription)
+                    .where(Subscription.id.in_(expired), subscription_is_active())
+                    .values(status="expired", revoke_lease_until=None)
+                )
+            if failed:
+                await session.execute(
+                    update(Subscription).where(Subscription.id.in_(failed)).values(revoke_lease_until=None)
+                )
+            await forget_snapshots(session, [name for name, ok in deleted.items() if ok], panel)
+            await session.commit()
+
+        stats.expired += len(expired)
+        stats.failed += len(failed)
+        stats.scanned += len(claimed)
+        stats.batches += 1
+        logger.debug("Cleanup %s batch %s: %s rows, cursor=%s", panel, stats.batches, len(claimed), cursor)
+
+        if len(claimed) < batch_size:
+            break
+
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def revoke_subscription(subscription_id: int) -> bool:
+    # Expire a single subscription at its deadline. Returns False when the
+    # Marzban delete failed; the periodic cleanup will retry it. Like the
+    # cleanup, the row is leased and the delete runs outside the transaction.
     now = datetime.now(timezone.utc)
     async with SessionLocal() as session:
-        # Find active subscriptions that are past end_at
         result = await session.execute(
             select(Subscription, User)
             .join(User, User.id == Subscription.user_id)
             .where(
                 and_(
-                    Subscription.status == "active",
-                    Subscription.end_at < now,
+                    Subscription.id == subscription_id,
+                    subscription_is_active(),
+                    Subscription.end_at <= now,
+                    lease_free(now),
                 )
             )
-            .limit(100)
+            .with_for_update(of=Subscription, skip_locked=True)
         )
-        rows: Iterable[tuple[Subscription, User]] = result.all()
-        if not rows:
-            logger.debug("No expired subscriptions found")
-            return
-
-        for sub, user in rows:
-            # Try to delete user in Marzban
-            try:
-                logger.info(f"Deleting Marzban user {user.marzban_username} due to expired subscription")
-                await delete_user(user.marzban_username)
-            except Exception:
-                logger.exception("Error deleting Marzban user during cleanup")
-            # Mark subscription as expired
+        row = result.first()
+        if row is None:
+            # already expired/canceled, extended past this deadline, or being
+            # revoked by another replica
+            return True
+        sub, user = row
+        marzban_username, panel = user.marzban_username, user.panel
+        if not panel_configured(panel):
+            # nothing to retry against; the cleanup keeps reporting the row
+            if not CLEANUP_EXPIRE_WITHOUT_PANEL:
+                logger.error(
+                    "No Marzban panel configured for %r: subscription %s of %s left active",
+                    panel, sub.id, marzban_username,
+                )
+                return True
+            logger.warning(
+                "No Marzban panel configured for %r: expiring subscription %s of %s locally",
+                panel, sub.id, marzban_username,
+            )
             sub.status = "expired"
+            await session.commit()
+            return True
+        logger.info("Revoking Marzban user %s: subscription %s ended at %s", marzban_username, sub.id, sub.end_at)
+        sub.revoke_lease_until = now + timedelta(seconds=CLEANUP_LEASE)
+        await session.commit()
 
+    deleted = await _delete_with_retry(marzban_username, panel)
+    async with SessionLocal() as session:
+        if deleted:
+            await session.execute(
+                update(Subscription)
+                .where(Subscription.id == subscription_id, subscription_is_active())
+                .values(status="expired", revoke_lease_until=None)
+            )
+            await forget_snapshots(session, [marzban_username], panel)
+        else:
+            await session.execute(
+                update(Subscription).where(Subscription.id == subscription_id).values(revoke_lease_until=None)
+            )
         await session.commit()
-        logger.info(f"Expired subscriptions cleaned: {len(rows)}")
+    return deleted
 
 
+async def cleanup_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await run_cleanup()
+    CLEANUP_DURATION.observe(stats.elapsed)
+    CLEANUP_ROWS.inc(stats.expired, result="expired")
+    CLEANUP_ROWS.inc(stats.failed, result="failed")
+    CLEANUP_ROWS.inc(stats.no_panel, result="no_panel")
+    CLEANUP_FAILURES.inc(stats.failed)
+    if not stats.scanned:
+        logger.debug("No expired subscriptions found")
+        return
+    logger.info(
+        "Expired subscriptions cleaned: %s expired, %s failed, %s without a panel, %s batches in %.2fs (%.1f rows/s)",
+        stats.expired, stats.failed, stats.no_panel, stats.batches, stats.elapsed, stats.rate,
+    )
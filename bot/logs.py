@@ -0,0 +1,176 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+from bot.metrics import Counter, Gauge
+from bot.ratelimit import TokenBucket
+from config import LOG_LEVEL, LOG_FORMAT, LOG_LEVELS, LOG_SAMPLE, LOG_RATE_LIMIT, LOG_QUEUE_SIZE
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Plain ints: counted on the logging call's path, read at scrape time
+dropped = {"sampled": 0, "rate_limited": 0, "queue_full": 0}
+LOG_RECORDS_DROPPED = Counter(
+    "vpn_bot_log_records_dropped_total", "Log records not written, by reason", ("reason",),
+    callback=lambda: {(reason,): count for reason, count in dropped.items()},
+)
+
+
+def _configured(settings: dict, name: str) -> Optional[str]:
+    # The logger's own name or its closest parent's, if either is in `settings`
+    while name not in settings:
+        if "." not in name:
+            return None
+        name = name.rsplit(".", 1)[0]
+    return name
+
+
+class SamplingFilter(logging.Filter):
+    # Thins out DEBUG/INFO records of chatty loggers before they are queued:
+    # a logger keeps a `sample` fraction of them and at most `rate_limit` per
+    # second. WARNING and above always pass.
+    def __init__(self, sample: dict[str, float], rate_limit: dict[str, float]):
+        super().__init__()
+        self.sample = sample
+        self.rate_limit = rate_limit
+        self._buckets: dict[str, TokenBucket] = {}
+        self._policies: dict[str, tuple[Optional[float], Optional[TokenBucket]]] = {}
+
+    def _policy(self, name: str) -> tuple[Optional[float], Optional[TokenBucket]]:
+        policy = self._policies.get(name)
+        if policy is None:
+            sample_key = _configured(self.sample, name)
+            rate_key = _configured(self.rate_limit, name)
+            bucket = None
+            if rate_key is not None:
+                # loggers under one configured name share its budget
+                bucket = self._buckets.get(rate_key)
+                if bucket is None:
+                    bucket = self._buckets[rate_key] = TokenBucket(self.rate_limit[rate_key])
+            sample = self.sample[sample_key] if sample_key is not None else None
+            policy = self._policies[name] = (sample, bucket)
+        return policy
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        sample, bucket = self._policy(record.name)
+        if sample is not None and random.random() >= sample:
+            dropped["sampled"] += 1
+            return False
+        if bucket is not None and bucket.consume() > 0:
+            dropped["rate_limited"] += 1
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # As QueueHandler does: merge the arguments into the message and
+        # render the traceback now, while they still describe the call, and
+        # hand the listener a copy holding only strings. The traceback goes
+        # in exc_text rather than the message, so the formatters still lay
+        # it out themselves.
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.message = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+    def __init__(self, queue: queue.SimpleQueue, maxsize: int):
+        super().__init__(queue)
+        self.maxsize = maxsize
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # Never wait for the writer: with the queue full the record is lost.
+        # (SimpleQueue is unbounded but much cheaper to put to than Queue.)
+        if self.queue.qsize() >= self.maxsize:
+            dropped["queue_full"] += 1
+            return
+        self.queue.put_nowait(record)
+
+
+_listener: Optional[QueueListener] = None
+_queue: Optional[queue.SimpleQueue] = None
+
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    fmt: str = LOG_FORMAT,
+    levels: dict[str, str] = LOG_LEVELS,
+    sample: dict[str, float] = LOG_SAMPLE,
+    rate_limit: dict[str, float] = LOG_RATE_LIMIT,
+    queue_size: int = LOG_QUEUE_SIZE,
+    stream: Optional[TextIO] = None,
+) -> None:
+    # Routes all logging through a bounded queue to a writer thread, so the
+    # event loop never blocks on (or formats for) the log output
+    global _listener, _queue
+    stop_logging()
+    # Neither format uses the caller's thread or process, so skip collecting
+    # them for every record
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    _queue = queue.SimpleQueue()
+    queue_handler = _NonBlockingQueueHandler(_queue, queue_size)
+    if sample or rate_limit:
+        queue_handler.addFilter(SamplingFilter(sample, rate_limit))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = QueueListener(_queue, handler)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    # Writes out what is still queued; safe to call more than once
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+LOG_QUEUE_DEPTH = Gauge(
+    "vpn_bot_log_queue_depth", "Log records waiting for the writer thread",
+    callback=lambda: _queue.qsize() if _queue is not None else 0,
+)
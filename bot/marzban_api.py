@@ -1,138 +1,667 @@
+import asyncio
+import base64
+import codecs
+import json
 import logging
+import re
+import time
 import aiohttp
-from typing import Optional
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
 from config import (
-    MARZBAN_API_URL,
-    MARZBAN_API_KEY,
-    MARZBAN_USERNAME,
-    MARZBAN_PASSWORD,
+    MARZBAN_PANELS,
+    MARZBAN_DEFAULT_PANEL,
+    MARZBAN_POOL_LIMIT,
+    MARZBAN_POOL_LIMIT_PER_HOST,
+    MARZBAN_DNS_CACHE_TTL,
+    MARZBAN_KEEPALIVE_TIMEOUT,
+    MARZBAN_TOKEN_REFRESH_MARGIN,
+    MARZBAN_CONNECT_TIMEOUT,
+    MARZBAN_READ_TIMEOUT,
+    MARZBAN_MAX_RETRIES,
+    MARZBAN_RETRY_BACKOFF,
+    MARZBAN_RETRY_BUDGET_RATIO,
+    MARZBAN_BREAKER_THRESHOLD,
+    MARZBAN_BREAKER_RESET,
+    MARZBAN_USER_CACHE_TTL,
+    MARZBAN_USER_CACHE_STALE,
+    MARZBAN_USER_CACHE_SIZE,
 )
+from bot.cache import AsyncTTLCache
+from bot.metrics import (
+    MARZBAN_BREAKER_REJECTED,
+    MARZBAN_BREAKER_STATE,
+    MARZBAN_LOGINS,
+    MARZBAN_REQUEST_DURATION,
+    MARZBAN_RETRIES,
+    endpoint_label,
+)
+from bot.resilience import CircuitBreaker, RetryBudget, backoff_delay
 
 
 logger = logging.getLogger(__name__)
-_cached_token: Optional[str] = None
 
+# Treat a token as expired slightly before its `exp` to absorb clock skew
+_EXPIRY_SKEW = 5.0
+# Only these are retried on errors/5xx; POST/PATCH/PUT may have been applied
+_IDEMPOTENT_METHODS = frozenset({"GET", "DELETE"})
+_BREAKER_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+class MarzbanUnavailable(aiohttp.ClientError):
+    # Raised without touching the network while the circuit breaker is open
+    pass
+
+
+@dataclass(slots=True)
+class MarzbanUser:
+    # The fields of Marzban's UserResponse the bot reads; proxies, links,
+    # inbounds etc. are dropped as soon as a user is decoded
+    username: str
+    status: Optional[str] = None
+    used_traffic: int = 0
+    data_limit: Optional[int] = None
+    expire: Optional[int] = None
+    subscription_url: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "MarzbanUser":
+        return cls(
+            data.get("username") or "",
+            data.get("status"),
+            int(data.get("used_traffic") or 0),
+            data.get("data_limit"),
+            data.get("expire"),
+            data.get("subscription_url"),
+        )
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_json_decoder = json.JSONDecoder()
 
-def _auth_headers():
-    global _cached_token
-    token = MARZBAN_API_KEY or _cached_token
-    return {"Authorization": f"Bearer {token}"} if token else {}
 
+class _JsonStream:
+    # Reads a JSON response body value by value as it arrives, so a listing
+    # of thousands of users is never held as one text or one dict tree
+    def __init__(self, content: aiohttp.StreamReader, chunk_size: int = 1 << 16):
+        self._content = content
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
 
-async def _login_if_needed(session: aiohttp.ClientSession) -> bool:
-    global _cached_token
-    if MARZBAN_API_KEY:
+    async def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = await self._content.read(self._chunk_size)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
         return True
-    if not (MARZBAN_USERNAME and MARZBAN_PASSWORD):
-        return False
 
-    url = f"{MARZBAN_API_URL.rstrip('/')}/api/admin/token"
+    async def peek(self) -> str:
+        # Next non-whitespace character, "" at the end of the body
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not await self._fill():
+                return ""
+
+    async def expect(self, char: str) -> None:
+        found = await self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in Marzban response, got {found!r}")
+        self._pos += 1
+
+    async def skip_comma(self) -> None:
+        if await self.peek() == ",":
+            self._pos += 1
+
+    async def value(self) -> Any:
+        await self.peek()
+        while True:
+            try:
+                value, end = _json_decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # an incomplete value: read more and decode it again
+                if not await self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self._buf) and await self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+async def _decode_user(resp: aiohttp.ClientResponse) -> MarzbanUser:
+    return MarzbanUser.from_json(await resp.json())
+
+
+async def _decode_user_list(
+    resp: aiohttp.ClientResponse, chunk_size: int = 1 << 16
+) -> tuple[list[MarzbanUser], Optional[int]]:
+    # {"users": [...], "total": N}, users decoded one at a time
+    stream = _JsonStream(resp.content, chunk_size)
+    users: list[MarzbanUser] = []
+    total = None
+    await stream.expect("{")
+    while await stream.peek() != "}":
+        key = await stream.value()
+        await stream.expect(":")
+        if key == "users":
+            await stream.expect("[")
+            while await stream.peek() != "]":
+                users.append(MarzbanUser.from_json(await stream.value()))
+                await stream.skip_comma()
+            await stream.expect("]")
+        else:
+            value = await stream.value()
+            if key == "total":
+                total = value
+        await stream.skip_comma()
+    return users, total
+
+
+def _jwt_exp(token: str) -> Optional[float]:
     try:
-        logger.debug("Logging in to Marzban to obtain token (json)...")
-        async with session.post(
-            url,
-            json={"username": MARZBAN_USERNAME, "password": MARZBAN_PASSWORD},
-            timeout=15,
-        ) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                _cached_token = data.get("access_token") or data.get("token")
-                logger.info("Obtained Marzban token via admin credentials (json)")
-                return _cached_token is not None
-        # Fallback: OAuth2PasswordRequestForm-style (application/x-www-form-urlencoded)
-        logger.debug("Login fallback (form-encoded) ...")
-        form_data = aiohttp.FormData()
-        form_data.add_field("username", MARZBAN_USERNAME)
-        form_data.add_field("password", MARZBAN_PASSWORD)
-        form_data.add_field("grant_type", "password")
-        async with session.post(
-            url,
-            data=form_data,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            timeout=15,
-        ) as resp2:
-            if resp2.status == 200:
-                data = await resp2.json()
-                _cached_token = data.get("access_token") or data.get("token")
-                logger.info("Obtained Marzban token via admin credentials (form)")
-                return _cached_token is not None
-            logger.error(f"Login failed with status {resp2.status}")
-            return False
-    except aiohttp.ClientError:
-        logger.exception("Failed to login to Marzban")
-        return False
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+    # Admin token holder: logins are single-flight (concurrent callers await the
+    # same attempt), the token is refreshed in the background shortly before
+    # its JWT `exp`, and the login flavor that worked (json/form) is tried first.
+    def __init__(
+        self,
+        client: "MarzbanClient",
+        api_key: str = "",
+        username: str = "",
+        password: str = "",
+        refresh_margin: float = MARZBAN_TOKEN_REFRESH_MARGIN,
+    ):
+        self._client = client
+        self.api_key = api_key
+        self.username = username
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.token: Optional[str] = None
+        self.expires_at: Optional[float] = None
+        self.login_mode: Optional[str] = None
+        self._skew = _EXPIRY_SKEW
+        self._inflight: Optional[asyncio.Future] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def can_login(self) -> bool:
+        return bool(self.username and self.password)
+
+    def _expired(self) -> bool:
+        return self.expires_at is not None and time.time() >= self.expires_at - self._skew
+
+    async def get_token(self) -> Optional[str]:
+        if self.api_key:
+            return self.api_key
+        if self.token is not None and not self._expired():
+            return self.token
+        if not self.can_login:
+            return None
+        return await self.refresh()
 
+    async def refresh(self, stale: Optional[str] = None) -> Optional[str]:
+        if self.api_key:
+            return self.api_key
+        # Another caller already replaced the token we got a 401 with
+        if stale is not None and self.token is not None and self.token != stale:
+            return self.token
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._login())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return await asyncio.shield(self._inflight)
 
-async def get_user_info(marzban_username: str):
-    if not MARZBAN_API_URL:
+    def _clear_inflight(self, fut: asyncio.Future) -> None:
+        if self._inflight is fut:
+            self._inflight = None
+
+    async def _login(self) -> Optional[str]:
+        modes = ["json", "form"]
+        if self.login_mode in modes:
+            modes.remove(self.login_mode)
+            modes.insert(0, self.login_mode)
+
+        session = await self._client.session()
+        url = self._client.url("/api/admin/token")
+        for mode in modes:
+            try:
+                logger.debug("Logging in to Marzban to obtain token (%s)...", mode)
+                if mode == "json":
+                    request = session.post(
+                        url,
+                        json={"username": self.username, "password": self.password},
+                    )
+                else:
+                    # OAuth2PasswordRequestForm-style (application/x-www-form-urlencoded)
+                    form_data = aiohttp.FormData()
+                    form_data.add_field("username", self.username)
+                    form_data.add_field("password", self.password)
+                    form_data.add_field("grant_type", "password")
+                    request = session.post(
+                        url,
+                        data=form_data,
+                        headers={"Content-Type": "application/x-www-form-urlencoded"},
+                    )
+                async with request as resp:
+                    if resp.status != 200:
+                        logger.debug("Login (%s) failed with status %s", mode, resp.status)
+                        continue
+                    data = await resp.json()
+            except aiohttp.ClientError:
+                logger.exception("Failed to login to Marzban (%s)", mode)
+                continue
+
+            token = data.get("access_token") or data.get("token")
+            if not token:
+                continue
+            self.token = token
+            self.expires_at = _jwt_exp(token)
+            if self.expires_at is not None:
+                self._skew = min(_EXPIRY_SKEW, max(self.expires_at - time.time(), 0.0) / 4)
+            self.login_mode = mode
+            MARZBAN_LOGINS.inc(result="ok")
+            logger.info("Obtained Marzban token via admin credentials (%s)", mode)
+            self._schedule_refresh()
+            return token
+
+        MARZBAN_LOGINS.inc(result="failed")
+        logger.error("Login to Marzban failed")
         return None
 
-    url = f"{MARZBAN_API_URL.rstrip('/')}/api/user/{marzban_username}"
-    async with aiohttp.ClientSession() as session:
+    def _schedule_refresh(self) -> None:
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        self._refresh_task = None
+        if self.expires_at is None:
+            return
+        lifetime = self.expires_at - time.time()
+        # Short-lived tokens: refresh at half-life rather than immediately
+        margin = min(self.refresh_margin, lifetime / 2)
+        delay = max(lifetime - margin, 0.0)
+        self._refresh_task = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        # Detach so that the login we start doesn't cancel its own scheduling
+        self._refresh_task = None
+        logger.debug("Refreshing Marzban token before expiry")
+        await self.refresh()
+
+    async def close(self) -> None:
+        for task in (self._refresh_task, self._inflight):
+            if task is not None and not task.done():
+                task.cancel()
+        self._refresh_task = None
+        self._inflight = None
+
+
+class MarzbanClient:
+    # Long-lived HTTP client for the panel: one keep-alive connector reused by
+    # every API call, so requests don't pay a TCP+TLS handshake each time.
+    def __init__(
+        self,
+        base_url: str,
+        name: str = MARZBAN_DEFAULT_PANEL,
+        api_key: str = "",
+        username: str = "",
+        password: str = "",
+        limit: int = MARZBAN_POOL_LIMIT,
+        limit_per_host: int = MARZBAN_POOL_LIMIT_PER_HOST,
+        dns_cache_ttl: int = MARZBAN_DNS_CACHE_TTL,
+        keepalive_timeout: float = MARZBAN_KEEPALIVE_TIMEOUT,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.tokens = TokenManager(self, api_key=api_key, username=username, password=password)
+        self.breaker = CircuitBreaker(name, threshold=MARZBAN_BREAKER_THRESHOLD, reset_timeout=MARZBAN_BREAKER_RESET)
+        self.retry_budget = RetryBudget(ratio=MARZBAN_RETRY_BUDGET_RATIO)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        # No overall deadline: connecting and each socket read are bounded separately
+        timeout = aiohttp.ClientTimeout(total=None, connect=MARZBAN_CONNECT_TIMEOUT, sock_read=MARZBAN_READ_TIMEOUT)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.debug(
+            "Marzban client %s started (limit=%s, per_host=%s, dns_ttl=%s)",
+            self.name, self.limit, self.limit_per_host, self.dns_cache_ttl,
+        )
+
+    async def close(self) -> None:
+        await self.tokens.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.debug("Marzban client %s closed", self.name)
+        self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        # Started from Application.post_init; lazily started for jobs/scripts
+        # that run outside the bot application.
+        if self._session is None or self._session.closed:
+            await self.start()
+        return self._session
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        decode: Optional[Callable[[aiohttp.ClientResponse], Awaitable[Any]]] = None,
+        **kwargs,
+    ) -> tuple[int, Any]:
+        # Returns (status, decoded JSON body or None); `decode` replaces the
+        # plain resp.json() for successful JSON responses. Fails fast with
+        # MarzbanUnavailable while the breaker is open; idempotent calls are
+        # retried with jittered backoff on network errors and 5xx, as long as
+        # the retry budget allows.
         try:
-            # ensure we have a token
-            if not MARZBAN_API_KEY and not _cached_token:
-                await _login_if_needed(session)
+            return await self._request_with_retries(method, path, decode, **kwargs)
+        finally:
+            MARZBAN_BREAKER_STATE.set(_BREAKER_STATES[self.breaker.state], panel=self.breaker.name)
+
+    async def _request_with_retries(self, method: str, path: str, decode, **kwargs) -> tuple[int, Any]:
+        endpoint = endpoint_label(path)
+        retryable = method in _IDEMPOTENT_METHODS
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                MARZBAN_BREAKER_REJECTED.inc(panel=self.breaker.name)
+                raise MarzbanUnavailable(f"Marzban circuit {self.breaker.name} is open")
+            try:
+                status, data = await self._send(method, path, endpoint, decode, **kwargs)
+            except aiohttp.ClientError:
+                self.breaker.record_failure()
+                if not (retryable and attempt < MARZBAN_MAX_RETRIES and self.retry_budget.withdraw()):
+                    raise
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                if status < 500:
+                    self.breaker.record_success()
+                    return status, data
+                self.breaker.record_failure()
+                if not (retryable and attempt < MARZBAN_MAX_RETRIES and self.retry_budget.withdraw()):
+                    return status, data
+            MARZBAN_RETRIES.inc(method=method, endpoint=endpoint)
+            await asyncio.sleep(backoff_delay(attempt, MARZBAN_RETRY_BACKOFF))
+            attempt += 1
+
+    async def _send(self, method: str, path: str, endpoint: str, decode, **kwargs) -> tuple[int, Any]:
+        # A 401 triggers one (single-flight) re-login and a retry
+        session = await self.session()
+        token = await self.tokens.get_token()
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with session.request(method, self.url(path), headers=headers, **kwargs) as resp:
+                    status = resp.status
+                    if resp.status == 401 and attempt == 0 and self.tokens.can_login:
+                        logger.debug("Marzban returned 401 for %s %s, refreshing token", method, path)
+                        token = await self.tokens.refresh(stale=token)
+                        if token is None:
+                            return resp.status, None
+                        continue
+                    data = None
+                    if resp.status in (200, 201) and resp.content_type == "application/json":
+                        data = await (decode(resp) if decode is not None else resp.json())
+                    return resp.status, data
+            finally:
+                MARZBAN_REQUEST_DURATION.observe(
+                    time.perf_counter() - started, method=method, endpoint=endpoint, status=status
+                )
+        return 401, None
+
+
+# One client (token, connection pool, circuit breaker) per configured panel
+clients: dict[str, MarzbanClient] = {
+    panel["name"]: MarzbanClient(
+        panel.get("url", ""),
+        name=panel["name"],
+        api_key=panel["api_key"],
+        username=panel["username"],
+        password=panel["password"],
+    )
+    for panel in MARZBAN_PANELS
+}
+for _client in clients.values():
+    MARZBAN_BREAKER_STATE.set(0, panel=_client.name)
+
+
+def get_client(panel: Optional[str] = None) -> Optional[MarzbanClient]:
+    # Users without a stored panel predate sharding and live on the default one
+    client = clients.get(panel or MARZBAN_DEFAULT_PANEL)
+    if client is None:
+        logger.error("Unknown Marzban panel %r", panel)
+        return None
+    if not client.base_url:
+        return None
+    return client
+
+
+async def start_clients() -> None:
+    await asyncio.gather(*(client.start() for client in clients.values()))
+
+
+async def close_clients() -> None:
+    await asyncio.gather(*(client.close() for client in clients.values()))
 
-            async with session.get(url, headers=_auth_headers(), timeout=15) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    logger.debug(f"Fetched Marzban user info for {marzban_username}")
-                    return data
-                if resp.status == 401 and (MARZBAN_USERNAME and MARZBAN_PASSWORD):
-                    # try re-login once
-                    if await _login_if_needed(session):
-                        async with session.get(url, headers=_auth_headers(), timeout=15) as retry_resp:
-                            if retry_resp.status == 200:
-                                data = await retry_resp.json()
-                                logger.debug(f"Fetched Marzban user info after re-login for {marzban_username}")
-                                return data
-                return None
-        except aiohttp.ClientError:
-            logger.exception("Error fetching Marzban user info")
-            return None
+
+async def get_user_info(marzban_username: str, panel: Optional[str] = None) -> Optional[MarzbanUser]:
+    client = get_client(panel)
+    if client is None:
+        return None
+
+    try:
+        status, data = await client.request("GET", f"/api/user/{marzban_username}", decode=_decode_user)
+        if status == 200:
+            logger.debug("Fetched Marzban user info for %s", marzban_username)
+            return data
+        return None
+    except MarzbanUnavailable:
+        logger.warning("Marzban %s unavailable (circuit open), skipped fetching Marzban user info", client.name)
+        return None
+    except aiohttp.ClientError:
+        logger.exception("Error fetching Marzban user info")
+        return None
+
+
+async def list_users(
+    offset: int = 0, limit: int = 500, panel: Optional[str] = None
+) -> Optional[tuple[list[MarzbanUser], int]]:
+    client = get_client(panel)
+    if client is None:
+        return None
+    try:
+        status, data = await client.request(
+            "GET", "/api/users", decode=_decode_user_list, params={"offset": offset, "limit": limit}
+        )
+        if status == 200 and data is not None:
+            users, total = data
+            return users, int(total if total is not None else len(users))
+        logger.error("Failed to list Marzban users (offset=%s), status %s", offset, status)
+        return None
+    except MarzbanUnavailable:
+        logger.warning("Marzban %s unavailable (circuit open), skipped listing Marzban users", client.name)
+        return None
+    except (aiohttp.ClientError, ValueError):
+        logger.exception("Error listing Marzban users")
+        return None
 
 
-async def create_user(m_username: str, data_limit: Optional[int] | None = None, expire_at: Optional[int] | None = None) -> bool:
-    if not MARZBAN_API_URL:
+def _cache_key(marzban_username: str, panel: Optional[str]) -> tuple[str, str]:
+    return (panel or MARZBAN_DEFAULT_PANEL, marzban_username)
+
+
+async def _load_user_info(key: tuple[str, str]):
+    panel, marzban_username = key
+    return await get_user_info(marzban_username, panel=panel)
+
+
+user_info_cache = AsyncTTLCache(
+    _load_user_info,
+    ttl=MARZBAN_USER_CACHE_TTL,
+    stale_ttl=MARZBAN_USER_CACHE_STALE,
+    maxsize=MARZBAN_USER_CACHE_SIZE,
+    name="marzban_user",
+)
+
+
+async def get_user_info_cached(marzban_username: str, panel: Optional[str] = None) -> Optional[MarzbanUser]:
+    key = _cache_key(marzban_username, panel)
+    info = await user_info_cache.get(key)
+    if info is None and not panel_available(panel):
+        # Panel is unhealthy: fall back to the last known answer, however old
+        return user_info_cache.peek(key)
+    return info
+
+
+def panel_available(panel: Optional[str] = None) -> bool:
+    client = clients.get(panel or MARZBAN_DEFAULT_PANEL)
+    return client is not None and not client.breaker.is_open
+
+
+def panel_configured(panel: Optional[str] = None) -> bool:
+    # False when no request to the panel can ever succeed: MARZBAN_API_URL is
+    # unset, or the panel was removed from MARZBAN_PANELS
+    client = clients.get(panel or MARZBAN_DEFAULT_PANEL)
+    return client is not None and bool(client.base_url)
+
+
+async def create_user(
+    m_username: str,
+    data_limit: Optional[int] | None = None,
+    expire_at: Optional[int] | None = None,
+    panel: Optional[str] = None,
+) -> bool:
+    client = get_client(panel)
+    if client is None:
         return False
-    url = f"{MARZBAN_API_URL.rstrip('/')}/api/user"
     payload = {"username": m_username}
+    # Owned by the admin we log in as, so the user shows up in that admin's panel UI
+    if client.tokens.username:
+        payload["owner"] = client.tokens.username
     if data_limit is not None:
         payload["data_limit"] = data_limit
     if expire_at is not None:
         payload["expire"] = expire_at
-    async with aiohttp.ClientSession() as session:
-        try:
-            if not MARZBAN_API_KEY and not _cached_token:
-                await _login_if_needed(session)
-            async with session.post(url, headers=_auth_headers(), json=payload, timeout=15) as resp:
-                ok = resp.status in (200, 201)
-                if ok:
-                    logger.info(f"Created Marzban user {m_username}")
-                else:
-                    logger.error(f"Failed to create Marzban user {m_username}, status {resp.status}")
-                return ok
-        except aiohttp.ClientError:
-            logger.exception("Error creating Marzban user")
-            return False
+    try:
+        status, _ = await client.request("POST", "/api/user", json=payload)
+        if status in (200, 201):
+            logger.info("Created Marzban user %s on %s", m_username, client.name)
+            return True
+        if status == 409:
+            logger.warning("User %s already exists in Marzban, updating limits/expiry", m_username)
+            return await update_user(m_username, data_limit=data_limit, expire_at=expire_at, panel=panel)
+        logger.error("Failed to create Marzban user %s, status %s", m_username, status)
+        return False
+    except MarzbanUnavailable:
+        logger.warning("Marzban %s unavailable (circuit open), skipped creating Marzban user", client.name)
+        return False
+    except aiohttp.ClientError:
+        logger.exception("Error creating Marzban user")
+        return False
+    finally:
+        user_info_cache.invalidate(_cache_key(m_username, panel))
 
 
-async def delete_user(m_username: str) -> bool:
-    if not MARZBAN_API_URL:
+async def delete_user(m_username: str, panel: Optional[str] = None) -> bool:
+    client = get_client(panel)
+    if client is None:
         return False
-    url = f"{MARZBAN_API_URL.rstrip('/')}/api/user/{m_username}"
-    async with aiohttp.ClientSession() as session:
-        try:
-            if not MARZBAN_API_KEY and not _cached_token:
-                await _login_if_needed(session)
-            async with session.delete(url, headers=_auth_headers(), timeout=15) as resp:
-                ok = resp.status in (200, 204)
-                if ok:
-                    logger.info(f"Deleted Marzban user {m_username}")
-                else:
-                    logger.error(f"Failed to delete Marzban user {m_username}, status {resp.status}")
-                return ok
-        except aiohttp.ClientError:
-            logger.exception("Error deleting Marzban user")
-            return False
+    try:
+        status, _ = await client.request("DELETE", f"/api/user/{m_username}")
+        ok = status in (200, 204)
+        if ok:
+            logger.info("Deleted Marzban user %s on %s", m_username, client.name)
+        elif status == 404:
+            # Already gone (e.g. a retried or duplicate delete) - nothing left to revoke
+            logger.info("Marzban user %s not found, treating as deleted", m_username)
+            ok = True
+        else:
+            logger.error("Failed to delete Marzban user %s, status %s", m_username, status)
+        return ok
+    except MarzbanUnavailable:
+        logger.warning("Marzban %s unavailable (circuit open), skipped deleting Marzban user", client.name)
+        return False
+    except aiohttp.ClientError:
+        logger.exception("Error deleting Marzban user")
+        return False
+    finally:
+        user_info_cache.invalidate(_cache_key(m_username, panel))
+
+
+async def update_user(
+    m_username: str,
+    data_limit: Optional[int] | None = None,
+    expire_at: Optional[int] | None = None,
+    panel: Optional[str] = None,
+) -> bool:
+    client = get_client(panel)
+    if client is None:
+        return False
+    payload: dict = {}
+    if data_limit is not None:
+        payload["data_limit"] = data_limit
+    if expire_at is not None:
+        payload["expire"] = expire_at
+
+    if not payload:
+        logger.info("Nothing to update for %s", m_username)
+        return True
+
+    try:
+        # Try PATCH first
+        status, _ = await client.request("PATCH", f"/api/user/{m_username}", json=payload)
+        if status in (200, 204):
+            logger.info("Updated Marzban user %s", m_username)
+            return True
+        # Fallback to PUT if PATCH not allowed
+        if status in (400, 404, 405):
+            status, _ = await client.request("PUT", f"/api/user/{m_username}", json=payload)
+            ok = status in (200, 204)
+            if ok:
+                logger.info("Updated (PUT) Marzban user %s", m_username)
+            else:
+                logger.error("Failed to update (PUT) Marzban user %s, status %s", m_username, status)
+            return ok
+        logger.error("Failed to update (PATCH) Marzban user %s, status %s", m_username, status)
+        return False
+    except MarzbanUnavailable:
+        logger.warning("Marzban %s unavailable (circuit open), skipped updating Marzban user", client.name)
+        return False
+    except aiohttp.ClientError:
+        logger.exception("Error updating Marzban user")
+        return False
+    finally:
+        user_info_cache.invalidate(_cache_key(m_username, panel))
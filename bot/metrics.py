@@ -0,0 +1,322 @@
+import functools
+import logging
+import math
+import re
+import time
+from typing import Callable, Iterable, Optional
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, "_Metric"] = {}
+
+    def register(self, metric: "_Metric") -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+def _callback_samples(metric: _Metric, callback: Callable) -> list[str]:
+    # A callback returns a single value, or {label values tuple: value} for
+    # labelled metrics
+    try:
+        value = callback()
+    except Exception:
+        logger.exception("Callback for %s failed", metric.name)
+        return []
+    if isinstance(value, dict):
+        return [
+            f"{metric.name}{_format_labels(metric.labelnames, key)} {_format_value(v)}"
+            for key, v in value.items()
+        ]
+    return [f"{metric.name} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args, callback: Optional[Callable[[], float | dict]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        if self._callback is not None:
+            return _callback_samples(self, self._callback)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+            for key, v in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, *args, callback: Optional[Callable[[], float | dict]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> list[str]:
+        if self._callback is not None:
+            return _callback_samples(self, self._callback)
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+            for key, v in self._values.items()
+        ]
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_started")
+
+    def __init__(self, histogram: "Histogram", labels: dict):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per label set: [bucket counts..., sum, count]
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    def time(self, **labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def count(self, **labels) -> float:
+        state = self._values.get(self._key(labels))
+        return state[-1] if state else 0.0
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, state):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}")
+        return lines
+
+
+# --- bot metrics ---------------------------------------------------------
+
+HANDLER_DURATION = Histogram(
+    "vpn_bot_handler_duration_seconds", "Command handler latency", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "vpn_bot_handler_errors_total", "Command handler exceptions", ("handler",)
+)
+MARZBAN_REQUEST_DURATION = Histogram(
+    "vpn_bot_marzban_request_duration_seconds",
+    "Marzban API request latency",
+    ("method", "endpoint", "status"),
+)
+MARZBAN_LOGINS = Counter(
+    "vpn_bot_marzban_logins_total", "Marzban admin token logins", ("result",)
+)
+DB_QUERY_DURATION = Histogram(
+    "vpn_bot_db_query_duration_seconds",
+    "SQL statement execution time",
+    ("statement",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "vpn_bot_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled DB connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+MARZBAN_RETRIES = Counter(
+    "vpn_bot_marzban_retries_total", "Retried Marzban requests", ("method", "endpoint")
+)
+MARZBAN_BREAKER_REJECTED = Counter(
+    "vpn_bot_marzban_breaker_rejected_total", "Marzban calls rejected by the open circuit breaker", ("panel",)
+)
+MARZBAN_BREAKER_STATE = Gauge(
+    "vpn_bot_marzban_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ("panel",)
+)
+CLEANUP_DURATION = Histogram(
+    "vpn_bot_cleanup_duration_seconds", "Expired subscription cleanup run time",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+)
+CLEANUP_ROWS = Counter(
+    "vpn_bot_cleanup_rows_total", "Expired subscriptions processed by cleanup", ("result",)
+)
+CLEANUP_FAILURES = Counter(
+    "vpn_bot_cleanup_failures_total", "Marzban deletes that failed during cleanup after all retries"
+)
+
+
+_USER_PATH = re.compile(r"^/api/user/[^/]+")
+
+
+def endpoint_label(path: str) -> str:
+    # Collapse per-user URLs so label cardinality stays bounded
+    return _USER_PATH.sub("/api/user/{username}", path.split("?", 1)[0])
+
+
+def timed_handler(name: str, handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_query_start"].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_QUERY_DURATION.observe(time.perf_counter() - started, statement=kind)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(context):
+        if context.connection is not None:
+            stack = context.connection.info.get("metrics_query_start")
+            if stack:
+                stack.pop()
+
+    # The pool events only fire once a connection is handed out, so time
+    # Engine.connect(), which every Session and engine.begin() goes through
+    # and which returns once the pool has checked out a connection
+    connect = sync_engine.connect
+
+    @functools.wraps(connect)
+    def _timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+    sync_engine.connect = _timed_connect
+
+
+class MetricsServer:
+    def __init__(self, registry: Registry = REGISTRY):
+        self._registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self._registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    async def start(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Metrics endpoint listening on %s:%s/metrics", host, port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
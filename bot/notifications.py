@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from telegram.ext import ContextTypes
+from sqlalchemy import select, update
+from db.models import SessionLocal, Subscription, User, subscription_is_active
+from bot.dispatcher import PRIORITY_LOW, PRIORITY_NORMAL, dispatcher
+from config import REMINDER_HOURS
+
+logger = logging.getLogger(__name__)
+
+# Rows read per keyset window
+STREAM_BATCH_SIZE = 500
+
+
+@dataclass
+class DeliveryStats:
+    queued: int = 0
+    sent: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+
+class _DeliveryTracker:
+    # Counts message outcomes as they resolve, without holding on to the
+    # futures of an arbitrarily long run
+    def __init__(self, stats: DeliveryStats):
+        self.stats = stats
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def track(self, future: asyncio.Future) -> None:
+        self.stats.queued += 1
+        self._pending += 1
+        self._idle.clear()
+        future.add_done_callback(self._done)
+
+    def _done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.result():
+            self.stats.sent += 1
+        else:
+            self.stats.failed += 1
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    async def wait(self) -> None:
+        await self._idle.wait()
+
+
+async def _iter_windows(query, key, batch_size: int = STREAM_BATCH_SIZE):
+    # Yields the rows of `query` in `key` order, one short read per window.
+    # Consumers are paced by the send rate (hours for a big broadcast), so
+    # no cursor or transaction stays open between windows.
+    last = None
+    while True:
+        window = query if last is None else query.where(key > last)
+        async with SessionLocal() as session:
+            rows = (await session.execute(window.order_by(key).limit(batch_size))).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last = getattr(rows[-1], key.key)
+
+
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def reminder_window(start_at: datetime, end_at: datetime, hours: int = REMINDER_HOURS) -> timedelta:
+    # How long before end_at the reminder goes out: `hours`, or a quarter of
+    # the subscription for short ones, so a one-day trial hears 6 hours ahead
+    return min(timedelta(hours=hours), (_utc(end_at) - _utc(start_at)) / 4)
+
+
+def _reminder_text(end_at: datetime) -> str:
+    end_at = _utc(end_at)
+    hours = max(1, round((end_at - datetime.now(timezone.utc)).total_seconds() / 3600))
+    return f"⏰ Доступ закончится примерно через {hours} ч. ({end_at:%d.%m.%Y %H:%M} UTC). Подробности в /profile"
+
+
+async def send_expiry_reminders(hours: int = REMINDER_HOURS, wait: bool = False) -> DeliveryStats:
+    # Active subscriptions within their reminder_window() of the end that
+    # haven't been reminded yet. Candidates are those ending within `hours`;
+    # short ones whose scaled window hasn't opened are left for a later run.
+    # Each window of rows is marked reminded_at before its messages are
+    # queued, so a reminder goes out at most once even if the process dies
+    # (at the cost of the ones still queued).
+    now = datetime.now(timezone.utc)
+    stats = DeliveryStats()
+    tracker = _DeliveryTracker(stats)
+    started = time.monotonic()
+    query = (
+        select(Subscription.id, Subscription.start_at, Subscription.end_at, User.telegram_id)
+        .join(User, User.id == Subscription.user_id)
+        .where(
+            subscription_is_active(),
+            Subscription.end_at > now,
+            Subscription.end_at <= now + timedelta(hours=hours),
+            Subscription.reminded_at.is_(None),
+        )
+    )
+    async for rows in _iter_windows(query, Subscription.id):
+        due = [row for row in rows if _utc(row.end_at) - now <= reminder_window(row.start_at, row.end_at, hours)]
+        if not due:
+            continue
+        async with SessionLocal() as session:
+            await session.execute(
+                update(Subscription)
+                .where(Subscription.id.in_([row.id for row in due]), Subscription.reminded_at.is_(None))
+                .values(reminded_at=now)
+            )
+            await session.commit()
+        for row in due:
+            tracker.track(await dispatcher.put(row.telegram_id, _reminder_text(row.end_at), PRIORITY_NORMAL))
+    if wait:
+        await tracker.wait()
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def broadcast(text: str, wait: bool = True) -> DeliveryStats:
+    # Queues `text` for every user. Ids are read a window at a time as the
+    # dispatcher makes room, so memory stays flat however many users there are.
+    stats = DeliveryStats()
+    tracker = _DeliveryTracker(stats)
+    started = time.monotonic()
+    async for rows in _iter_windows(select(User.id, User.telegram_id), User.id):
+        for row in rows:
+            tracker.track(await dispatcher.put(row.telegram_id, text, PRIORITY_LOW))
+    if wait:
+        await tracker.wait()
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def remind_expiring(context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await send_expiry_reminders()
+    if stats.queued:
+        logger.info("Queued %s expiry reminders (%sh ahead)", stats.queued, REMINDER_HOURS)
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import Subscription, User, subscription_is_live
+from bot.metrics import Gauge
+from config import (
+    MARZBAN_PANELS,
+    MARZBAN_DEFAULT_PANEL,
+    MARZBAN_PLACEMENT,
+    MARZBAN_PLACEMENT_REFRESH,
+)
+
+logger = logging.getLogger(__name__)
+
+PANEL_ACTIVE_USERS = Gauge(
+    "vpn_bot_panel_active_users", "Users with an active or pending subscription per Marzban panel", ("panel",)
+)
+
+
+def on_panel(column, panel: str):
+    # WHERE clause for rows stored on `panel`; NULL means the default panel
+    if panel == MARZBAN_DEFAULT_PANEL:
+        return or_(column == panel, column.is_(None))
+    return column == panel
+
+
+def _hrw_score(panel: str, weight: float, telegram_id: int) -> float:
+    # Weighted rendezvous hashing: the highest score wins, and changing one
+    # panel's weight only moves users onto or off that panel
+    digest = hashlib.blake2b(f"{panel}:{telegram_id}".encode(), digest_size=8).digest()
+    point = (int.from_bytes(digest, "big") + 1) / (2 ** 64 + 1)
+    return -weight / math.log(point)
+
+
+class PanelPlacement:
+    # Picks the panel for a newly registered user. Per-panel load (users with
+    # an active or pending subscription) is read with one GROUP BY at most
+    # every `refresh_interval` seconds; placements made in between are counted
+    # locally so a burst of /start doesn't pile onto one panel.
+    def __init__(self, panels: list[dict], policy: str, refresh_interval: float):
+        self.policy = policy
+        self.refresh_interval = refresh_interval
+        self._order = [panel["name"] for panel in panels]
+        self._weights = {panel["name"]: float(panel.get("weight", 1)) for panel in panels}
+        self._load: dict[str, int] = {}
+        self._loaded_at = -math.inf
+        self._lock = asyncio.Lock()
+
+    @property
+    def candidates(self) -> list[str]:
+        return [name for name in self._order if self._weights[name] > 0]
+
+    async def choose(self, session: AsyncSession, telegram_id: int) -> str:
+        candidates = self.candidates
+        if not candidates:
+            logger.warning("All Marzban panels have weight 0, placing user on the default panel")
+            return MARZBAN_DEFAULT_PANEL
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.policy == "hash":
+            return max(candidates, key=lambda name: _hrw_score(name, self._weights[name], telegram_id))
+
+        await self._refresh(session)
+        panel = min(
+            candidates,
+            key=lambda name: (self._load.get(name, 0) / self._weights[name], self._order.index(name)),
+        )
+        self._load[panel] = self._load.get(panel, 0) + 1
+        return panel
+
+    async def _refresh(self, session: AsyncSession) -> None:
+        if time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._loaded_at < self.refresh_interval:
+                return
+            panel = func.coalesce(User.panel, MARZBAN_DEFAULT_PANEL)
+            result = await session.execute(
+                select(panel, func.count(func.distinct(User.id)))
+                .join(Subscription, Subscription.user_id == User.id)
+                .where(subscription_is_live())
+                .group_by(panel)
+            )
+            self._load = {name: count for name, count in result.all()}
+            self._loaded_at = time.monotonic()
+            for name in self._order:
+                PANEL_ACTIVE_USERS.set(self._load.get(name, 0), panel=name)
+            logger.debug("Marzban panel load: %s", self._load)
+
+
+placement = PanelPlacement(MARZBAN_PANELS, MARZBAN_PLACEMENT, MARZBAN_PLACEMENT_REFRESH)
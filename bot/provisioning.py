@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import random
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import select, update, func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import SessionLocal, ProvisioningTask, Subscription, User, subscription_is_live
+from bot.dispatcher import PRIORITY_HIGH, dispatcher
+from bot.marzban_api import create_user, update_user, delete_user
+from bot.metrics import Counter, Gauge
+from bot.qr import forget_qr
+from bot.scheduler import expiry_scheduler
+from bot.usage import forget_snapshots
+from config import (
+    PROVISIONING_WORKERS,
+    PROVISIONING_MAX_ATTEMPTS,
+    PROVISIONING_RETRY_BACKOFF,
+    PROVISIONING_LEASE,
+    PROVISIONING_POLL_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+PROVISIONING_QUEUE_DEPTH = Gauge("vpn_bot_provisioning_queue_depth", "Pending provisioning tasks")
+PROVISIONING_LATENCY = Gauge(
+    "vpn_bot_provisioning_latency_seconds", "Enqueue-to-done latency of recent provisioning tasks", ("quantile",)
+)
+PROVISIONING_TASKS = Counter("vpn_bot_provisioning_tasks_total", "Finished provisioning tasks", ("result",))
+
+# Tasks queued by bot.reconcile from a diff that may be stale by the time a
+# worker gets to them; see Provisioner._still_applies
+RECONCILE_ORIGIN = "reconcile"
+
+
+def _utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; they are stored in UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def enqueue(
+    session: AsyncSession,
+    kind: str,
+    marzban_username: str,
+    panel: Optional[str] = None,
+    subscription_id: Optional[int] = None,
+    data_limit: Optional[int] = None,
+    expire_at: Optional[int] = None,
+    notify_chat_id: Optional[int] = None,
+    origin: Optional[str] = None,
+) -> ProvisioningTask:
+    # Adds the task to the caller's transaction; call provisioner.wake() after commit
+    task = ProvisioningTask(
+        kind=kind,
+        marzban_username=marzban_username,
+        panel=panel,
+        subscription_id=subscription_id,
+        data_limit=data_limit,
+        expire_at=expire_at,
+        notify_chat_id=notify_chat_id,
+        origin=origin,
+    )
+    session.add(task)
+    return task
+
+
+class Provisioner:
+    # Pool of workers draining the provisioning outbox. A task is claimed by
+    # pushing its run_after forward by PROVISIONING_LEASE with a conditional
+    # UPDATE, so a task whose worker died becomes visible again once the lease
+    # runs out. Marzban operations are idempotent (409 on create falls back to
+    # update, 404 on delete counts as done), so re-running a task is safe.
+    def __init__(self, workers: int = PROVISIONING_WORKERS):
+        self.workers = workers
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self.processed = 0
+        self.failed = 0
+        self.latencies: deque[float] = deque(maxlen=1000)
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.debug("Started %s provisioning workers", self.workers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def queue_depth(self) -> int:
+        async with SessionLocal() as session:
+            return (
+                await session.execute(
+                    select(func.count()).select_from(ProvisioningTask).where(ProvisioningTask.status == "pending")
+                )
+            ).scalar_one()
+
+    def latency_percentiles(self) -> dict[str, float]:
+        if not self.latencies:
+            return {}
+        ordered = sorted(self.latencies)
+        return {
+            f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+            for p in (50, 95, 99)
+        }
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            try:
+                task = await self._claim()
+            except Exception:
+                logger.exception("Failed to claim provisioning task")
+                task = None
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), PROVISIONING_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._execute(task)
+            except Exception:
+                logger.exception("Provisioning task %s crashed, will retry after lease", task.id)
+
+    async def _claim(self) -> Optional[ProvisioningTask]:
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as session:
+            candidates = (
+                await session.execute(
+                    select(ProvisioningTask.id, ProvisioningTask.run_after)
+                    .where(
+                        and_(
+                            ProvisioningTask.status == "pending",
+                            ProvisioningTask.run_after <= now,
+                        )
+                    )
+                    .order_by(ProvisioningTask.run_after, ProvisioningTask.id)
+                    .limit(self.workers)
+                    .with_for_update(skip_locked=True)
+                )
+            ).all()
+            for task_id, run_after in candidates:
+                claimed = await session.execute(
+                    update(ProvisioningTask)
+                    .where(
+                        and_(
+                            ProvisioningTask.id == task_id,
+                            ProvisioningTask.status == "pending",
+                            ProvisioningTask.run_after == run_after,
+                        )
+                    )
+                    .values(
+                        run_after=now + timedelta(seconds=PROVISIONING_LEASE),
+                        attempts=ProvisioningTask.attempts + 1,
+                    )
+                )
+                if claimed.rowcount != 1:
+                    continue
+                task = await session.get(ProvisioningTask, task_id)
+                if task.origin == RECONCILE_ORIGIN and not await self._still_applies(session, task):
+                    task.status = "skipped"
+                    task.finished_at = now
+                    task.last_error = "no longer applies"
+                    PROVISIONING_TASKS.inc(result="skipped")
+                    logger.info(
+                        "Reconcile task %s (%s %s) dropped: the subscription changed since the diff",
+                        task.id, task.kind, task.marzban_username,
+                    )
+                    continue
+                await session.commit()
+                return task
+            await session.commit()
+        return None
+
+    async def _still_applies(self, session: AsyncSession, task: ProvisioningTask) -> bool:
+        # Re-checks a reconcile repair in the claiming transaction: the diff it
+        # came from may predate a trial, an import or an extend. A newer pending
+        # task for the user supersedes it; a delete needs the user to still have
+        # no live subscription, a create/update its subscription to still be
+        # active with the end_at it was computed from.
+        newer = await session.scalar(
+            select(ProvisioningTask.id)
+            .where(
+                ProvisioningTask.marzban_username == task.marzban_username,
+                ProvisioningTask.status == "pending",
+                ProvisioningTask.id > task.id,
+            )
+            .limit(1)
+        )
+        if newer is not None:
+            return False
+        if task.kind == "delete":
+            live = await session.scalar(
+                select(Subscription.id)
+                .join(User, User.id == Subscription.user_id)
+                .where(User.marzban_username == task.marzban_username, subscription_is_live())
+                .limit(1)
+            )
+            return live is None
+        sub = await session.get(Subscription, task.subscription_id) if task.subscription_id else None
+        return (
+            sub is not None
+            and sub.status == "active"
+            and int(_utc(sub.end_at).timestamp()) == task.expire_at
+        )
+
+    async def _run_operation(self, task: ProvisioningTask) -> bool:
+        if task.kind == "create":
+            return await create_user(
+                task.marzban_username, data_limit=task.data_limit, expire_at=task.expire_at, panel=task.panel
+            )
+        if task.kind == "update":
+            return await update_user(
+                task.marzban_username, data_limit=task.data_limit, expire_at=task.expire_at, panel=task.panel
+            )
+        if task.kind == "delete":
+            return await delete_user(task.marzban_username, panel=task.panel)
+        logger.error("Unknown provisioning task kind %r", task.kind)
+        return False
+
+    async def _execute(self, task: ProvisioningTask) -> None:
+        ok = await self._run_operation(task)
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as session:
+            task = await session.get(ProvisioningTask, task.id)
+            if task is None or task.status != "pending":
+                return
+            sub = await session.get(Subscription, task.subscription_id) if task.subscription_id else None
+
+            if ok:
+                task.status = "done"
+                task.finished_at = now
+                task.last_error = None
+                if sub is not None and sub.status == "pending" and task.kind in ("create", "update"):
+                    sub.status = "active"
+                # the subscription link, expiry and limit may have changed with the panel user
+                await forget_qr(session, task.marzban_username)
+                await forget_snapshots(session, [task.marzban_username], task.panel)
+                await session.commit()
+                self.processed += 1
+                PROVISIONING_TASKS.inc(result="done")
+                self.latencies.append((now - _utc(task.created_at)).total_seconds())
+                logger.info("Provisioning task %s (%s %s) done", task.id, task.kind, task.marzban_username)
+                if sub is not None and sub.status == "active":
+                    expiry_scheduler.schedule(sub.id, sub.end_at)
+                    await self._notify(task, "✅ Доступ активирован. Смотри /profile")
+                return
+
+            task.last_error = f"{task.kind} failed"
+            if task.attempts >= PROVISIONING_MAX_ATTEMPTS:
+                task.status = "failed"
+                task.finished_at = now
+                if sub is not None and sub.status == "pending":
+                    sub.status = "canceled"
+                await session.commit()
+                self.failed += 1
+                PROVISIONING_TASKS.inc(result="failed")
+                logger.error(
+                    "Provisioning task %s (%s %s) gave up after %s attempts",
+                    task.id, task.kind, task.marzban_username, task.attempts,
+                )
+                await self._notify(task, "Не удалось выдать доступ. Попробуй позже.")
+                return
+
+            delay = PROVISIONING_RETRY_BACKOFF * (2 ** (task.attempts - 1))
+            task.run_after = now + timedelta(seconds=delay + random.uniform(0, delay))
+            await session.commit()
+            logger.warning(
+                "Provisioning task %s failed (attempt %s), retrying in ~%.0fs", task.id, task.attempts, delay
+            )
+
+    async def _notify(self, task: ProvisioningTask, text: str) -> None:
+        # Queued ahead of reminders and broadcasts; delivery errors are the
+        # dispatcher's to handle and must not hold up the worker
+        if task.notify_chat_id is None:
+            return
+        dispatcher.submit(task.notify_chat_id, text, PRIORITY_HIGH)
+
+
+provisioner = Provisioner()
+
+
+async def report_provisioning_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    depth = await provisioner.queue_depth()
+    percentiles = provisioner.latency_percentiles()
+    PROVISIONING_QUEUE_DEPTH.set(depth)
+    for name, value in percentiles.items():
+        PROVISIONING_LATENCY.set(value, quantile=f"0.{name[1:]}")
+    if logger.isEnabledFor(logging.DEBUG):
+        latency = ", ".join(f"{k}={v:.2f}s" for k, v in percentiles.items()) or "n/a"
+        logger.debug(
+            "Provisioning queue depth=%s processed=%s failed=%s latency=%s",
+            depth, provisioner.processed, provisioner.failed, latency,
+        )
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import io
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import segno
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import SubscriptionQr
+from bot.metrics import Counter, Gauge
+from config import QR_CACHE_BYTES, QR_RENDER_WORKERS, QR_SCALE
+
+logger = logging.getLogger(__name__)
+
+QR_SENDS = Counter("vpn_bot_qr_sends_total", "Subscription QR images sent, by how", ("source",))
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def render_png(url: str, scale: int = QR_SCALE) -> bytes:
+    buffer = io.BytesIO()
+    segno.make(url, error="m").save(buffer, kind="png", scale=scale, border=2)
+    return buffer.getvalue()
+
+
+class QrCache:
+    # Rendered PNGs by URL hash, least recently used evicted once they take
+    # more than `max_bytes`. Rendering runs in a small thread pool so it never
+    # holds up the event loop; concurrent requests for one URL share a render.
+    # Keys are content hashes, so a changed URL simply misses and the old
+    # image ages out; invalidate() only frees the memory sooner.
+    def __init__(self, max_bytes: int = QR_CACHE_BYTES, workers: int = QR_RENDER_WORKERS):
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.size = 0
+        self.hits = 0
+        self.renders = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, url: str) -> bytes:
+        key = url_hash(url)
+        png = self._entries.get(key)
+        if png is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return png
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._inflight[key] = asyncio.ensure_future(self._render(key, url))
+        return await asyncio.shield(fut)
+
+    def invalidate(self, url: str) -> None:
+        key = url_hash(url)
+        png = self._entries.pop(key, None)
+        if png is not None:
+            self.size -= len(png)
+        # A render started before the invalidation must not repopulate
+        self._inflight.pop(key, None)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _render(self, key: str, url: str) -> bytes:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="qr")
+        task = asyncio.current_task()
+        try:
+            png = await asyncio.get_running_loop().run_in_executor(self._executor, render_png, url)
+        finally:
+            current = self._inflight.get(key) is task
+            if current:
+                del self._inflight[key]
+        self.renders += 1
+        if current:
+            self._store(key, png)
+        return png
+
+    def _store(self, key: str, png: bytes) -> None:
+        if len(png) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+qr_cache = QrCache()
+
+QR_CACHE_SIZE = Gauge(
+    "vpn_bot_qr_cache_bytes", "Bytes of rendered QR images held in memory",
+    callback=lambda: qr_cache.size,
+)
+QR_RENDERS = Counter(
+    "vpn_bot_qr_renders_total", "QR image requests by result", ("result",),
+    callback=lambda: {("hit",): qr_cache.hits, ("render",): qr_cache.renders},
+)
+
+
+async def forget_qr(session: AsyncSession, marzban_username: str) -> None:
+    # Drops the user's stored file_id in the caller's transaction, so the next
+    # /profile renders and uploads the (possibly new) link again
+    stored = await session.get(SubscriptionQr, marzban_username)
+    if stored is not None:
+        qr_cache.invalidate(stored.subscription_url)
+        await session.delete(stored)
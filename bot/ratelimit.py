@@ -0,0 +1,36 @@
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    # `rate` tokens per second, bursting up to `capacity`
+    __slots__ = ("rate", "capacity", "_tokens", "_updated")
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def wait_time(self, now: Optional[float] = None) -> float:
+        # Seconds until a token is available (0 if one is), without taking it
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return 0.0 if self._tokens >= 1.0 else (1.0 - self._tokens) / self.rate
+
+    def consume(self, now: Optional[float] = None) -> float:
+        # Takes a token and returns 0, or returns the wait_time() if there is none
+        wait = self.wait_time(now)
+        if wait == 0.0:
+            self._tokens -= 1.0
+        return wait
+
+    def is_full(self, now: Optional[float] = None) -> bool:
+        # A full bucket carries no state worth keeping
+        self._refill(time.monotonic() if now is None else now)
+        return self._tokens >= self.capacity
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timezone
+from typing import Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import select
+from db.models import ProvisioningTask, SessionLocal, Subscription, User, subscription_is_live
+from bot.marzban_api import MarzbanUser, clients, list_users
+from bot.metrics import Gauge
+from bot.provisioning import RECONCILE_ORIGIN, enqueue, provisioner
+from bot.ratelimit import TokenBucket
+from config import (
+    MARZBAN_DEFAULT_PANEL,
+    RECONCILE_PAGE_SIZE,
+    RECONCILE_BATCH_SIZE,
+    RECONCILE_RATE,
+    RECONCILE_MAX_DELETES,
+    RECONCILE_EXPIRE_TOLERANCE,
+    RECONCILE_DRY_RUN,
+)
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_DRIFT = Gauge(
+    "vpn_bot_reconcile_drift", "Panel users out of line with the database at the last reconciliation", ("panel", "kind")
+)
+
+
+@dataclass(slots=True)
+class Expected:
+    # What the panel should hold for a user with an active subscription
+    subscription_id: int
+    expire: int
+    data_limit: Optional[int]
+
+
+@dataclass
+class LocalState:
+    active: dict[str, dict[str, Expected]] = field(default_factory=dict)  # panel -> username -> expected
+    known: set[str] = field(default_factory=set)  # every local marzban username
+    in_flight: set[str] = field(default_factory=set)  # pending subscription or provisioning task
+
+
+@dataclass
+class ReconcileReport:
+    panel: str
+    remote: int = 0
+    active: int = 0
+    missing: list[str] = field(default_factory=list)  # active here, absent on the panel
+    orphans: list[str] = field(default_factory=list)  # on the panel, no active subscription here
+    mismatched: list[str] = field(default_factory=list)  # expire or data limit differ
+    unknown: list[str] = field(default_factory=list)  # on the panel, no local user: reported only
+    skipped: int = 0  # in flight, left to the provisioning workers
+    queued: int = 0
+    deletes_refused: bool = False
+    failed: bool = False
+    elapsed: float = 0.0
+
+
+async def load_local_state(page_size: int = RECONCILE_PAGE_SIZE) -> LocalState:
+    # Walks users by id, a page at a time, with their live subscriptions and
+    # the data limit last pushed for each active one: three queries per page
+    state = LocalState()
+    cursor = 0
+    async with SessionLocal() as session:
+        while True:
+            users = (
+                await session.execute(
+                    select(User.id, User.marzban_username, User.panel)
+                    .where(User.id > cursor)
+                    .order_by(User.id)
+                    .limit(page_size)
+                )
+            ).all()
+            if not users:
+                break
+            cursor = users[-1].id
+            by_id = {user.id: user for user in users}
+            state.known.update(user.marzban_username for user in users)
+
+            subs = (
+                await session.execute(
+                    select(Subscription.id, Subscription.user_id, Subscription.status, Subscription.end_at).where(
+                        Subscription.user_id.in_(list(by_id)), subscription_is_live()
+                    )
+                )
+            ).all()
+            active = [sub for sub in subs if sub.status == "active"]
+            limits: dict[int, int] = {}
+            if active:
+                # ordered by id, so the last task pushed wins
+                for subscription_id, data_limit in await session.execute(
+                    select(ProvisioningTask.subscription_id, ProvisioningTask.data_limit)
+                    .where(
+                        ProvisioningTask.subscription_id.in_([sub.id for sub in active]),
+                        ProvisioningTask.status == "done",
+                        ProvisioningTask.kind.in_(("create", "update")),
+                        ProvisioningTask.data_limit.is_not(None),
+                    )
+                    .order_by(ProvisioningTask.id)
+                ):
+                    limits[subscription_id] = data_limit
+
+            for sub in subs:
+                user = by_id[sub.user_id]
+                if sub.status != "active":
+                    state.in_flight.add(user.marzban_username)
+                    continue
+                end_at = sub.end_at if sub.end_at.tzinfo else sub.end_at.replace(tzinfo=timezone.utc)
+                expected = state.active.setdefault(user.panel or MARZBAN_DEFAULT_PANEL, {})
+                current = expected.get(user.marzban_username)
+                # several active subscriptions: the panel should follow the latest
+                if current is None or int(end_at.timestamp()) > current.expire:
+                    expected[user.marzban_username] = Expected(sub.id, int(end_at.timestamp()), limits.get(sub.id))
+            if len(users) < page_size:
+                break
+
+        state.in_flight.update(
+            await session.scalars(
+                select(ProvisioningTask.marzban_username).where(ProvisioningTask.status == "pending").distinct()
+            )
+        )
+    return state
+
+
+async def load_panel_users(panel: str, page_size: int = RECONCILE_PAGE_SIZE) -> Optional[dict[str, MarzbanUser]]:
+    # The panel's whole user list, a page at a time (each page is decoded as
+    # it streams in). None if any page fails: a partial list would make every
+    # user on the missing pages look missing.
+    users: dict[str, MarzbanUser] = {}
+    offset = 0
+    while True:
+        page = await list_users(offset=offset, limit=page_size, panel=panel)
+        if page is None:
+            return None
+        batch, total = page
+        users.update((user.username, user) for user in batch if user.username)
+        offset += len(batch)
+        if not batch or len(batch) < page_size or offset >= total:
+            return users
+
+
+def _differs(remote: MarzbanUser, expected: Expected) -> bool:
+    if not remote.expire or abs(remote.expire - expected.expire) > RECONCILE_EXPIRE_TOLERANCE:
+        return True
+    return expected.data_limit is not None and remote.data_limit != expected.data_limit
+
+
+def diff_panel(panel: str, remote: dict[str, MarzbanUser], state: LocalState) -> ReconcileReport:
+    report = ReconcileReport(panel, remote=len(remote))
+    expected = state.active.get(panel, {})
+    report.active = len(expected)
+    remote_names = remote.keys()
+    local_names = expected.keys()
+    in_flight = state.in_flight
+
+    report.missing = sorted(local_names - remote_names - in_flight)
+    # a user active on another panel is an orphan here too
+    report.orphans = sorted((remote_names & state.known) - local_names - in_flight)
+    report.unknown = sorted(remote_names - state.known)
+    report.mismatched = sorted(
+        name for name in (local_names & remote_names) - in_flight if _differs(remote[name], expected[name])
+    )
+    report.skipped = len((local_names | (remote_names & state.known)) & in_flight)
+    return report
+
+
+async def _queue_repairs(report: ReconcileReport, state: LocalState, batch_size: int, rate: float) -> None:
+    # Writes the repairs to the provisioning outbox in small transactions,
+    # paced by a token bucket so the workers (and the panel) see a steady
+    # trickle rather than thousands of tasks at once
+    expected = state.active.get(report.panel, {})
+    repairs: list[tuple[str, str]] = [("create", name) for name in report.missing]
+    repairs += [("update", name) for name in report.mismatched]
+    if len(report.orphans) > RECONCILE_MAX_DELETES:
+        report.deletes_refused = True
+        logger.error(
+            "Reconciliation of %s would delete %s panel users (limit %s); deleting none, check the database",
+            report.panel, len(report.orphans), RECONCILE_MAX_DELETES,
+        )
+    else:
+        repairs += [("delete", name) for name in report.orphans]
+
+    bucket = TokenBucket(rate, capacity=batch_size)
+    for start in range(0, len(repairs), batch_size):
+        batch = repairs[start:start + batch_size]
+        for _ in batch:
+            while (wait := bucket.consume()) > 0:
+                await asyncio.sleep(wait)
+        async with SessionLocal() as session:
+            for kind, name in batch:
+                if kind == "delete":
+                    enqueue(session, kind, name, panel=report.panel, origin=RECONCILE_ORIGIN)
+                    continue
+                target = expected[name]
+                enqueue(
+                    session,
+                    kind,
+                    name,
+                    panel=report.panel,
+                    subscription_id=target.subscription_id,
+                    data_limit=target.data_limit,
+                    expire_at=target.expire,
+                    origin=RECONCILE_ORIGIN,
+                )
+            await session.commit()
+        report.queued += len(batch)
+        provisioner.wake()
+
+
+async def reconcile_panels(
+    dry_run: bool = RECONCILE_DRY_RUN,
+    panels: Optional[list[str]] = None,
+    batch_size: int = RECONCILE_BATCH_SIZE,
+    rate: float = RECONCILE_RATE,
+) -> list[ReconcileReport]:
+    # One paged listing per panel (panels listed in parallel), then one pass
+    # over the local users, diffed as sets of usernames: no per-user requests.
+    # The panels are listed first so that any panel user seen was created
+    # before the local state was read: a user provisioned in between is
+    # absent from the listing, never an orphan. Repairs are provisioning
+    # tasks marked origin="reconcile", which the workers re-check when they
+    # claim them (see Provisioner._still_applies).
+    started = time.monotonic()
+    panels = panels or list(clients)
+    listings = await asyncio.gather(*(load_panel_users(panel) for panel in panels))
+    state = await load_local_state()
+    reports = []
+    for panel, remote in zip(panels, listings):
+        if remote is None:
+            logger.warning("Reconciliation of %s skipped: the user list could not be read", panel)
+            reports.append(ReconcileReport(panel, failed=True))
+            continue
+        report = diff_panel(panel, remote, state)
+        for kind in ("missing", "orphans", "mismatched", "unknown"):
+            RECONCILE_DRIFT.set(len(getattr(report, kind)), panel=panel, kind=kind)
+        if not dry_run:
+            await _queue_repairs(report, state, batch_size, rate)
+        report.elapsed = time.monotonic() - started
+        reports.append(report)
+    return reports
+
+
+def format_report(report: ReconcileReport, sample: int = 5) -> str:
+    if report.failed:
+        return f"{report.panel}: user list unavailable, nothing compared"
+    parts = [f"{report.panel}: {report.remote} on the panel, {report.active} active locally"]
+    for kind in ("missing", "orphans", "mismatched", "unknown"):
+        names = getattr(report, kind)
+        if names:
+            shown = ", ".join(names[:sample]) + (", ..." if len(names) > sample else "")
+            parts.append(f"{len(names)} {kind} ({shown})")
+    parts.append(f"{report.skipped} in flight, {report.queued} repairs queued")
+    if report.deletes_refused:
+        parts.append("deletes refused (over RECONCILE_MAX_DELETES)")
+    return "; ".join(parts)
+
+
+async def reconcile_marzban(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for report in await reconcile_panels():
+        if report.failed or report.missing or report.orphans or report.mismatched or report.unknown:
+            logger.info("Reconciliation%s: %s", " (dry run)" if RECONCILE_DRY_RUN else "", format_report(report))
+        else:
+            logger.debug("Reconciliation: %s in sync (%s users)", report.panel, report.remote)
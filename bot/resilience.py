@@ -0,0 +1,100 @@
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RetryBudget:
+    # Caps retries to a fraction of recent traffic: every request deposits
+    # `ratio` tokens (up to `capacity`) and every retry spends one, so a
+    # degraded upstream sees at most ~(1 + ratio)x its normal load.
+    def __init__(self, ratio: float = 0.2, capacity: float = 10.0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = capacity
+
+    def deposit(self) -> None:
+        self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return True
+        return False
+
+    @property
+    def available(self) -> float:
+        return self._tokens
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 5.0) -> float:
+    # "full jitter" exponential backoff
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # Opens after `threshold` consecutive failures and rejects calls for
+    # `reset_timeout` seconds; then lets a single probe through (half-open) and
+    # closes again on its success.
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_inflight = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probe_inflight:
+            self._probe_inflight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        if self._state != self.CLOSED:
+            logger.info("Circuit %s closed", self.name)
+        self._state = self.CLOSED
+        self._failures = 0
+        self._probe_inflight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probe_inflight or self._failures >= self.threshold:
+            if self._state != self.OPEN or self._probe_inflight:
+                logger.warning("Circuit %s opened after %s consecutive failures", self.name, self._failures)
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+        self._probe_inflight = False
+
+    def release_probe(self) -> None:
+        # A probe that ended without a verdict (e.g. cancelled) must not block the next one
+        self._probe_inflight = False
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import select, and_
+from db.models import SessionLocal, Subscription, subscription_is_active
+from bot.jobs import cleanup_expired, revoke_subscription
+from bot.metrics import Gauge
+from config import CLEANUP_CONCURRENCY, EXPIRY_RETRY_BACKOFF, EXPIRY_RETRY_MAX, EXPIRY_SCHEDULER_HORIZON
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(value: datetime) -> float:
+    # SQLite hands back naive datetimes; they are stored in UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class ExpiryScheduler:
+    # Min-heap of (deadline, subscription_id) that revokes access exactly at
+    # Subscription.end_at. Rescheduling a subscription pushes a new entry and
+    # leaves the old one in the heap; it is skipped when popped because
+    # _deadlines only remembers the latest deadline per subscription.
+    def __init__(self, horizon: int = EXPIRY_SCHEDULER_HORIZON, concurrency: int = CLEANUP_CONCURRENCY):
+        self.horizon = horizon
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, float] = {}
+        self._failures: dict[int, int] = {}  # consecutive failed revocations
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, subscription_id: int, end_at: datetime) -> None:
+        deadline = _timestamp(end_at)
+        if deadline > datetime.now(timezone.utc).timestamp() + self.horizon:
+            # Too far out; a later reload() will pick it up
+            self._deadlines.pop(subscription_id, None)
+            return
+        if self._deadlines.get(subscription_id) == deadline:
+            return
+        self._deadlines[subscription_id] = deadline
+        heapq.heappush(self._heap, (deadline, subscription_id))
+        if self._heap[0] == (deadline, subscription_id):
+            self._wakeup.set()
+
+    def cancel(self, subscription_id: int) -> None:
+        self._deadlines.pop(subscription_id, None)
+        self._failures.pop(subscription_id, None)
+
+    async def reload(self) -> int:
+        now = datetime.now(timezone.utc)
+        async with SessionLocal() as session:
+            result = await session.execute(
+                select(Subscription.id, Subscription.end_at).where(
+                    and_(
+                        subscription_is_active(),
+                        Subscription.end_at >= now,
+                        Subscription.end_at < now + timedelta(seconds=self.horizon),
+                    )
+                )
+            )
+            rows = result.all()
+        for subscription_id, end_at in rows:
+            self.schedule(subscription_id, end_at)
+        logger.debug("Expiry scheduler loaded %s upcoming deadlines (%s tracked)", len(rows), len(self))
+        return len(rows)
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        await self.reload()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._inflight):
+            task.cancel()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = datetime.now(timezone.utc).timestamp()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, subscription_id = heapq.heappop(self._heap)
+                if self._deadlines.get(subscription_id) != deadline:
+                    continue  # superseded or cancelled
+                del self._deadlines[subscription_id]
+                task = loop.create_task(self._fire(subscription_id))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, subscription_id: int) -> None:
+        async with self._semaphore:
+            try:
+                if await revoke_subscription(subscription_id):
+                    self._failures.pop(subscription_id, None)
+                    return
+                logger.warning("Revocation of subscription %s failed", subscription_id)
+            except Exception:
+                logger.exception("Error revoking subscription %s", subscription_id)
+        self._retry(subscription_id)
+
+    def _retry(self, subscription_id: int) -> None:
+        # Bounded exponential backoff, retried until the revocation goes through
+        failures = self._failures.get(subscription_id, 0)
+        self._failures[subscription_id] = failures + 1
+        delay = min(EXPIRY_RETRY_BACKOFF * 2 ** min(failures, 16), EXPIRY_RETRY_MAX)
+        logger.info("Retrying revocation of subscription %s in %.0fs", subscription_id, delay)
+        self.schedule(subscription_id, datetime.now(timezone.utc) + timedelta(seconds=delay))
+
+
+expiry_scheduler = ExpiryScheduler()
+
+Gauge(
+    "vpn_bot_expiry_scheduler_tracked",
+    "Subscriptions tracked by the expiry scheduler",
+    callback=lambda: len(expiry_scheduler),
+)
+
+
+async def reconcile_expired(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Safety net: catch anything the in-memory scheduler missed (restarts,
+    # failed revocations, rows changed outside the bot) and refill the horizon
+    await cleanup_expired(context)
+    await expiry_scheduler.reload()
@@ -0,0 +1,87 @@
+import time
+from telegram import Update
+from bot.dispatcher import PRIORITY_HIGH, dispatcher
+from bot.metrics import Counter, Gauge
+from bot.ratelimit import TokenBucket
+from config import THROTTLE_RATE, THROTTLE_BURST, THROTTLE_NOTICE_INTERVAL
+
+THROTTLED_UPDATES = Counter(
+    "vpn_bot_throttled_updates_total", "Updates dropped by the per-user flood limit", ("action",)
+)
+
+# Users whose bucket is full again (idle for BURST / RATE seconds) are forgotten
+_SWEEP_INTERVAL = 60.0
+
+
+class _UserState:
+    __slots__ = ("bucket", "quiet_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, capacity=burst)
+        self.quiet_until = 0.0
+
+
+class UpdateThrottle:
+    # Per-user token buckets checked by PerUserUpdateProcessor as an update
+    # arrives, before it waits on the user's lock or a processing slot. An
+    # update over the limit is never processed; the first one in a notice
+    # interval gets a "slow down" reply, the rest are dropped silently. Only
+    # users seen within the last BURST / RATE seconds (or still in a notice
+    # interval) are tracked.
+    def __init__(
+        self,
+        rate: float = THROTTLE_RATE,
+        burst: float = THROTTLE_BURST,
+        notice_interval: float = THROTTLE_NOTICE_INTERVAL,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.notice_interval = notice_interval
+        self._users: dict[int, _UserState] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def allow(self, user_id: int, now: float) -> bool:
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(self.rate, self.burst)
+        return state.bucket.consume(now) == 0.0
+
+    def should_notify(self, user_id: int, now: float) -> bool:
+        state = self._users[user_id]
+        if now < state.quiet_until:
+            return False
+        state.quiet_until = now + self.notice_interval
+        return True
+
+    def sweep(self, now: float) -> None:
+        if now - self._last_sweep < _SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        idle = [
+            user_id for user_id, state in self._users.items()
+            if now >= state.quiet_until and state.bucket.is_full(now)
+        ]
+        for user_id in idle:
+            del self._users[user_id]
+
+    def admit(self, update: Update) -> bool:
+        user = update.effective_user
+        if user is None:
+            return True
+        now = time.monotonic()
+        self.sweep(now)
+        if self.allow(user.id, now):
+            return True
+        if update.effective_chat is not None and self.should_notify(user.id, now):
+            THROTTLED_UPDATES.inc(action="notified")
+            dispatcher.submit(update.effective_chat.id, "Слишком много запросов, подожди немного.", PRIORITY_HIGH)
+        else:
+            THROTTLED_UPDATES.inc(action="dropped")
+        return False
+
+
+throttle = UpdateThrottle()
+THROTTLED_USERS = Gauge("vpn_bot_throttle_tracked_users", "Users with live flood-limit state", callback=lambda: len(throttle))
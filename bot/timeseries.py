@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import SessionLocal, UsageSeries, engine
+from config import (
+    USAGE_MINUTE_DAYS,
+    USAGE_HOUR_DAYS,
+    USAGE_RETENTION_DAYS,
+    USAGE_ROLLUP_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+MINUTE, HOUR, DAY = "minute", "hour", "day"
+_BATCH_PAUSE = 0.1
+
+
+@dataclass
+class RollupStats:
+    hours: int = 0  # minute rows folded into hour rows
+    days: int = 0  # hour rows folded into day rows
+    expired: int = 0
+    elapsed: float = 0.0
+
+
+def pack(points: Iterable[tuple[int, int]]) -> bytes:
+    # (slot, bytes) pairs as unsigned LEB128 varints: a sample is 3-6 bytes,
+    # and appending one is a plain concatenation
+    out = bytearray()
+    for pair in points:
+        for n in pair:
+            while n >= 0x80:
+                out.append(n & 0x7F | 0x80)
+                n >>= 7
+            out.append(n)
+    return bytes(out)
+
+
+def unpack(blob: bytes) -> list[tuple[int, int]]:
+    numbers = []
+    n = shift = 0
+    for byte in blob:
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            numbers.append(n)
+            n = shift = 0
+    return list(zip(numbers[::2], numbers[1::2]))
+
+
+def usage_deltas(rows: list[dict], previous: dict[str, int]) -> dict[str, int]:
+    # Traffic since the last sync for users seen before; a counter that went
+    # down was reset on the panel, so everything it shows now is new
+    deltas = {}
+    for row in rows:
+        before = previous.get(row["marzban_username"])
+        if before is None:
+            continue
+        used = row["used_traffic"]
+        delta = used - before if used >= before else used
+        if delta > 0:
+            deltas[row["marzban_username"]] = delta
+    return deltas
+
+
+def _insert():
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(UsageSeries)
+    return sqlite.insert(UsageSeries)
+
+
+def _upsert_points():
+    # Executed with a list of rows (executemany), points already merged
+    stmt = _insert()
+    return stmt.on_conflict_do_update(
+        index_elements=[UsageSeries.marzban_username, UsageSeries.period, UsageSeries.resolution],
+        set_={"points": stmt.excluded.points, "updated_at": stmt.excluded.updated_at},
+    )
+
+
+async def record_usage(session: AsyncSession, deltas: dict[str, int], at: datetime) -> None:
+    # Appends one sample per user to today's minute row, in the caller's
+    # transaction: one SELECT of the rows and one executemany upsert
+    if not deltas:
+        return
+    period = at.date()
+    sample = (at.hour * 60 + at.minute,)
+    existing = dict(
+        (
+            await session.execute(
+                select(UsageSeries.marzban_username, UsageSeries.points).where(
+                    UsageSeries.resolution == MINUTE,
+                    UsageSeries.period == period,
+                    UsageSeries.marzban_username.in_(list(deltas)),
+                )
+            )
+        ).all()
+    )
+    await session.execute(
+        _upsert_points(),
+        [
+            {
+                "marzban_username": username,
+                "period": period,
+                "resolution": MINUTE,
+                "points": existing.get(username, b"") + pack([sample + (delta,)]),
+                "updated_at": at,
+            }
+            for username, delta in deltas.items()
+        ],
+    )
+
+
+def _month(day: date) -> date:
+    return day.replace(day=1)
+
+
+# source resolution -> (target resolution, target period, target slot)
+_ROLLUPS = {
+    MINUTE: (HOUR, lambda period: period, lambda period, slot: slot // 60),
+    HOUR: (DAY, _month, lambda period, slot: period.day - 1),
+}
+
+
+async def rollup_batch(resolution: str, before: date, batch_size: int) -> int:
+    # Folds up to `batch_size` rows of `resolution` with period < `before`
+    # into the next coarser resolution and deletes them, in one transaction
+    target, target_period, target_slot = _ROLLUPS[resolution]
+    now = datetime.now(timezone.utc)
+    async with SessionLocal() as session:
+        rows = (
+            await session.execute(
+                select(UsageSeries.marzban_username, UsageSeries.period, UsageSeries.points)
+                .where(UsageSeries.resolution == resolution, UsageSeries.period < before)
+                .order_by(UsageSeries.period, UsageSeries.marzban_username)
+                .limit(batch_size)
+            )
+        ).all()
+        if not rows:
+            return 0
+
+        merged: dict[tuple[str, date], dict[int, int]] = {}
+        for username, period, points in rows:
+            slots = merged.setdefault((username, target_period(period)), {})
+            for slot, value in unpack(points):
+                slot = target_slot(period, slot)
+                slots[slot] = slots.get(slot, 0) + value
+        existing = (
+            await session.execute(
+                select(UsageSeries.marzban_username, UsageSeries.period, UsageSeries.points).where(
+                    UsageSeries.resolution == target,
+                    tuple_(UsageSeries.marzban_username, UsageSeries.period).in_(list(merged)),
+                )
+            )
+        ).all()
+        for username, period, points in existing:
+            slots = merged[(username, period)]
+            for slot, value in unpack(points):
+                slots[slot] = slots.get(slot, 0) + value
+
+        await session.execute(
+            _upsert_points(),
+            [
+                {
+                    "marzban_username": username,
+                    "period": period,
+                    "resolution": target,
+                    "points": pack(sorted(slots.items())),
+                    "updated_at": now,
+                }
+                for (username, period), slots in merged.items()
+            ],
+        )
+        await session.execute(
+            delete(UsageSeries).where(
+                UsageSeries.resolution == resolution,
+                tuple_(UsageSeries.marzban_username, UsageSeries.period).in_(
+                    [(username, period) for username, period, _ in rows]
+                ),
+            )
+        )
+        await session.commit()
+    return len(rows)
+
+
+async def rollup_series(today: Optional[date] = None, batch_size: int = USAGE_ROLLUP_BATCH_SIZE) -> RollupStats:
+    today = today or datetime.now(timezone.utc).date()
+    started = time.monotonic()
+    stats = RollupStats()
+    for resolution, keep_days in ((MINUTE, USAGE_MINUTE_DAYS), (HOUR, USAGE_HOUR_DAYS)):
+        before = today - timedelta(days=keep_days - 1)
+        while True:
+            rolled = await rollup_batch(resolution, before, batch_size)
+            if resolution == MINUTE:
+                stats.hours += rolled
+            else:
+                stats.days += rolled
+            if rolled < batch_size:
+                break
+            # let the bot's own writes in between batches
+            await asyncio.sleep(_BATCH_PAUSE)
+
+    async with SessionLocal() as session:
+        stats.expired = (
+            await session.execute(
+                delete(UsageSeries).where(
+                    UsageSeries.resolution == DAY,
+                    UsageSeries.period < _month(today - timedelta(days=USAGE_RETENTION_DAYS)),
+                )
+            )
+        ).rowcount
+        await session.commit()
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def daily_usage(
+    session: AsyncSession, marzban_username: str, days: int, today: Optional[date] = None
+) -> list[tuple[date, int, Optional[list[int]]]]:
+    # (day, bytes, bytes per hour or None once rolled up to days) for the
+    # last `days` days, oldest first; one query over the user's few rows
+    today = today or datetime.now(timezone.utc).date()
+    first = today - timedelta(days=days - 1)
+    totals = {first + timedelta(days=i): 0 for i in range(days)}
+    hours: dict[date, list[int]] = {}
+    rows = await session.execute(
+        select(UsageSeries.period, UsageSeries.resolution, UsageSeries.points).where(
+            UsageSeries.marzban_username == marzban_username,
+            UsageSeries.period >= _month(first),
+        )
+    )
+    for period, resolution, points in rows:
+        if resolution == DAY:
+            for slot, value in unpack(points):
+                day = period + timedelta(days=slot)
+                if day in totals:
+                    totals[day] += value
+            continue
+        if period not in totals:
+            continue
+        per_hour = 60 if resolution == MINUTE else 1
+        bucket = hours.setdefault(period, [0] * 24)
+        for slot, value in unpack(points):
+            bucket[slot // per_hour] += value
+            totals[period] += value
+    return [(day, totals[day], hours.get(day)) for day in totals]
+
+
+async def rollup_usage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await rollup_series()
+    if stats.hours or stats.days or stats.expired:
+        logger.info(
+            "Usage series rolled up: %s minute rows to hours, %s hour rows to days, %s expired (%.1fs)",
+            stats.hours, stats.days, stats.expired, stats.elapsed,
+        )
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+from telegram.ext import ContextTypes
+from sqlalchemy import case, delete, func, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.models import SessionLocal, UsageSnapshot, engine
+from bot.marzban_api import MarzbanUser, clients, list_users
+from bot.timeseries import record_usage, usage_deltas
+from config import MARZBAN_DEFAULT_PANEL, USAGE_SYNC_INTERVAL, USAGE_SYNC_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Snapshots older than this are not trusted by /profile (sync is failing)
+SNAPSHOT_MAX_AGE = 3 * USAGE_SYNC_INTERVAL
+
+
+@dataclass
+class SyncStats:
+    seen: int = 0
+    changed: int = 0
+    removed: int = 0
+    pages: int = 0
+    elapsed: float = 0.0
+
+
+def _insert():
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(UsageSnapshot)
+    return sqlite.insert(UsageSnapshot)
+
+
+def _snapshot_row(user: MarzbanUser, panel: str, synced_at: datetime) -> Optional[dict]:
+    if not user.username:
+        return None
+    return {
+        "marzban_username": user.username,
+        "panel": panel,
+        "status": user.status,
+        "used_traffic": user.used_traffic,
+        "data_limit": user.data_limit,
+        "expire": user.expire,
+        "synced_at": synced_at,
+        "updated_at": synced_at,
+    }
+
+
+def _upsert_statement(rows: list[dict], listed_at: datetime):
+    stmt = _insert().values(rows)
+    excluded = stmt.excluded
+    changed = or_(
+        UsageSnapshot.used_traffic != excluded.used_traffic,
+        UsageSnapshot.status.is_distinct_from(excluded.status),
+        UsageSnapshot.data_limit.is_distinct_from(excluded.data_limit),
+        UsageSnapshot.expire.is_distinct_from(excluded.expire),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UsageSnapshot.panel, UsageSnapshot.marzban_username],
+        set_={
+            "status": excluded.status,
+            "used_traffic": excluded.used_traffic,
+            "data_limit": excluded.data_limit,
+            "expire": excluded.expire,
+            "synced_at": excluded.synced_at,
+            "updated_at": case((changed, excluded.updated_at), else_=UsageSnapshot.updated_at),
+            # a change marked after the page was requested may not be in it
+            "stale_at": case((UsageSnapshot.stale_at > listed_at, UsageSnapshot.stale_at), else_=None),
+        },
+    )
+
+
+async def sync_usage_snapshots(
+    panel: str = MARZBAN_DEFAULT_PANEL, page_size: int = USAGE_SYNC_PAGE_SIZE
+) -> Optional[SyncStats]:
+    # Pages through the panel's GET /api/users and upserts each page with one
+    # multi-row statement, recording the traffic since the last sync in the
+    # usage series. Returns None if the listing could not be read completely.
+    synced_at = datetime.now(timezone.utc)
+    started = time.monotonic()
+    stats = SyncStats()
+    offset = 0
+
+    async with SessionLocal() as session:
+        while True:
+            listed_at = datetime.now(timezone.utc)
+            page = await list_users(offset=offset, limit=page_size, panel=panel)
+            if page is None:
+                logger.warning("Usage sync of %s aborted at offset %s; stale rows kept", panel, offset)
+                return None
+            users, total = page
+            rows = [row for row in (_snapshot_row(u, panel, synced_at) for u in users) if row is not None]
+            if rows:
+                previous = dict(
+                    (
+                        await session.execute(
+                            select(UsageSnapshot.marzban_username, UsageSnapshot.used_traffic).where(
+                                UsageSnapshot.panel == panel,
+                                UsageSnapshot.marzban_username.in_([row["marzban_username"] for row in rows]),
+                            )
+                        )
+                    ).all()
+                )
+                await session.execute(_upsert_statement(rows, listed_at))
+                await record_usage(session, usage_deltas(rows, previous), synced_at)
+                await session.commit()
+            stats.pages += 1
+            stats.seen += len(rows)
+            offset += len(users)
+            if not users or len(users) < page_size or offset >= total:
+                break
+
+        # Only after a complete listing: forget users that are gone from the panel.
+        # synced_at is only ever set by a listing, so a row marked stale
+        # meanwhile but still on the panel is not among these.
+        stats.removed = (
+            await session.execute(
+                delete(UsageSnapshot).where(UsageSnapshot.panel == panel, UsageSnapshot.synced_at < synced_at)
+            )
+        ).rowcount
+        stats.changed = (
+            await session.execute(
+                select(func.count())
+                .select_from(UsageSnapshot)
+                .where(UsageSnapshot.panel == panel, UsageSnapshot.updated_at == synced_at)
+            )
+        ).scalar_one()
+        await session.commit()
+
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+async def forget_snapshots(
+    session: AsyncSession, marzban_usernames: list[str], panel: Optional[str] = None
+) -> None:
+    # Marks the users' snapshots stale in the caller's transaction after a
+    # change on the panel, so /profile asks the panel until a sync listed
+    # after the change refreshes them. The rows are kept: their used_traffic
+    # is the baseline of the next usage delta.
+    if not marzban_usernames:
+        return
+    await session.execute(
+        update(UsageSnapshot)
+        .where(
+            UsageSnapshot.panel == (panel or MARZBAN_DEFAULT_PANEL),
+            UsageSnapshot.marzban_username.in_(marzban_usernames),
+        )
+        .values(stale_at=datetime.now(timezone.utc))
+    )
+
+
+async def get_snapshot(session, marzban_username: str, panel: Optional[str] = None) -> Optional[UsageSnapshot]:
+    snapshot = await session.get(UsageSnapshot, (panel or MARZBAN_DEFAULT_PANEL, marzban_username))
+    if snapshot is None or snapshot.stale_at is not None:
+        return None
+    synced_at = snapshot.synced_at
+    if synced_at.tzinfo is None:
+        synced_at = synced_at.replace(tzinfo=timezone.utc)
+    if (datetime.now(timezone.utc) - synced_at).total_seconds() > SNAPSHOT_MAX_AGE:
+        return None
+    return snapshot
+
+
+async def sync_usage(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Panels are listed in parallel; a failing panel keeps its old snapshots
+    # without holding back the others
+    panels = list(clients)
+    results = await asyncio.gather(*(sync_usage_snapshots(panel) for panel in panels))
+    for panel, stats in zip(panels, results):
+        if stats is None:
+            continue
+        logger.info(
+            "Usage snapshots synced from %s: %s users, %s changed, %s removed, %s pages in %.2fs",
+            panel, stats.seen, stats.changed, stats.removed, stats.pages, stats.elapsed,
+        )
@@ -0,0 +1,152 @@
+import asyncio
+import hmac
+import logging
+import signal
+from typing import Optional
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from bot.metrics import Counter, Gauge
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_INFLIGHT,
+    WEBHOOK_MAX_CONNECTIONS,
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+WEBHOOK_REQUESTS = Counter("vpn_bot_webhook_requests_total", "Webhook POSTs by outcome", ("result",))
+
+
+class WebhookServer:
+    # Receives updates from Telegram and acknowledges them as soon as they are
+    # handed to the application's update processor, so a slow handler never
+    # holds the HTTP request (and Telegram's per-bot delivery) open. At most
+    # `max_inflight` updates may be accepted and unfinished; above that the
+    # server answers 503 and Telegram redelivers the update later.
+    def __init__(self, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET, max_inflight: int = WEBHOOK_MAX_INFLIGHT):
+        self.path = path
+        self.secret = secret
+        self.max_inflight = max_inflight
+        self._application: Optional[Application] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    async def start(self, application: Application, host: str, port: int) -> None:
+        self._application = application
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Webhook server listening on %s:%s%s", host, port, self.path)
+
+    async def stop(self, drain_timeout: float = 10.0) -> None:
+        # Stop accepting first, then let accepted updates finish: Telegram
+        # already got a 200 for them and won't send them again
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            logger.info("Waiting for %s in-flight webhook updates", len(self._tasks))
+            _, pending = await asyncio.wait(set(self._tasks), timeout=drain_timeout)
+            if pending:
+                logger.warning("Dropping %s webhook updates still running after %ss", len(pending), drain_timeout)
+                for task in pending:
+                    task.cancel()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            WEBHOOK_REQUESTS.inc(result="forbidden")
+            return web.Response(status=403)
+        if len(self._tasks) >= self.max_inflight:
+            WEBHOOK_REQUESTS.inc(result="busy")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self._application.bot)
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            WEBHOOK_REQUESTS.inc(result="bad_request")
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        WEBHOOK_REQUESTS.inc(result="accepted")
+        return web.Response()
+
+    async def _process(self, update: Update) -> None:
+        # Same path as updates fetched by polling: the update processor keeps
+        # per-user ordering and the global concurrency limit
+        application = self._application
+        try:
+            await application.update_processor.process_update(update, application.process_update(update))
+        except Exception:
+            logger.exception("Error processing webhook update %s", update.update_id)
+
+
+webhook_server = WebhookServer()
+WEBHOOK_INFLIGHT = Gauge(
+    "vpn_bot_webhook_inflight_updates", "Accepted webhook updates not yet handled",
+    callback=lambda: webhook_server.inflight,
+)
+
+
+async def serve_webhook(application: Application, stop: asyncio.Event, ready: Optional[asyncio.Event] = None) -> None:
+    # Application lifecycle of run_polling()/run_webhook(), with our server in
+    # place of the Updater: initialize, post_init, start, serve ... and the
+    # reverse once `stop` is set
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await webhook_server.start(application, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            # Every replica registers the same URL, so this is idempotent. The
+            # webhook is not deleted on shutdown: other replicas keep serving it.
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        if ready is not None:
+            ready.set()
+        await stop.wait()
+    finally:
+        await webhook_server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application) -> None:
+    async def _main() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        await serve_webhook(application, stop)
+
+    asyncio.run(_main())
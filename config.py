@@ -1,4 +1,6 @@
+import json
 import os
+import re
 from urllib.parse import urlparse
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
@@ -6,9 +8,198 @@ MARZBAN_API_URL = os.getenv("MARZBAN_API_URL", "")
 MARZBAN_API_KEY = os.getenv("MARZBAN_API_KEY", "")
 MARZBAN_USERNAME = os.getenv("MARZBAN_USERNAME", "")
 MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD", "")
+# Marzban panels users are sharded across, as a JSON list of objects with
+# "name", "url", "api_key"/"username"/"password" and an optional "weight"
+# (0 stops new placements on a panel). Without it the MARZBAN_* settings above
+# form a single panel. Names are stored on users, so keep them stable; users
+# that have no panel yet live on the first one.
+_panels = os.getenv("MARZBAN_PANELS", "")
+if _panels:
+    MARZBAN_PANELS = [
+        {"api_key": "", "username": "", "password": "", "weight": 1, **panel}
+        for panel in json.loads(_panels)
+    ]
+else:
+    MARZBAN_PANELS = [{
+        "name": "default",
+        "url": MARZBAN_API_URL,
+        "api_key": MARZBAN_API_KEY,
+        "username": MARZBAN_USERNAME,
+        "password": MARZBAN_PASSWORD,
+        "weight": 1,
+    }]
+MARZBAN_DEFAULT_PANEL = MARZBAN_PANELS[0].get("name", "") if MARZBAN_PANELS else ""
+# New users go to the panel with the fewest active users relative to its weight
+# ("least_loaded"), or are spread by weighted rendezvous hashing ("hash")
+MARZBAN_PLACEMENT = os.getenv("MARZBAN_PLACEMENT", "least_loaded")
+MARZBAN_PLACEMENT_REFRESH = float(os.getenv("MARZBAN_PLACEMENT_REFRESH", "60"))
+
+# Max updates handled concurrently; updates from one user still run in order
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# How updates arrive: "polling" (getUpdates long poll) or "webhook" (Telegram
+# POSTs them to an embedded HTTP server; required to run several replicas)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Public HTTPS base URL Telegram should call, e.g. https://bot.example.com;
+# empty means the webhook is registered out of band
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token (1-256 of A-Z a-z 0-9 _ -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Updates accepted but not yet handled; beyond this the server answers 503
+# and Telegram redelivers later
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", str(8 * UPDATE_CONCURRENCY)))
+# Parallel connections Telegram may open to the webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Marzban HTTP connection pool (one keep-alive connector shared by all API calls)
+MARZBAN_POOL_LIMIT = int(os.getenv("MARZBAN_POOL_LIMIT", "100"))
+MARZBAN_POOL_LIMIT_PER_HOST = int(os.getenv("MARZBAN_POOL_LIMIT_PER_HOST", "20"))
+MARZBAN_DNS_CACHE_TTL = int(os.getenv("MARZBAN_DNS_CACHE_TTL", "300"))
+MARZBAN_KEEPALIVE_TIMEOUT = float(os.getenv("MARZBAN_KEEPALIVE_TIMEOUT", "30"))
+# Marzban resilience: connect/read timeouts, jittered retries for idempotent
+# calls (GET/DELETE) limited by a retry budget, and a circuit breaker
+MARZBAN_CONNECT_TIMEOUT = float(os.getenv("MARZBAN_CONNECT_TIMEOUT", "3"))
+MARZBAN_READ_TIMEOUT = float(os.getenv("MARZBAN_READ_TIMEOUT", "10"))
+MARZBAN_MAX_RETRIES = int(os.getenv("MARZBAN_MAX_RETRIES", "2"))
+MARZBAN_RETRY_BACKOFF = float(os.getenv("MARZBAN_RETRY_BACKOFF", "0.2"))
+MARZBAN_RETRY_BUDGET_RATIO = float(os.getenv("MARZBAN_RETRY_BUDGET_RATIO", "0.2"))
+MARZBAN_BREAKER_THRESHOLD = int(os.getenv("MARZBAN_BREAKER_THRESHOLD", "5"))
+MARZBAN_BREAKER_RESET = float(os.getenv("MARZBAN_BREAKER_RESET", "30"))
+# Refresh the admin token this many seconds before its JWT `exp`
+MARZBAN_TOKEN_REFRESH_MARGIN = float(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", "60"))
+# Marzban user info cache used by /profile: fresh for TTL seconds, then served
+# stale (while refreshing in the background) for up to STALE seconds more
+MARZBAN_USER_CACHE_TTL = float(os.getenv("MARZBAN_USER_CACHE_TTL", "30"))
+MARZBAN_USER_CACHE_STALE = float(os.getenv("MARZBAN_USER_CACHE_STALE", "300"))
+MARZBAN_USER_CACHE_SIZE = int(os.getenv("MARZBAN_USER_CACHE_SIZE", "10000"))
+
+# telegram_id -> user identity cache in front of the per-command users lookup
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "3600"))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "100000"))
+
+# Subscription link QR codes for /profile: rendered PNGs are kept in memory
+# (least recently used evicted past QR_CACHE_BYTES), QR_RENDER_WORKERS threads
+# render them, QR_SCALE pixels per module
+QR_CACHE_BYTES = int(os.getenv("QR_CACHE_BYTES", str(8 * 1024 * 1024)))
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+QR_SCALE = int(os.getenv("QR_SCALE", "8"))
+
+# Expired subscription cleanup
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", "200"))
+CLEANUP_CONCURRENCY = int(os.getenv("CLEANUP_CONCURRENCY", "10"))
+CLEANUP_MAX_ATTEMPTS = int(os.getenv("CLEANUP_MAX_ATTEMPTS", "3"))
+CLEANUP_RETRY_BACKOFF = float(os.getenv("CLEANUP_RETRY_BACKOFF", "1.0"))
+# A batch is claimed by leasing its rows for CLEANUP_LEASE seconds, so the
+# panel deletes run with no transaction open; rows left leased by a crashed
+# run become visible again once the lease runs out
+CLEANUP_LEASE = int(os.getenv("CLEANUP_LEASE", "300"))
+# Expired subscriptions whose panel is not configured (renamed or removed from
+# MARZBAN_PANELS) are left active and reported, since their users may still
+# have access there; set to 1 to expire them locally anyway
+CLEANUP_EXPIRE_WITHOUT_PANEL = os.getenv("CLEANUP_EXPIRE_WITHOUT_PANEL", "0") == "1"
+# Exact-time expiry: deadlines within the horizon are kept in memory, and a
+# low-frequency reconciliation scan catches anything the scheduler missed
+EXPIRY_RECONCILE_INTERVAL = int(os.getenv("EXPIRY_RECONCILE_INTERVAL", "3600"))
+EXPIRY_SCHEDULER_HORIZON = int(os.getenv("EXPIRY_SCHEDULER_HORIZON", str(2 * EXPIRY_RECONCILE_INTERVAL)))
+# A failed revocation is retried after EXPIRY_RETRY_BACKOFF seconds, doubling
+# up to EXPIRY_RETRY_MAX, until it goes through
+EXPIRY_RETRY_BACKOFF = float(os.getenv("EXPIRY_RETRY_BACKOFF", "5.0"))
+EXPIRY_RETRY_MAX = float(os.getenv("EXPIRY_RETRY_MAX", "300.0"))
+
+# Provisioning outbox workers (Marzban create/update/delete off the request path)
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "4"))
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "8"))
+PROVISIONING_RETRY_BACKOFF = float(os.getenv("PROVISIONING_RETRY_BACKOFF", "2.0"))
+PROVISIONING_LEASE = int(os.getenv("PROVISIONING_LEASE", "60"))
+PROVISIONING_POLL_INTERVAL = float(os.getenv("PROVISIONING_POLL_INTERVAL", "5"))
+
+# Panel/DB reconciliation: every RECONCILE_INTERVAL seconds (0 disables) the
+# full Marzban user list of each panel is diffed against the local users and
+# live subscriptions. Repairs go to the provisioning outbox in batches of
+# RECONCILE_BATCH_SIZE at up to RECONCILE_RATE tasks/s. A run that would
+# delete more than RECONCILE_MAX_DELETES panel users deletes none of them.
+# RECONCILE_DRY_RUN=1 only reports.
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "21600"))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "1000"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "20"))
+RECONCILE_MAX_DELETES = int(os.getenv("RECONCILE_MAX_DELETES", "500"))
+RECONCILE_EXPIRE_TOLERANCE = int(os.getenv("RECONCILE_EXPIRE_TOLERANCE", "60"))
+RECONCILE_DRY_RUN = os.getenv("RECONCILE_DRY_RUN", "0") == "1"
 
-# Logging
-LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+# Outbound message dispatcher. Telegram allows ~30 messages/s per bot and
+# ~1/s per chat; the limits are per process, and bulk senders (reminders,
+# broadcasts) run on one replica only.
+DISPATCH_GLOBAL_RATE = float(os.getenv("DISPATCH_GLOBAL_RATE", "25"))
+DISPATCH_CHAT_RATE = float(os.getenv("DISPATCH_CHAT_RATE", "1"))
+DISPATCH_CONCURRENCY = int(os.getenv("DISPATCH_CONCURRENCY", "8"))
+DISPATCH_MAX_QUEUE = int(os.getenv("DISPATCH_MAX_QUEUE", "1000"))
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "5"))
+# "Subscription ends in N hours" reminders, checked every REMINDER_INTERVAL seconds;
+# subscriptions shorter than 4*REMINDER_HOURS are reminded a quarter of their length ahead
+REMINDER_HOURS = int(os.getenv("REMINDER_HOURS", "24"))
+REMINDER_INTERVAL = int(os.getenv("REMINDER_INTERVAL", "600"))
+# Telegram ids allowed to use admin commands (/broadcast), comma-separated
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x)
+
+# Per-user anti-flood: each user may send THROTTLE_RATE updates per second,
+# bursting to THROTTLE_BURST; the excess is dropped with at most one warning
+# per THROTTLE_NOTICE_INTERVAL seconds
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "1"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "5"))
+THROTTLE_NOTICE_INTERVAL = float(os.getenv("THROTTLE_NOTICE_INTERVAL", "10"))
+
+# Usage snapshot sync from the Marzban bulk users listing
+USAGE_SYNC_INTERVAL = int(os.getenv("USAGE_SYNC_INTERVAL", "300"))
+USAGE_SYNC_PAGE_SIZE = int(os.getenv("USAGE_SYNC_PAGE_SIZE", "500"))
+# Per-user traffic history recorded by the sync: per-sample (minute) points
+# are kept for USAGE_MINUTE_DAYS days, then rolled up to hours; hours are kept
+# for USAGE_HOUR_DAYS days, then rolled up to days, which are kept for
+# USAGE_RETENTION_DAYS. The rollup runs every USAGE_ROLLUP_INTERVAL seconds.
+USAGE_MINUTE_DAYS = int(os.getenv("USAGE_MINUTE_DAYS", "2"))
+USAGE_HOUR_DAYS = int(os.getenv("USAGE_HOUR_DAYS", "8"))
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "400"))
+USAGE_ROLLUP_INTERVAL = int(os.getenv("USAGE_ROLLUP_INTERVAL", "3600"))
+USAGE_ROLLUP_BATCH_SIZE = int(os.getenv("USAGE_ROLLUP_BATCH_SIZE", "500"))
+
+# Archiving: expired/canceled subscriptions that ended more than
+# ARCHIVE_RETENTION_DAYS ago are moved to subscriptions_archive every
+# ARCHIVE_INTERVAL seconds, ARCHIVE_BATCH_SIZE rows per transaction.
+# ARCHIVE_PARTITIONED=1 creates the archive table (Postgres, on first start
+# only) range-partitioned by end_at, one partition per month.
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "90"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.1"))
+ARCHIVE_PARTITIONED = os.getenv("ARCHIVE_PARTITIONED", "0") == "1"
+
+# Prometheus-style metrics endpoint (GET /metrics); 0 disables it. It has no
+# authentication, so it listens on loopback only unless METRICS_HOST says
+# otherwise (e.g. 0.0.0.0 for a scraper in another container, behind a firewall)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9477"))
+
+# Logging. Records are written by a background thread (bot.logs); the event
+# loop only queues them. LOG_FORMAT is text or json. The other settings are
+# comma-separated name=value pairs keyed by logger name (children included):
+# LOG_LEVELS sets levels, LOG_SAMPLE keeps that fraction of a logger's
+# DEBUG/INFO records, LOG_RATE_LIMIT caps them at that many per second.
+def _pairs(value: str) -> dict[str, str]:
+    return dict(item.split("=", 1) for item in value.replace(" ", "").split(",") if "=" in item)
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVELS = {
+    name: level.upper()
+    for name, level in _pairs(os.getenv("LOG_LEVELS", "httpx=WARNING,apscheduler=WARNING,aiosqlite=INFO")).items()
+}
+LOG_SAMPLE = {name: float(rate) for name, rate in _pairs(os.getenv("LOG_SAMPLE", "")).items()}
+LOG_RATE_LIMIT = {name: float(rate) for name, rate in _pairs(os.getenv("LOG_RATE_LIMIT", "")).items()}
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
 # Database selection: prefer explicit Postgres DSN if provided,
 # otherwise use SQLite file in DB_PATH (default /app/data/bot.db)
@@ -20,5 +211,28 @@ else:
     os.makedirs(DB_PATH, exist_ok=True)
     DATABASE_URL = f"sqlite+aiosqlite:///{os.path.join(DB_PATH, 'bot.db')}"
 
+# Multi-replica mode (Postgres only): periodic jobs run on the replica holding
+# an advisory lock, and expired subscriptions are claimed with SKIP LOCKED.
+# On SQLite the bot always behaves as a single instance.
+MULTI_INSTANCE = os.getenv("MULTI_INSTANCE", "1" if POSTGRES_DSN else "0") == "1"
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", "7310001"))
+LEADER_ELECTION_INTERVAL = float(os.getenv("LEADER_ELECTION_INTERVAL", "15"))
+
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
+if not MARZBAN_PANELS or any(not panel.get("name") for panel in MARZBAN_PANELS):
+    raise RuntimeError("MARZBAN_PANELS must be a non-empty list of panels with a name")
+if len({panel["name"] for panel in MARZBAN_PANELS}) != len(MARZBAN_PANELS):
+    raise RuntimeError("MARZBAN_PANELS contains duplicate panel names")
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError(f"Unknown BOT_MODE {BOT_MODE!r}")
+if BOT_MODE == "webhook" and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise RuntimeError("WEBHOOK_SECRET must be set to 1-256 characters of A-Z, a-z, 0-9, _ and - in webhook mode")
+if MARZBAN_PLACEMENT not in ("least_loaded", "hash"):
+    raise RuntimeError(f"Unknown MARZBAN_PLACEMENT {MARZBAN_PLACEMENT!r}")
+if LOG_FORMAT not in ("text", "json"):
+    raise RuntimeError("LOG_FORMAT must be 'text' or 'json'")
+if USAGE_MINUTE_DAYS < 1 or USAGE_HOUR_DAYS < USAGE_MINUTE_DAYS:
+    raise RuntimeError("USAGE_MINUTE_DAYS must be at least 1 and USAGE_HOUR_DAYS at least USAGE_MINUTE_DAYS")
+if RECONCILE_PAGE_SIZE < 1 or RECONCILE_BATCH_SIZE < 1 or RECONCILE_RATE <= 0:
+    raise RuntimeError("RECONCILE_PAGE_SIZE and RECONCILE_BATCH_SIZE must be at least 1 and RECONCILE_RATE positive")
@@ -1,16 +1,17 @@
 import logging
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, Boolean, Date, DateTime, ForeignKey, Index, LargeBinary, literal, text,
+)
 from datetime import datetime, timezone
 
-from config import DATABASE_URL, LOG_LEVEL
+from config import ARCHIVE_PARTITIONED, DATABASE_URL
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.DEBUG))
 
 Base = declarative_base()
-logger.debug(f"Creating DB engine for {DATABASE_URL}")
+logger.debug("Creating DB engine for %s", DATABASE_URL)
 engine = create_async_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
@@ -20,6 +21,7 @@ class User(Base):
     telegram_id = Column(BigInteger, unique=True, index=True)
     username = Column(String, nullable=True)
     marzban_username = Column(String, unique=True)
+    panel = Column(String, nullable=True)  # Marzban panel name; NULL = the default (first) panel
 
 
 class Subscription(Base):
@@ -27,6 +29,165 @@ class Subscription(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
     is_trial = Column(Boolean, default=False, nullable=False)
-    status = Column(String, default="active", nullable=False)  # active | expired | canceled
+    status = Column(String, default="active", nullable=False)  # pending | active | expired | canceled
     start_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
     end_at = Column(DateTime(timezone=True), nullable=False)
+    reminded_at = Column(DateTime(timezone=True), nullable=True)  # "ends soon" reminder queued
+    revoke_lease_until = Column(DateTime(timezone=True), nullable=True)  # claimed by a revocation until then
+
+    # Partial on both Postgres and SQLite: only the live rows are indexed, so the
+    # indexes stay small however long the subscription history grows.
+    # (status, end_at, id) serves the expiry scans ordered by (end_at, id);
+    # (user_id, status) the per-user "current subscription" lookups;
+    # (end_at, id) over finished rows the archiver, which keeps that set small.
+    __table_args__ = (
+        Index(
+            "ix_subscriptions_status_end_at",
+            "status",
+            "end_at",
+            "id",
+            postgresql_where=text("status = 'active'"),
+            sqlite_where=text("status = 'active'"),
+        ),
+        Index(
+            "ix_subscriptions_user_id_status",
+            "user_id",
+            "status",
+            postgresql_where=text("status IN ('active', 'pending')"),
+            sqlite_where=text("status IN ('active', 'pending')"),
+        ),
+        Index(
+            "ix_subscriptions_finished_end_at",
+            "end_at",
+            "id",
+            postgresql_where=text("status IN ('expired', 'canceled')"),
+            sqlite_where=text("status IN ('expired', 'canceled')"),
+        ),
+    )
+
+
+
+# Status filters for queries served by the partial indexes above. The values
+# are rendered into the SQL as literals: a bound parameter can't be matched
+# against an index predicate (SQLite's IN, Postgres generic plans).
+def subscription_is_active():
+    return Subscription.status == literal("active", literal_execute=True)
+
+
+def subscription_is_live():
+    return Subscription.status.in_([literal(status, literal_execute=True) for status in ("active", "pending")])
+
+
+def subscription_is_finished():
+    return Subscription.status.in_([literal(status, literal_execute=True) for status in ("expired", "canceled")])
+
+
+class SubscriptionArchive(Base):
+    # Finished subscriptions moved out of `subscriptions` by bot.archive, ids
+    # kept. Partitioned tables need the partition key in the primary key.
+    __tablename__ = "subscriptions_archive"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+    is_trial = Column(Boolean, nullable=False)
+    status = Column(String, nullable=False)
+    start_at = Column(DateTime(timezone=True), nullable=False)
+    end_at = Column(DateTime(timezone=True), primary_key=True)
+    reminded_at = Column(DateTime(timezone=True), nullable=True)
+    archived_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index("ix_subscriptions_archive_user_id_end_at", "user_id", "end_at"),
+        {"postgresql_partition_by": "RANGE (end_at)"} if ARCHIVE_PARTITIONED else {},
+    )
+
+
+class SubscriptionSummary(Base):
+    # Per-user totals over the archived subscriptions
+    __tablename__ = "subscription_summaries"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    subscriptions = Column(Integer, nullable=False, default=0)
+    trials = Column(Integer, nullable=False, default=0)
+    days = Column(Integer, nullable=False, default=0)  # total subscribed days, rounded per subscription
+    first_start_at = Column(DateTime(timezone=True), nullable=True)
+    last_end_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class UsageSnapshot(Base):
+    # Local copy of per-user traffic/limits, bulk-synced from the Marzban users listing
+    __tablename__ = "usage_snapshots"
+    # the same username can exist on two panels
+    panel = Column(String, primary_key=True)
+    marzban_username = Column(String, primary_key=True)
+    status = Column(String, nullable=True)
+    used_traffic = Column(BigInteger, nullable=False, default=0)
+    data_limit = Column(BigInteger, nullable=True)
+    expire = Column(BigInteger, nullable=True)  # unix timestamp, as returned by Marzban
+    synced_at = Column(DateTime(timezone=True), nullable=False)  # last sync that saw this user
+    updated_at = Column(DateTime(timezone=True), nullable=False)  # last sync that changed a value
+    stale_at = Column(DateTime(timezone=True), nullable=True)  # changed on the panel since that sync
+
+
+class UsageSeries(Base):
+    # Per-user traffic deltas, one row per user, period and resolution rather
+    # than one per sample. `points` packs (slot, bytes) pairs as varints (see
+    # bot.timeseries): minute and hour rows cover one day (slot = minute or
+    # hour of the day), day rows one month (period = the 1st, slot = day - 1).
+    __tablename__ = "usage_series"
+    marzban_username = Column(String, primary_key=True)
+    period = Column(Date, primary_key=True)
+    resolution = Column(String, primary_key=True)  # minute | hour | day
+    points = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+    # the rollup job walks one resolution's oldest periods
+    __table_args__ = (Index("ix_usage_series_resolution_period", "resolution", "period"),)
+
+
+class SubscriptionQr(Base):
+    # Telegram file_id of the subscription link QR image last uploaded for a
+    # user; dropped when the user is provisioned again
+    __tablename__ = "subscription_qr_codes"
+    marzban_username = Column(String, primary_key=True)
+    subscription_url = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
+class ProvisioningTask(Base):
+    # Outbox of Marzban operations, written in the same transaction as the
+    # subscription change and executed by bot.provisioning workers
+    __tablename__ = "provisioning_tasks"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # create | update | delete
+    # pending | done | failed | skipped (a reconcile repair that no longer applied when claimed)
+    status = Column(String, default="pending", nullable=False)
+    # kept when the subscription is archived: the task is the record of what was pushed to the panel
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id", ondelete="SET NULL"), nullable=True)
+    marzban_username = Column(String, nullable=False)
+    panel = Column(String, nullable=True)
+    data_limit = Column(BigInteger, nullable=True)
+    expire_at = Column(BigInteger, nullable=True)
+    notify_chat_id = Column(BigInteger, nullable=True)
+    origin = Column(String, nullable=True)  # "reconcile" for bot.reconcile repairs, NULL otherwise
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    # earliest time a worker may pick the task up; also used as the claim lease
+    run_after = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+    # subscription_id: the reconciliation looks up the limit last pushed per subscription
+    __table_args__ = (
+        Index("ix_provisioning_tasks_status_run_after", "status", "run_after"),
+        Index("ix_provisioning_tasks_subscription_id", "subscription_id"),
+    )
+
+
+class AdminCheckpoint(Base):
+    # Progress of a resumable admin.py run, committed with each batch it covers
+    __tablename__ = "admin_checkpoints"
+    name = Column(String, primary_key=True)
+    position = Column(BigInteger, nullable=False, default=0)  # input line or last subscription id done
+    processed = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
@@ -1,14 +1,88 @@
 import asyncio
 import logging
-from db.models import Base, engine
+from sqlalchemy import inspect, text
+from db.models import Base, UsageSnapshot, engine
+from config import MARZBAN_DEFAULT_PANEL
 
 logger = logging.getLogger(__name__)
 
 
+def _add_missing_columns(sync_conn) -> None:
+    # create_all() skips tables that already exist; add the nullable columns
+    # introduced since they were created
+    inspector = inspect(sync_conn)
+    quote = sync_conn.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} to an existing table")
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            logger.info("Adding column %s.%s", table.name, column.name)
+            sync_conn.execute(
+                text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}")
+            )
+
+
+def _rekey_usage_snapshots(sync_conn) -> None:
+    # usage_snapshots used to be keyed by marzban_username alone; it is now
+    # keyed by (panel, marzban_username). The rows are copied into the new
+    # table rather than dropped: they hold the baselines of the usage deltas.
+    inspector = inspect(sync_conn)
+    table = UsageSnapshot.__table__
+    if not inspector.has_table(table.name):
+        return
+    pk = inspector.get_pk_constraint(table.name)
+    if pk["constrained_columns"] != ["marzban_username"]:
+        return
+    logger.info("Rekeying %s by (panel, marzban_username)", table.name)
+    quote = sync_conn.dialect.identifier_preparer.quote
+    old = f"{table.name}_old"
+    sync_conn.execute(text(f"ALTER TABLE {quote(table.name)} RENAME TO {quote(old)}"))
+    if pk.get("name") and sync_conn.dialect.name == "postgresql":
+        # constraint (and index) names are per schema there
+        sync_conn.execute(text(f"ALTER TABLE {quote(old)} RENAME CONSTRAINT {quote(pk['name'])} TO {quote(old + '_pkey')}"))
+    table.create(sync_conn)
+    existing = {column["name"] for column in inspector.get_columns(old)}
+    columns = [column.name for column in table.columns if column.name in existing]
+    values = ["COALESCE(panel, :panel)" if name == "panel" else quote(name) for name in columns]
+    sync_conn.execute(
+        text(
+            f"INSERT INTO {quote(table.name)} ({', '.join(quote(name) for name in columns)}) "
+            f"SELECT {', '.join(values)} FROM {quote(old)}"
+        ),
+        {"panel": MARZBAN_DEFAULT_PANEL},
+    )
+    sync_conn.execute(text(f"DROP TABLE {quote(old)}"))
+
+
+def _add_missing_indexes(sync_conn) -> None:
+    # Same for indexes. On a large Postgres table this locks writes while it
+    # builds; create the index beforehand with CREATE INDEX CONCURRENTLY under
+    # the same name to avoid that, and it will be left alone here.
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            logger.info("Creating index %s on %s", index.name, table.name)
+            index.create(sync_conn)
+
+
 async def init_db() -> None:
     logger.info("Initializing database schema...")
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_rekey_usage_snapshots)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_add_missing_indexes)
     logger.info("Database schema is up to date.")
 
 
@@ -1,42 +1,112 @@
 import asyncio
-import logging
-from telegram.ext import ApplicationBuilder, CommandHandler
-from config import BOT_TOKEN
+from typing import Optional
+from telegram import Bot
+from telegram.ext import Application, ApplicationBuilder, CommandHandler
+from config import (
+    ARCHIVE_INTERVAL,
+    BOT_MODE,
+    BOT_TOKEN,
+    EXPIRY_RECONCILE_INTERVAL,
+    METRICS_HOST,
+    METRICS_PORT,
+    RECONCILE_INTERVAL,
+    REMINDER_INTERVAL,
+    UPDATE_CONCURRENCY,
+    USAGE_ROLLUP_INTERVAL,
+    USAGE_SYNC_INTERVAL,
+)
+from bot.archive import archive_expired
 from bot.handlers.start import start
 from bot.handlers.profile import profile
 from bot.handlers.trial import trial
-from bot.jobs import cleanup_expired
+from bot.handlers.broadcast import broadcast
+from bot.handlers.usage import usage
+from bot.concurrency import PerUserUpdateProcessor
+from bot.coordination import leader, leader_only
+from bot.dispatcher import dispatcher
+from bot.logs import setup_logging
+from bot.marzban_api import close_clients, start_clients
+from bot.metrics import instrument_engine, metrics_server, timed_handler
+from bot.notifications import remind_expiring
+from bot.provisioning import provisioner, report_provisioning_stats
+from bot.qr import qr_cache
+from bot.reconcile import reconcile_marzban
+from bot.scheduler import expiry_scheduler, reconcile_expired
+from bot.throttle import throttle
+from bot.timeseries import rollup_usage
+from bot.usage import sync_usage
+from bot.webhook import run_webhook
+from db.models import engine
 from init_db import init_db
 
 
-def main() -> None:
-    # Ensure an event loop exists (Python 3.11)
-    try:
-        asyncio.get_event_loop()
-    except RuntimeError:
-        asyncio.set_event_loop(asyncio.new_event_loop())
-
+def build_application(bot: Optional[Bot] = None) -> Application:
     async def _post_init(app):
+        instrument_engine(engine)
         await init_db()
+        if METRICS_PORT:
+            await metrics_server.start(METRICS_HOST, METRICS_PORT)
+        await start_clients()
+        await leader.start()
+        await expiry_scheduler.start()
+        await dispatcher.start(app.bot)
+        await provisioner.start()
+
+    async def _post_shutdown(app):
+        await provisioner.stop()
+        await dispatcher.stop()
+        await expiry_scheduler.stop()
+        await leader.stop()
+        await close_clients()
+        qr_cache.close()
+        await metrics_server.stop()
 
-    logging.getLogger().setLevel(logging.DEBUG)
-    app = (
+    builder = (
         ApplicationBuilder()
-        .token(BOT_TOKEN)
         .post_init(_post_init)
-        .concurrent_updates(False)
-        .build()
+        .post_shutdown(_post_shutdown)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, throttle=throttle))
     )
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN)
+    if BOT_MODE == "webhook":
+        # updates come from bot.webhook's server instead of the Updater
+        builder = builder.updater(None)
+    app = builder.build()
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("profile", profile))
-    app.add_handler(CommandHandler("trial", trial))
+    app.add_handler(CommandHandler("start", timed_handler("start", start)))
+    app.add_handler(CommandHandler("profile", timed_handler("profile", profile)))
+    app.add_handler(CommandHandler("trial", timed_handler("trial", trial)))
+    app.add_handler(CommandHandler("usage", timed_handler("usage", usage)))
+    app.add_handler(CommandHandler("broadcast", timed_handler("broadcast", broadcast)))
 
-    # periodic cleanup job
+    # expiry reconciliation runs on every replica (batches are claimed with
+    # SKIP LOCKED and each replica refills its own scheduler); exact-time
+    # revocation is done by expiry_scheduler. Other periodic jobs are leader-only.
     job_queue = app.job_queue
     if job_queue is not None:
-        job_queue.run_repeating(cleanup_expired, interval=300, first=60)
+        job_queue.run_repeating(reconcile_expired, interval=EXPIRY_RECONCILE_INTERVAL, first=60)
+        job_queue.run_repeating(leader_only(sync_usage), interval=USAGE_SYNC_INTERVAL, first=10)
+        job_queue.run_repeating(leader_only(remind_expiring), interval=REMINDER_INTERVAL, first=45)
+        job_queue.run_repeating(leader_only(archive_expired), interval=ARCHIVE_INTERVAL, first=300)
+        job_queue.run_repeating(leader_only(rollup_usage), interval=USAGE_ROLLUP_INTERVAL, first=600)
+        if RECONCILE_INTERVAL > 0:
+            job_queue.run_repeating(leader_only(reconcile_marzban), interval=RECONCILE_INTERVAL, first=900)
+        job_queue.run_repeating(report_provisioning_stats, interval=30, first=30)
+    return app
 
+
+def main() -> None:
+    setup_logging()
+    app = build_application()
+    if BOT_MODE == "webhook":
+        run_webhook(app)
+        return
+
+    # Ensure an event loop exists (Python 3.11)
+    try:
+        asyncio.get_event_loop()
+    except RuntimeError:
+        asyncio.set_event_loop(asyncio.new_event_loop())
     app.run_polling()
 
 